@@ -5,6 +5,7 @@ import socket
 import sys
 from enum import Enum
 import time
+import warnings
 import asyncio
 import logging
 import tornado
@@ -15,12 +16,16 @@ from dataclasses import dataclass
 import math
 import functools
 import traceback
+import bisect
+import re
+import weakref
+from collections import OrderedDict, namedtuple, deque
 import numpy as np
 from scipy.spatial.transform import Rotation
 
 logger = logging.getLogger(__name__)
 
-RECEIVE_SIZE = 1024
+RECEIVE_SIZE = 65536
 
 HOST = "10.0.0.1"
 PORT = 1294
@@ -33,24 +38,27 @@ IPP_ERROR_CHAR = "!"
 status = 0
 
 class float3:
+  __slots__ = ("x", "y", "z")
+
   def __init__(self, *args):
     if len(args)==0: 
-      self.values = (0,0,0)
+      values = (0,0,0)
     elif len(args)==1:
       if hasattr(args[0], '__iter__'):
-        self.values = tuple([ i for i in args[0] ])
+        values = tuple([ i for i in args[0] ])
       else:
         logger.debug("failed to create values")
         raise ValueError("Invalid args {} for float3".format(args))
     elif len(args) == 3:
-      self.values = args
+      values = args
     else: 
       raise ValueError("Invalid args {} for float3".format(args))
 
-    self.x = self.values[0]
-    self.y = self.values[1]
-    self.z = self.values[2]
+    (self.x, self.y, self.z) = values
 
+  @property
+  def values(self):
+    return (self.x, self.y, self.z)
 
   def __array__(self, dtype=None):
       if dtype:
@@ -62,6 +70,8 @@ class float3:
     """ Returns the vector difference of self and other """
     if isinstance(other, float3):
       subbed = float3(self.x-other.x,self.y-other.y,self.z-other.z)
+    elif isinstance(other, float3Array):
+      return NotImplemented
     elif isinstance(other, (int, float)):
       subbed = float3( list(a - other for a in self) )
     else:
@@ -74,6 +84,8 @@ class float3:
     """ Returns the vector addition of self and other """
     if isinstance(other, float3):
       added = float3(other.x+self.x,other.y+self.y,other.z+self.z)
+    elif isinstance(other, float3Array):
+      return NotImplemented
     elif isinstance(other, (int, float)):
       added = float3( list(a + other for a in self) )
     else:
@@ -89,6 +101,8 @@ class float3:
     elif isinstance(other, (int, float)):
       product = float3(self.x*other, self.y*other, self.z*other)
       return product
+    elif isinstance(other, float3Array):
+      return NotImplemented
     else:
       raise ValueError("Multiplication with type {} not supported".format(type(other)))
   def __rmul__(self, other):
@@ -96,15 +110,17 @@ class float3:
       return self.__mul__(other)
   def norm(self):
         """ Returns the norm (length, magnitude) of the vector """
-        return math.sqrt(sum( x*x for x in self ))
+        return math.sqrt(self.x*self.x + self.y*self.y + self.z*self.z)
   def normalize(self):
         """ Returns a normalized unit vector """
         norm = self.norm()
-        normed = tuple( x / norm for x in self )
-        return self.__class__(*normed)
+        return self.__class__(self.x / norm, self.y / norm, self.z / norm)
   def __iter__(self):
-    for val in [self.x,self.y,self.z]:
-      yield val
+    yield self.x
+    yield self.y
+    yield self.z
+  def __len__(self):
+    return 3
   def __repr__(self):
         return str(self.values)
   def __getitem__(self, item):
@@ -115,7 +131,14 @@ class float3:
     """
     if not isinstance(vector, float3):
       raise ValueError('The dot product requires another vector')
-    return sum(a * b for a, b in zip(self, vector))
+    return self.x*vector.x + self.y*vector.y + self.z*vector.z
+
+  def cross(self, vector):
+    """ Returns the cross product of self and another vector
+    """
+    if not isinstance(vector, float3):
+      raise ValueError('The cross product requires another vector')
+    return float3(self.y*vector.z - self.z*vector.y, self.z*vector.x - self.x*vector.z, self.x*vector.y - self.y*vector.x)
   
   def ToXYZString(self):
     return "X(%s), Y(%s), Z(%s)" % (self.x, self.y, self.z)
@@ -128,17 +151,338 @@ class float3:
 
   @classmethod
   def FromXYZString(cls, xyzString):
-    x = float(xyzString[xyzString.find("X(") + 2 : xyzString.find("), Y")])
-    y = float(xyzString[xyzString.find("Y(") + 2 : xyzString.find("), Z")])
-    z = float(xyzString[xyzString.find("Z(") + 2 : xyzString.rfind(")")])
+    (x, y, z) = compileResponseFormat("X(),Y(),Z()").parse(xyzString)
     return cls(x,y,z)
 
   def ToIJKString(self):
     return "IJK(%s,%s,%s)" % (self.x, self.y, self.z)
 
+
+class float3Array:
+  """
+  N points or vectors held in one contiguous N x 3 float64 array, with the
+  arithmetic of float3 applied to every row at once. Operands can be another
+  float3Array of the same length, a float3 (applied to every row), a scalar or
+  an array of N scalars (one per row). Indexing a row returns a float3, slicing
+  returns a float3Array.
+
+    contacts = startPos + float3Array.outer(np.linspace(0, length, numPoints), lineVec)
+  """
+  __slots__ = ("array",)
+
+  def __init__(self, points=()):
+    if isinstance(points, float3Array):
+      points = points.array
+    elif not isinstance(points, np.ndarray):
+      points = [ tuple(p) for p in points ]
+    self.array = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+
+  @classmethod
+  def outer(cls, scales, vector):
+    '''
+    vector scaled by each of scales
+    '''
+    return cls(np.outer(scales, np.asarray(vector, dtype=np.float64)))
+
+  @staticmethod
+  def _operand(other):
+    if isinstance(other, float3Array):
+      return other.array
+    if isinstance(other, float3):
+      return np.array(other.values, dtype=np.float64)
+    if isinstance(other, (int, float)):
+      return other
+    if isinstance(other, np.ndarray):
+      # one scalar per row
+      return other[:,None] if other.ndim == 1 else other
+    return NotImplemented
+
+  def __add__(self, other):
+    other = self._operand(other)
+    return NotImplemented if other is NotImplemented else float3Array(self.array + other)
+  __radd__ = __add__
+
+  def __sub__(self, other):
+    other = self._operand(other)
+    return NotImplemented if other is NotImplemented else float3Array(self.array - other)
+
+  def __rsub__(self, other):
+    other = self._operand(other)
+    return NotImplemented if other is NotImplemented else float3Array(other - self.array)
+
+  def __mul__(self, other):
+    other = self._operand(other)
+    return NotImplemented if other is NotImplemented else float3Array(self.array * other)
+  __rmul__ = __mul__
+
+  def __neg__(self):
+    return float3Array(-self.array)
+
+  def dot(self, other):
+    '''
+    Row by row dot products with a float3 or float3Array, an array of N values
+    '''
+    return (self.array * self._operand(other)).sum(axis=1)
+
+  def cross(self, other):
+    return float3Array(np.cross(self.array, self._operand(other)))
+
+  def norm(self):
+    return np.sqrt((self.array * self.array).sum(axis=1))
+
+  def normalize(self):
+    return float3Array(self.array / self.norm()[:,None])
+
+  @property
+  def x(self):
+    return self.array[:,0]
+
+  @property
+  def y(self):
+    return self.array[:,1]
+
+  @property
+  def z(self):
+    return self.array[:,2]
+
+  def __len__(self):
+    return self.array.shape[0]
+
+  def __getitem__(self, item):
+    if isinstance(item, (int, np.integer)):
+      return float3(*self.array[item].tolist())
+    return float3Array(self.array[item])
+
+  def __iter__(self):
+    for row in self.array.tolist():
+      yield float3(*row)
+
+  def __array__(self, dtype=None):
+    return self.array if dtype is None else self.array.astype(dtype)
+
+  def __repr__(self):
+    return "float3Array(%s)" % self.array.tolist()
+
+  def ToXYZStrings(self):
+    return [ "X(%s), Y(%s), Z(%s)" % row for row in map(tuple, self.array.tolist()) ]
+
+  def ToIJKStrings(self):
+    return [ "IJK(%s,%s,%s)" % row for row in map(tuple, self.array.tolist()) ]
+
+# Response fields with a fixed number of numeric values. Any other field is
+# converted by its content: a number, a quoted string or a tuple of numbers.
+SCALAR_FIELDS = { "X", "Y", "Z", "R", "ER", "Q", "Tool.A", "Tool.B", "Tool.C" }
+VECTOR_FIELDS = { "IJK", "IJKAct" }
+
+FORMAT_FIELD_RE = re.compile(r'([A-Za-z_][\w.]*)\(\)')
+NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+def _vector_field(value):
+  (i, j, k) = value.split(",")
+  return float3(float(i), float(j), float(k))
+
+def _generic_field(value):
+  values = value.split(",")
+  if len(values) > 1:
+    return tuple(float(v) for v in values)
+  value = value.strip()
+  try:
+    return float(value)
+  except ValueError:
+    return value.strip('"')
+
+class ResponseParser:
+  """
+  Parses response lines of a fixed format, as configured with OnPtMeasReport,
+  OnScanReport or passed to Get/GetProp, e.g. "X(),Y(),Z(),IJK(),Tool.A()".
+  The format is compiled once into a regular expression and a converter per
+  field. Lines are parsed into namedtuples with one lower case field per format
+  field ("Tool.A" becomes tool_a). Scalars like X() and ER() are floats, IJK() is
+  a float3 and any other field is converted by its content.
+
+  Use compileResponseFormat to get a cached parser for a format string.
+  """
+  def __init__(self, formatString):
+    self.format = formatString
+    self.fields = FORMAT_FIELD_RE.findall(formatString)
+    if not self.fields:
+      raise ValueError("No fields in response format %s" % formatString)
+    self.Result = namedtuple("Response", [ re.sub(r'\W', '_', f).lower() for f in self.fields ], rename=True)
+
+    self.regex = re.compile(r'\s*,\s*'.join(re.escape(f) + r'\(([^()]*)\)' for f in self.fields))
+    self.fieldRegexes = [ re.compile(re.escape(f) + r'\(([^()]*)\)') for f in self.fields ]
+    self.converters = []
+    self.width = 0
+    for f in self.fields:
+      if f in SCALAR_FIELDS:
+        self.converters.append(float)
+        self.width += 1
+      elif f in VECTOR_FIELDS:
+        self.converters.append(_vector_field)
+        self.width += 3
+      else:
+        self.converters.append(_generic_field)
+    self.isScalar = all(c is float for c in self.converters)
+    # Number of float columns of parseArray, None if the format has non numeric fields
+    if _generic_field in self.converters:
+      self.width = None
+
+  def _groups(self, line):
+    m = self.regex.search(line)
+    if m is not None:
+      return m.groups()
+    # Fall back to looking for each field on its own, e.g. if the server reordered them
+    groups = []
+    for r in self.fieldRegexes:
+      m = r.search(line)
+      groups.append(m.group(1) if m else None)
+    return groups
+
+  def _convert(self, groups):
+    if self.isScalar:
+      return self.Result._make(map(float, groups))
+    return self.Result._make(None if g is None else c(g) for (c, g) in zip(self.converters, groups))
+
+  def parse(self, line):
+    '''
+    Parse a single response line, fields missing from the line are None
+    '''
+    groups = self._groups(line)
+    if self.isScalar and None in groups:
+      return self.Result._make(None if g is None else float(g) for g in groups)
+    return self._convert(groups)
+
+  def parseMany(self, lines):
+    '''
+    Parse a batch of response lines that all match the format
+    '''
+    matches = self.regex.findall("".join(lines))
+    if len(matches) != len(lines):
+      return [ self.parse(line) for line in lines ]
+    if len(self.fields) == 1:
+      matches = [ (m,) for m in matches ]
+    return [ self._convert(m) for m in matches ]
+
+  def parseArray(self, lines):
+    '''
+    Parse a batch of response lines into an N x width float64 array, IJK()
+    fields taking three columns
+    '''
+    if self.width is None:
+      raise ValueError("Response format %s has non numeric fields" % self.format)
+    text = "".join(lines)
+    if self.isScalar:
+      matches = self.regex.findall(text)
+      if len(matches) == len(lines):
+        return np.array(matches, dtype=np.float64).reshape(len(lines), self.width)
+    values = np.array(NUMBER_RE.findall("\n".join(m.group(0) for m in self.regex.finditer(text))), dtype=np.float64)
+    return values.reshape(-1, self.width)
+
+@functools.lru_cache(maxsize=128)
+def _compile_response_format(formatString):
+  return ResponseParser(formatString)
+
+def compileResponseFormat(formatString):
+  '''
+  Returns the cached ResponseParser for a response format string
+  '''
+  return _compile_response_format(formatString.replace(" ", ""))
+
+def parseScanLines(lines, width):
+  '''
+  Parse unlabeled scan data lines ("00012 # 1,2,3,...") into an N x width array,
+  raises ValueError if they don't hold whole rows of numbers. The lines can also be
+  given concatenated, as a str, bytes or uint8 array of ASCII text.
+  '''
+  if isinstance(lines, np.ndarray):
+    lines = lines.tobytes()
+  if isinstance(lines, bytes):
+    lines = lines.decode("ascii")
+  if isinstance(lines, str):
+    lines = lines.splitlines()
+  # Skip the "00012 # " tag and response key, the trailing CRLFs are ignored as whitespace
+  text = ",".join([ line[8:] for line in lines ])
+  with warnings.catch_warnings():
+    warnings.simplefilter("error", DeprecationWarning)
+    try:
+      values = np.fromstring(text, sep=",")
+    except DeprecationWarning:
+      raise ValueError("Scan data has values that aren't numbers") from None
+  if values.size % width:
+    raise ValueError("Scan data has %s values, not a multiple of %s" % (values.size, width))
+  return values.reshape(-1, width)
+
+class ScanResult:
+  """
+  Scan data parsed in bulk into a contiguous N x k float64 array, one row per
+  point and one column per value of the OnScanReport format, IJK() taking three
+  columns. Scan data lines hold comma separated values for one or more points
+  and are parsed without creating an object per point.
+  """
+  def __init__(self, array, format="X(),Y(),Z()"):
+    self.array = array
+    self.format = format
+    self.columns = []
+    for f in compileResponseFormat(format).fields:
+      if f in VECTOR_FIELDS:
+        self.columns.extend([ "i", "j", "k" ])
+      else:
+        self.columns.append(re.sub(r'\W', '_', f).lower())
+
+  @classmethod
+  def fromLines(cls, lines, format="X(),Y(),Z()"):
+    '''
+    Parse scan data lines, raises ValueError if they don't hold whole rows of numbers
+    '''
+    parser = compileResponseFormat(format)
+    if parser.width is None:
+      raise ValueError("Scan format %s has non numeric fields" % format)
+    if not lines:
+      return cls(np.empty((0, parser.width)), format)
+
+    if "(" in lines[0]:
+      # Values labeled like X(1.0), parse them with the response format
+      return cls(parser.parseArray(lines), format)
+
+    return cls(parseScanLines(lines, parser.width), format)
+
+  @classmethod
+  def fromTransaction(cls, transaction, format="X(),Y(),Z()"):
+    return cls.fromLines(transaction.data_list, format)
+
+  def __len__(self):
+    return self.array.shape[0]
+
+  def __array__(self, dtype=None):
+    return self.array if dtype is None else self.array.astype(dtype)
+
+  def column(self, name):
+    return self.array[:, self.columns.index(name)]
+
+  @property
+  def xyz(self):
+    '''
+    N x 3 array of the X, Y and Z columns, a view when they are adjacent
+    '''
+    start = self.columns.index("x")
+    if self.columns[start:start+3] == [ "x", "y", "z" ]:
+      return self.array[:, start:start+3]
+    return self.array[:, [ self.columns.index(c) for c in "xyz" ]]
+
+  @property
+  def ijk(self):
+    start = self.columns.index("i")
+    return self.array[:, start:start+3]
+
+  @property
+  def points(self):
+    return float3Array(self.xyz)
+
 # I++ documentation mentions zxz rotation order in an example and 
 # experimentation has shown it work. 
 ORDER = 'zxz'
+CSY_FIELDS = ( "x", "y", "z", "theta", "psi", "phi" )
+
 class Csy:
   def __init__(self, x,y,z,theta,psi,phi):
     """
@@ -153,42 +497,105 @@ class Csy:
     self.psi = psi
     self.phi = phi
 
+  def __setattr__(self, name, value):
+    # any change to the origin or angles invalidates the cached matrices
+    object.__setattr__(self, name, value)
+    if name in CSY_FIELDS:
+      object.__setattr__(self, "_matrix", None)
+      object.__setattr__(self, "_inverse", None)
+
   def toMatrix4(self):
-    r = Rotation.from_euler(ORDER, (self.phi, self.theta, self.psi), degrees=True)
+    return self._matrix4().copy()
+
+  def _matrix4(self):
+    if self._matrix is None:
+      self._matrix = Csy.toMatrix4Array([ self ])[0]
+    return self._matrix
 
-    # Convert rotation to 3x3 matrix
-    mat3 = r.as_matrix()
+  def inverseMatrix4(self):
+    return self._inverseMatrix4().copy()
 
-    # Initialize empty 4x4 matrix
-    mat4 = np.empty((4,4))
+  def _inverseMatrix4(self):
+    if self._inverse is None:
+      mat4 = self._matrix4()
+      inverse = np.identity(4)
+      inverse[:3,:3] = mat4[:3,:3].T
+      inverse[:3,3] = -mat4[:3,:3].T @ mat4[:3,3]
+      self._inverse = inverse
+    return self._inverse
 
-    # Copy 3x3 rotation matrix into top left of 4x4 matrix
-    mat4[:3,:3] = mat3
+  def fromMatrix4(mat4):
+    return Csy.fromMatrix4Array([ mat4 ])[0]
+
+  @staticmethod
+  def toMatrix4Array(csys):
+    '''
+    N x 4 x 4 array of the matrices of a sequence of Csys, with one Rotation for all of them
+    '''
+    values = np.array([ (c.x, c.y, c.z, c.phi, c.theta, c.psi) for c in csys ], dtype=np.float64).reshape(-1, 6)
 
-    # Populate the translation portion of the 4x4 matrix with the origin
-    mat4[:3,3] = (self.x, self.y, self.z)
+    mat4 = np.zeros((len(values), 4, 4))
+
+    # Rotation in the top left, origin in the translation column
+    mat4[:,:3,:3] = Rotation.from_euler(ORDER, values[:,3:], degrees=True).as_matrix()
+    mat4[:,:3,3] = values[:,:3]
 
     # Fill in the homogenous coordinates
-    mat4[3,:] = [0,0,0,1]
+    mat4[:,3,3] = 1
 
     return mat4
 
-  def fromMatrix4(mat4):
-    # Extract the 3x3 rotation matrix from the 4x4 matrix
-    mat3 = mat4[0:3, 0:3]
+  @staticmethod
+  def fromMatrix4Array(mat4s):
+    '''
+    Csys of an N x 4 x 4 array of matrices
+    '''
+    mat4s = np.asarray(mat4s, dtype=np.float64).reshape(-1, 4, 4)
 
-    # Create a rotation object with rotation matrix
-    r = Rotation.from_matrix(mat3)
+    # Convert the rotations to euler angles
+    angles = Rotation.from_matrix(mat4s[:,:3,:3]).as_euler(ORDER, degrees=True)
 
-    # Convert rotation to euler angles
-    (phi, theta, psi) = r.as_euler(ORDER, degrees=True)
+    return [ Csy(x, y, z, theta, psi, phi) for ((x, y, z), (phi, theta, psi)) in zip(mat4s[:,:3,3].tolist(), angles.tolist()) ]
 
-    # Extract the origin from the translation components of 4x4 matrix
-    x = mat4[0][3]
-    y = mat4[1][3]
-    z = mat4[2][3]
+  def __matmul__(self, other):
+    '''
+    Composition: other is relative to self, e.g. machine_csy = part_csy @ feature_csy
+    '''
+    return Csy.fromMatrix4(self._matrix4() @ other._matrix4())
 
-    return Csy(x,y,z,theta,psi,phi)
+  def inverse(self):
+    return Csy.fromMatrix4(self._inverseMatrix4())
+
+  def _transform(self, mat4, points, directions):
+    array = toPointArray(points)
+    array = array @ mat4[:3,:3].T
+    if not directions:
+      array = array + mat4[:3,3]
+    if isinstance(points, float3):
+      return float3(*array[0].tolist())
+    if isinstance(points, float3Array):
+      return float3Array(array)
+    return array
+
+  def toMachine(self, points, directions=False):
+    '''
+    Points or, with directions=True, vectors in this Csy to machine coordinates. Takes
+    a float3, float3Array, N x 3 array or ScanResult and returns a float3, float3Array
+    or N x 3 array.
+    '''
+    return self._transform(self._matrix4(), points, directions)
+
+  def fromMachine(self, points, directions=False):
+    '''
+    Points or vectors in machine coordinates to this Csy, the inverse of toMachine
+    '''
+    return self._transform(self._inverseMatrix4(), points, directions)
+
+  def transformPoints(self, points):
+    return self.toMachine(points)
+
+  def transformVectors(self, vectors):
+    return self.toMachine(vectors, directions=True)
 
   def toJSON(self):
     return {
@@ -208,12 +615,22 @@ class Csy:
     
 
 def readPointData(data):
-  logger.debug("read point data %s" % data)
-  x = float(data[data.find("X(") + 2 : data.find("), Y")])
-  y = float(data[data.find("Y(") + 2 : data.find("), Z")])
-  z = float(data[data.find("Z(") + 2 : data.rfind(")")])
-  pt = float3(x,y,z)
-  return pt
+  logger.debug("read point data %s", data)
+  return float3.FromXYZString(data)
+
+def toPointArray(points):
+  '''
+  N x 3 float64 array from an N x 3 array, a float3Array, a float3, a sequence of float3 or a ScanResult
+  '''
+  if isinstance(points, ScanResult):
+    points = points.xyz
+  elif isinstance(points, float3Array):
+    points = points.array
+  elif isinstance(points, float3):
+    points = [ points.values ]
+  elif not isinstance(points, np.ndarray):
+    points = [ tuple(p) for p in points ]
+  return np.asarray(points, dtype=np.float64).reshape(-1, 3)
 
 
 async def noop(args=None):
@@ -271,6 +688,37 @@ class CmmExceptionAxisLimit(CmmException):
   pass
 class CmmExceptionUnknownCommand(CmmException):
   pass
+class CmmExceptionFlushed(CmmException):
+  """
+  Raised for a queued command the server discarded because an earlier command
+  failed with an error that stops the DME
+  """
+  pass
+
+
+# I++ error severity classes, the first argument of an Error(...) response
+ERROR_SEVERITY_INFO = 0
+ERROR_SEVERITY_WARNING = 1
+# The command is aborted, the server goes on with the next queued command
+ERROR_SEVERITY_ERROR = 2
+# The command is aborted, the DME stops and every queued command is discarded
+# until ClearAllErrors
+ERROR_SEVERITY_STOP = 3
+ERROR_SEVERITY_FATAL = 9
+
+ERROR_RE = re.compile(r'Error\(\s*(\d+)\s*,\s*(\d+)\s*,\s*"?([^",]*)"?\s*,\s*"?([^"]*)"?\s*\)')
+
+IppError = namedtuple("IppError", [ "severity", "code", "command", "text" ])
+
+def parseError(msg):
+  '''
+  Parse an error response like: 00012 ! Error(3, 1006, "PtMeas", "Surface not found").
+  An error that doesn't follow the format is treated as stopping the DME.
+  '''
+  m = ERROR_RE.search(msg)
+  if m is None:
+    return IppError(ERROR_SEVERITY_STOP, None, None, msg[8:].strip())
+  return IppError(int(m.group(1)), int(m.group(2)), m.group(3), m.group(4))
 
 
 class TransactionStatus(Enum):
@@ -322,138 +770,1050 @@ class Callbacks:
     self.transaction.complete = TransactionStatus.COMPLETE
 
 
+class TransactionStream:
+  """
+  Async iterator over the data lines of a transaction as they arrive, ending when
+  the transaction completes and raising CmmException if it errors.
+
+  With batchSize None every line is yielded as parser(line), otherwise lists of
+  up to batchSize lines are yielded as parser(lines), e.g. with
+  ScanResult.fromLines as the parser. Without a parser lines are yielded as is.
+
+  At most maxQueue lines are queued. Once the queue is full the client stops
+  reading from the socket until the consumer catches up, so the queue can only
+  grow past maxQueue by what was left of the chunk being dispatched. A full queue
+  is yielded as a short batch when batchSize is larger than maxQueue.
+
+  Reading stays paused for every transaction while a full stream isn't consumed,
+  so a consumer that may stop iterating early must call close(), or iterate inside
+  "async with stream:", which closes the stream on exit unless it finished:
+
+    async with client.ScanOnLine(...).stream(batchSize=500) as lines:
+      async for batch in lines:
+        ...
+  """
+  def __init__(self, transaction, batchSize=None, maxQueue=10000, parser=None):
+    self.transaction = transaction
+    self.batchSize = batchSize
+    self.maxQueue = maxQueue
+    self.parser = parser
+    self.queue = deque()
+    self.finished = False
+    self.closed = False
+    self.error = None
+    self.waiter = None
+    self.drainWaiter = None
+
+  def put(self, line):
+    if not self.closed:
+      self.queue.append(line)
+      self._wake()
+
+  def close(self):
+    '''
+    Stop consuming the stream early. Further lines are dropped so reading is
+    never held up waiting for this stream.
+    '''
+    self.closed = True
+    self.queue.clear()
+    self._wake_drain()
+
+  def full(self):
+    return len(self.queue) >= self.maxQueue
+
+  def finish(self, error=None):
+    self.finished = True
+    self.error = error
+    self._wake()
+    self._wake_drain()
+
+  def _wake(self):
+    if self.waiter is not None and not self.waiter.done():
+      self.waiter.set_result(None)
+
+  def _wake_drain(self):
+    if self.drainWaiter is not None and not self.drainWaiter.done():
+      self.drainWaiter.set_result(None)
+
+  async def drained(self):
+    '''
+    Wait until the consumer has taken the queue down to half of maxQueue
+    '''
+    while not self.finished and not self.closed and len(self.queue) > self.maxQueue // 2:
+      self.drainWaiter = asyncio.get_running_loop().create_future()
+      await self.drainWaiter
+
+  def __aiter__(self):
+    return self
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    if not self.finished:
+      self.close()
+    return False
+
+  async def __anext__(self):
+    while True:
+      queue = self.queue
+      if queue and (self.batchSize is None or len(queue) >= self.batchSize or self.finished or self.full()):
+        if self.batchSize is None:
+          item = queue.popleft()
+        else:
+          item = [ queue.popleft() for i in range(min(self.batchSize, len(queue))) ]
+        if len(queue) <= self.maxQueue // 2:
+          self._wake_drain()
+        return item if self.parser is None else self.parser(item)
+
+      if self.finished:
+        if self.error is not None:
+          raise CmmException(self.error)
+        raise StopAsyncIteration
+
+      self.waiter = asyncio.get_running_loop().create_future()
+      await self.waiter
+
+
 class Transaction:
-  def __init__(self, tag, cmd):
+  """
+  A command sent to the server and its responses. The command is sent the first
+  time one of send(), ack(), data(), complete() or stream() is called, or the
+  transaction itself is awaited, which waits for it to complete:
+
+    getPos = await client.Get("X(),Y(),Z()")
+
+  Each stage has a single future, created the first time it is asked for and
+  already resolved if the stage has been reached. Stage futures resolve to the
+  transaction and raise CmmException if the transaction errors.
+  """
+  __slots__ = (
+    "status", "tag", "command", "client",
+    "data_list", "error_list", "warning_list", "nbytes", "bytesReceived",
+    "createdAt", "sentAt", "ackAt", "firstDataAt", "lastDataAt", "completeAt", "errorAt",
+    "callbacks", "futures", "queued", "dataStream", "retainData", "__weakref__",
+  )
+
+  def __init__(self, tag, cmd, client=None):
     self.status = TransactionStatus.CREATED
     self.tag = tag
+    self.command = cmd
+    self.client = client
     self.data_list = []
     self.error_list = []
-    self.futures = {}
-    self.sendTask = None
-    self.command = cmd
-    self.fut = None
-    self.callbacks = TransactionCallbacks()
+    # Info and warning responses, they don't fail the transaction
+    self.warning_list = []
+    # Memory taken by the retained data lines, for the retention policy
+    self.nbytes = 0
+    # Length of every data line received, retained or not
+    self.bytesReceived = 0
+
+    # time.monotonic() timestamps of each lifecycle transition, None until it happens
+    self.createdAt = time.monotonic()
+    self.sentAt = None
+    self.ackAt = None
+    self.firstDataAt = None
+    self.lastDataAt = None
+    self.completeAt = None
+    self.errorAt = None
+
+    # Created when first needed, most transactions never register a callback
+    self.callbacks = None
+    # Stage name to its future
+    self.futures = None
+    self.queued = False
+
+    # Set by stream(), retainData False keeps data lines out of data_list
+    self.dataStream = None
+    self.retainData = True
 
   def register_callback(self, event, callback, once):
+    '''
+    Call callback(transaction, isError) on every send, ack, data, complete or error
+    event, or only on the next one if once is set
+    '''
+    if self.callbacks is None:
+      self.callbacks = TransactionCallbacks()
     try:
-      getattr(self.callbacks, event).append({'callback': callback, 'once': once})
+      getattr(self.callbacks, event).append((callback, once))
     except AttributeError as err:
       return err
 
   def clear_callbacks(self, event=None):
+    if self.callbacks is None:
+      return
     if event is not None:
       setattr(self.callbacks, event, [])
     else:
-      self.callbacks = TransactionCallbacks()
-
-  def _std_event_callback(self, key):
-    loop = asyncio.get_running_loop()
-    fut = loop.create_future()
-    def callback(transaction, isError=False):
-      self.fut = None
-      fut.set_result(transaction)
-    def error_callback(transaction, isError=False):
-      self.fut = None
-      fut.set_exception(CmmException("".join(transaction.error_list)))
-    self.register_callback(key, callback, True)
-    self.register_callback('error', error_callback, True)
-
-    self.fut = fut
-
-    if self.sendCoro:
-      sendCoro = self.sendCoro
-      async def mycoro():
-        await sendCoro
-        return await fut
-
-      self.sendCoro = None
-      return asyncio.create_task(mycoro())
-    else:
-      return fut
-
+      self.callbacks = None
 
   def _process_event_callbacks(self, event, isError=False):
     eventCallbacks = getattr(self.callbacks, event)
-    repeatCallbacks = []
-    for cb in eventCallbacks:
-      func = cb['callback']
-      func(self, isError)
-      if not cb['once']:
-        repeatCallbacks.append(cb)
-    setattr(self.callbacks, event, repeatCallbacks)
+    if not eventCallbacks:
+      return
+    setattr(self.callbacks, event, [ cb for cb in eventCallbacks if not cb[1] ])
+    for (callback, once) in eventCallbacks:
+      callback(self, isError)
+
+  def _reached(self, stage):
+    if stage == "data":
+      return self.firstDataAt is not None or self.status == TransactionStatus.COMPLETE
+    if stage == "error":
+      return False
+    return self.status.value >= STAGE_STATUS[stage].value
+
+  def _stage_future(self, stage):
+    futures = self.futures
+    if futures is None:
+      futures = self.futures = {}
+    fut = futures.get(stage)
+    if fut is None:
+      fut = futures[stage] = asyncio.get_running_loop().create_future()
+      if self.status == TransactionStatus.ERROR:
+        if stage == "error":
+          fut.set_result(self)
+        else:
+          fut.set_exception(CmmException("".join(self.error_list)))
+      elif self._reached(stage):
+        fut.set_result(self)
+    self._queue_send()
+    return fut
+
+  def _resolve(self, stage):
+    fut = self.futures.get(stage)
+    if fut is not None and not fut.done():
+      fut.set_result(self)
+
+  def _queue_send(self):
+    if not self.queued and self.client is not None:
+      self.queued = True
+      self.client._queue_write(self)
+
+  def waiting(self):
+    '''
+    True if anything is waiting on this transaction to finish
+    '''
+    if self.dataStream is not None and not self.dataStream.finished:
+      return True
+    return self.futures is not None and any(not f.done() for f in self.futures.values())
+
+  def __await__(self):
+    return self.complete().__await__()
 
   def send(self):
-    return self._std_event_callback("send")
+    return self._stage_future("send")
+
+  def stream(self, batchSize=None, maxQueue=10000, parser=None, retain=True):
+    '''
+    Send the command and return a TransactionStream over its data lines, for
+    processing results while the command is still running:
+
+      async for points in client.ScanOnLine(...).stream(batchSize=500, parser=ScanResult.fromLines, retain=False):
+        ...
+
+    With retain False data lines are not kept in data_list.
+    '''
+    self.dataStream = TransactionStream(self, batchSize=batchSize, maxQueue=maxQueue, parser=parser)
+    self.retainData = retain
+    self._queue_send()
+    return self.dataStream
 
   def ack(self):
-    logger.debug("creating ack future for message %s", self.tag)
-    return self._std_event_callback("ack")
+    return self._stage_future("ack")
 
   def complete(self):
-    logger.debug("creating complete future for message %s", self.tag)
-    return self._std_event_callback("complete")
+    return self._stage_future("complete")
 
   def data(self):
-    logger.debug("creating data future for message %s", self.tag)
-    return self._std_event_callback("data")
+    return self._stage_future("data")
 
   def error(self):
-    logger.debug("creating error future for message %s", self.tag)
-    return self._std_event_callback("error")
+    '''
+    Returns a future that resolves to the transaction if it errors
+    '''
+    return self._stage_future("error")
 
   def handle_send(self):
-    logger.debug("handling send for message %s", self.tag)
-    self.status = TransactionStatus.SENT
-    self._process_event_callbacks('send')
+    self.sentAt = time.monotonic()
+    # The ack can be read before the write completion is handled
+    if self.status == TransactionStatus.CREATED:
+      self.status = TransactionStatus.SENT
+    if self.futures is not None:
+      self._resolve("send")
+    if self.callbacks is not None:
+      self._process_event_callbacks('send')
 
   def handle_ack(self):
-    logger.debug("handling ack for message %s", self.tag)
+    self.ackAt = time.monotonic()
     self.status = TransactionStatus.ACK
-    self._process_event_callbacks('ack')
+    if self.futures is not None:
+      self._resolve("ack")
+    if self.callbacks is not None:
+      self._process_event_callbacks('ack')
 
   def handle_data(self, data_msg):
-    logger.debug("handling data for message %s", self.tag)
-    self.data_list.append(data_msg)
-    self._process_event_callbacks('data')
-
-  def handle_error(self, err_msg):
+    self.lastDataAt = time.monotonic()
+    self.bytesReceived += len(data_msg)
+    if self.firstDataAt is None:
+      self.firstDataAt = self.lastDataAt
+      if self.futures is not None:
+        self._resolve("data")
+    if self.retainData:
+      self.data_list.append(data_msg)
+      self.nbytes += sys.getsizeof(data_msg)
+    if self.dataStream is not None:
+      self.dataStream.put(data_msg)
+    if self.callbacks is not None:
+      self._process_event_callbacks('data')
+
+  def handle_error(self, err_msg, exception=None):
+    '''
+    Fail the transaction with an error response, or with the exception that
+    prevented the command from being sent
+    '''
     logger.debug("handling error for message %s", self.tag)
+    self.errorAt = time.monotonic()
     self.status = TransactionStatus.ERROR
     self.error_list.append(err_msg)
-    self._process_event_callbacks('error', True)
+    if self.futures is not None:
+      exception = exception or CmmException("".join(self.error_list))
+      for (stage, fut) in self.futures.items():
+        if not fut.done():
+          if stage == "error":
+            fut.set_result(self)
+          else:
+            fut.set_exception(exception)
+    if self.dataStream is not None:
+      self.dataStream.finish(err_msg)
+    if self.client is not None:
+      self.client._transaction_finished(self)
+    if self.callbacks is not None:
+      self._process_event_callbacks('error', True)
 
   def handle_complete(self):
-    logger.debug("handling complete for message %s", self.tag)
+    self.completeAt = time.monotonic()
     self.status = TransactionStatus.COMPLETE
-    self._process_event_callbacks('complete')
+    if self.futures is not None:
+      self._resolve("data")
+      self._resolve("complete")
+    if self.dataStream is not None:
+      self.dataStream.finish()
+    if self.client is not None:
+      self.client._transaction_finished(self)
+    if self.callbacks is not None:
+      self._process_event_callbacks('complete')
+
+STAGE_STATUS = {
+  "send": TransactionStatus.SENT,
+  "ack": TransactionStatus.ACK,
+  "complete": TransactionStatus.COMPLETE,
+}
+
+
+class Histogram:
+  """
+  Fixed-size histogram with logarithmically spaced buckets, bucketsPerDecade
+  buckets for every factor of 10 between minValue and maxValue. Recording a value
+  is a bisect and percentiles are accurate to one bucket width, which keeps it
+  cheap enough to leave on for every transaction.
+  """
+  def __init__(self, minValue=1e-6, maxValue=1e4, bucketsPerDecade=20):
+    numBuckets = int(math.ceil(math.log10(maxValue / minValue) * bucketsPerDecade))
+    self.edges = [ minValue * 10 ** (i / bucketsPerDecade) for i in range(numBuckets + 1) ]
+    # counts[0] holds values <= minValue, counts[-1] holds values > maxValue
+    self.counts = [0] * (numBuckets + 2)
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def record(self, value):
+    self.counts[bisect.bisect_left(self.edges, value)] += 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def percentile(self, p):
+    '''
+    Returns the upper edge of the bucket holding the p-th percentile, clamped to
+    the recorded min and max
+    '''
+    if self.count == 0:
+      return None
+    if p <= 0:
+      return self.min
+    target = p / 100 * self.count
+    cumulative = 0
+    for (i, c) in enumerate(self.counts):
+      cumulative += c
+      if c and cumulative >= target:
+        break
+    value = self.edges[min(i, len(self.edges) - 1)]
+    return min(max(value, self.min), self.max)
+
+  def summary(self):
+    if self.count == 0:
+      return { "count": 0 }
+    return {
+      "count": self.count,
+      "mean": self.total / self.count,
+      "min": self.min,
+      "p50": self.percentile(50),
+      "p90": self.percentile(90),
+      "p99": self.percentile(99),
+      "max": self.max,
+    }
+
+
+class CommandStats:
+  """
+  Latency and size histograms for every finished transaction of one command name.
+  ackLatency is send to ack, executionTime is ack to complete (or error) and
+  totalTime is send to complete (or error), all in seconds.
+  """
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self.ackLatency = Histogram()
+    self.executionTime = Histogram()
+    self.totalTime = Histogram()
+    self.bytesReceived = Histogram(minValue=1, maxValue=1e10, bucketsPerDecade=10)
+
+  def record(self, transaction):
+    self.count += 1
+    finishedAt = transaction.completeAt
+    if transaction.status == TransactionStatus.ERROR:
+      self.errors += 1
+      finishedAt = transaction.errorAt
+    if transaction.sentAt is not None:
+      if transaction.ackAt is not None:
+        self.ackLatency.record(transaction.ackAt - transaction.sentAt)
+      if finishedAt is not None:
+        self.totalTime.record(finishedAt - transaction.sentAt)
+    if transaction.ackAt is not None and finishedAt is not None:
+      self.executionTime.record(finishedAt - transaction.ackAt)
+    self.bytesReceived.record(transaction.bytesReceived)
+
+  def summary(self):
+    return {
+      "count": self.count,
+      "errors": self.errors,
+      "ackLatency": self.ackLatency.summary(),
+      "executionTime": self.executionTime.summary(),
+      "totalTime": self.totalTime.summary(),
+      "bytesReceived": dict(self.bytesReceived.summary(), total=self.bytesReceived.total),
+    }
+
+
+class LoopLagMonitor:
+  """
+  Measures event loop lag, how late a timer that fires every interval seconds
+  wakes up. Lag means something is blocking the loop and delaying reading
+  responses, so heavy processing should be offloaded (see ipp_offload).
+  """
+  def __init__(self, interval=0.01):
+    self.interval = interval
+    self.lag = Histogram()
+    self.task = None
+
+  def start(self):
+    if self.task is None:
+      self.task = asyncio.create_task(self._run())
+    return self
+
+  def stop(self):
+    if self.task is not None:
+      self.task.cancel()
+      self.task = None
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      expected = loop.time() + self.interval
+      await asyncio.sleep(self.interval)
+      self.lag.record(max(0.0, loop.time() - expected))
+
+  def summary(self):
+    return self.lag.summary()
+
+
+class PipelineResult(dict):
+  """
+  The transactions submitted through a Pipeline, keyed by tag in the order they were sent.
+  """
+  @property
+  def errors(self):
+    return PipelineResult((tag, t) for (tag, t) in self.items() if t.status == TransactionStatus.ERROR)
+
+  def data(self, tag):
+    return self[tag].data_list
+
+
+class Pipeline:
+  """
+  Queues transactions and writes them to the server back-to-back, so the server's
+  command queue stays full instead of idling for a round trip between commands.
+  Any Client command method can be called on the pipeline; the transaction is queued
+  and returned without being sent.
+
+    async with client.pipeline() as p:
+      p.GoTo("X(10),Y(10),Z(10)")
+      ptMeas = p.PtMeas("X(10),Y(10),Z(0),IJK(0,0,1)")
+    pt = float3.FromXYZString(p.result.data(ptMeas.tag)[0])
+
+  wait is the transaction stage that is awaited for every queued command ("ack",
+  "data" or "complete"). If raiseOnError is set, the first CmmException is raised
+  once every queued transaction has settled.
+  """
+  def __init__(self, client, wait="complete", raiseOnError=True):
+    self.client = client
+    self.wait = wait
+    self.raiseOnError = raiseOnError
+    self.transactions = []
+    self.result = None
+
+  def add(self, transaction):
+    self.transactions.append(transaction)
+    return transaction
+
+  def __getattr__(self, name):
+    attr = getattr(self.client, name)
+    if not callable(attr):
+      return attr
+
+    @functools.wraps(attr)
+    def queueCommand(*args, **kwargs):
+      r = attr(*args, **kwargs)
+      if isinstance(r, Transaction):
+        self.add(r)
+      return r
+    return queueCommand
+
+  def discard(self):
+    '''
+    Drop the queued transactions without sending them
+    '''
+    for t in self.transactions:
+      if self.client.unsentTransactions.get(t.tag) is t:
+        del self.client.unsentTransactions[t.tag]
+    self.transactions = []
+
+  async def gather(self):
+    '''
+    Send every queued transaction and wait for all of them to reach the wait stage
+    '''
+    transactions = self.transactions
+    self.transactions = []
+
+    # Starting every wait before awaiting any of them writes the commands in order
+    # without waiting for a response in between
+    waits = [ getattr(t, self.wait)() for t in transactions ]
+    results = await asyncio.gather(*waits, return_exceptions=True)
+
+    self.result = PipelineResult((t.tag, t) for t in transactions)
+    if self.raiseOnError:
+      for r in results:
+        if isinstance(r, BaseException):
+          raise r
+    return self.result
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    if exc_type is not None:
+      self.discard()
+      return False
+    await self.gather()
+    return False
+
+
+class LineFramer:
+  """
+  Splits a byte stream into complete I++ messages. Every complete line in a chunk
+  is decoded and split out in one pass; a trailing partial line is kept until the
+  rest of it arrives. Messages keep their CRLF terminator, the same as the ones
+  returned by Client.readMessage.
+  """
+  def __init__(self):
+    self.buffer = bytearray()
+
+  def feed(self, data):
+    buf = self.buffer
+    buf += data
+    end = buf.rfind(b"\r\n")
+    if end < 0:
+      return []
+    end += 2
+    text = buf[:end].decode("ascii")
+    del buf[:end]
+    return text.splitlines(True)
+
+
+class TornadoTransport:
+  """
+  Connects with tornado's TCPClient. The IOStream is read by Client.handleMessages.
+  """
+  def __init__(self):
+    self.tcpClient = TCPClient()
+    self.stream = None
+
+  async def connect(self, client, timeout):
+    '''
+    Connect to the client's host and port and start delivering messages to it.
+    Returns a task that finishes when the connection is closed.
+    '''
+    self.stream = await self.tcpClient.connect(client.host, client.port, timeout=timeout)
+    client.stream = self.stream
+    return asyncio.create_task(client.handleMessages())
+
+  def write(self, data):
+    return self.stream.write(data)
+
+  def is_connected(self):
+    return not self.stream.closed() if self.stream else False
+
+  def close(self):
+    if self.stream is not None:
+      self.stream.close()
+
+
+class IppProtocol(asyncio.Protocol):
+  """
+  asyncio Protocol that feeds received bytes straight into the client's LineFramer
+  and dispatches every complete message from data_received.
+  """
+  def __init__(self, client):
+    self.client = client
+    self.transport = None
+    loop = asyncio.get_running_loop()
+    self.closed = loop.create_future()
+    self.drained = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def data_received(self, data):
+    client = self.client
+    dispatch = client._dispatch_message
+    for msg in client.framer.feed(data):
+      dispatch(msg)
+    if client.fullStreams:
+      self.transport.pause_reading()
+      asyncio.create_task(self._resume_reading())
+
+  async def _resume_reading(self):
+    await self.client._drain_streams()
+    if not self.transport.is_closing():
+      self.transport.resume_reading()
+
+  def connection_lost(self, exc):
+    if self.drained is not None and not self.drained.done():
+      self.drained.set_exception(ConnectionResetError("Connection lost"))
+    if not self.closed.done():
+      self.closed.set_result(None)
+
+  def pause_writing(self):
+    if self.drained is None or self.drained.done():
+      self.drained = asyncio.get_running_loop().create_future()
+
+  def resume_writing(self):
+    if self.drained is not None and not self.drained.done():
+      self.drained.set_result(None)
+
+
+class AsyncioTransport:
+  """
+  Connects with a native asyncio Protocol, avoiding tornado's IOStream futures
+  and buffering on every read and write.
+  """
+  def __init__(self):
+    self.protocol = None
+
+  async def connect(self, client, timeout):
+    loop = asyncio.get_running_loop()
+    (transport, protocol) = await asyncio.wait_for(loop.create_connection(lambda: IppProtocol(client), client.host, client.port), timeout)
+    self.protocol = protocol
+    return protocol.closed
+
+  async def write(self, data):
+    if self.protocol.transport.is_closing():
+      raise StreamClosedError()
+    self.protocol.transport.write(data)
+    if self.protocol.drained is not None:
+      await self.protocol.drained
+
+  def is_connected(self):
+    return self.protocol is not None and not self.protocol.transport.is_closing()
+
+  def close(self):
+    if self.protocol is not None:
+      self.protocol.transport.close()
+
+
+class RetentionPolicy:
+  """
+  Limits how many finished (completed or errored) transactions a Client keeps in
+  its transactions dict. The oldest finished transactions are evicted once there
+  are more than maxCount of them, once their data lines take more than maxBytes,
+  or once they finished more than maxAge seconds ago. A limit of None is not
+  enforced. onEvict is called with every evicted transaction, e.g. for archiving.
+  Transactions that were never sent aren't in the dict, the client only holds
+  them weakly.
+  """
+  def __init__(self, maxCount=1000, maxBytes=None, maxAge=None, onEvict=None):
+    self.maxCount = maxCount
+    self.maxBytes = maxBytes
+    self.maxAge = maxAge
+    self.onEvict = onEvict
+
+
+# name(value) pairs of SetProp arguments and GetProp responses, values quoted or unnested
+PROPERTY_RE = re.compile(r'([A-Za-z_][\w.]*)\(\s*("[^"]*"|[^()]*?)\s*\)')
+
+class StateCache:
+  """
+  Client side shadow of server state: property values (including the active tool
+  as "Tool.Name") and the homed flag (as "IsHomed"), learned from the client's own SetProp,
+  GetProp, ChangeTool, SetTool, Home and IsHomed traffic.
+
+  A command that changes a value forgets it until it completes; the value is
+  only recorded if no later command changed it meanwhile. ChangeTool and SetTool
+  forget every Tool property, as they belong to the tool. Everything is forgotten
+  on reconnect and on errors that stop the DME. Values are kept as the text
+  the server sent or the client set, so local answers repeat it. hits counts
+  property, tool and homed queries answered and SetProps skipped locally, misses
+  those sent to the server.
+  """
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    # property name, or IsHomed, to its value's text
+    self.values = {}
+    # key to the latest command changing it, and a generation bumped when everything is forgotten
+    self.changing = {}
+    self.generation = 0
+    self.hits = 0
+    self.misses = 0
+    self.nextLocalTag = 1
+
+  def invalidate(self):
+    self.values.clear()
+    self.changing.clear()
+    self.generation += 1
+
+  def get(self, name):
+    '''
+    A value as a float or an unquoted string, None if it isn't known
+    '''
+    text = self.values.get(name)
+    return None if text is None else self.value(text)
+
+  @property
+  def homed(self):
+    homed = self.get("IsHomed")
+    return None if homed is None else bool(homed)
+
+  @staticmethod
+  def value(text):
+    if text.startswith('"'):
+      return text.strip('"')
+    try:
+      return float(text)
+    except ValueError:
+      return text
+
+  @staticmethod
+  def parse(text):
+    '''
+    Property name to value text for every name(value) in text
+    '''
+    return dict(PROPERTY_RE.findall(text))
+
+  def format(self, name):
+    return "%s(%s)" % (name, self.values[name])
+
+  def known(self, keys):
+    return all(key in self.values and key not in self.changing for key in keys)
+
+  def changes(self, transaction, keys, values=None, forgetTool=False):
+    '''
+    Track a command that changes keys, recording values (key to value) when it completes
+    '''
+    if forgetTool:
+      for key in [ k for k in self.values if k.startswith("Tool.") ]:
+        del self.values[key]
+      self.generation += 1
+    for key in keys:
+      self.values.pop(key, None)
+      self.changing[key] = transaction
+    generation = self.generation
+
+    def changed(transaction, isError=False):
+      for key in keys:
+        if self.changing.get(key) is transaction:
+          del self.changing[key]
+          if generation == self.generation and values is not None:
+            self.values[key] = values[key]
+    def failed(transaction, isError=False):
+      for key in keys:
+        if self.changing.get(key) is transaction:
+          del self.changing[key]
+    transaction.register_callback('complete', changed, True)
+    transaction.register_callback('error', failed, True)
+
+  def learn(self, transaction):
+    '''
+    Record the values in a query's response when it completes, unless changed meanwhile
+    '''
+    generation = self.generation
+    def learned(transaction, isError=False):
+      if generation != self.generation or not transaction.data_list:
+        return
+      for (key, value) in self.parse(transaction.data_list[0]).items():
+        if key not in self.changing:
+          self.values[key] = value
+    transaction.register_callback('complete', learned, True)
+
+  def local(self, command, dataLines=(), hit=True):
+    '''
+    An already completed transaction for a command answered without the server,
+    counted in hits if hit is set
+    '''
+    if hit:
+      self.hits += 1
+    tag = "L%04d" % self.nextLocalTag
+    self.nextLocalTag = self.nextLocalTag % 9999 + 1
+    transaction = Transaction(tag, command)
+    transaction.status = TransactionStatus.COMPLETE
+    transaction.completeAt = transaction.sentAt = transaction.createdAt
+    transaction.data_list = [ "%s # %s\r\n" % (tag, line) for line in dataLines ]
+    return transaction
+
+
+def split_arguments(text):
+  '''
+  Split an argument list like X(1), IJK(0,0,1), Tool.Name("A,B") on the commas
+  outside parentheses and quotes
+  '''
+  parts = []
+  depth = 0
+  quoted = False
+  start = 0
+  for (i, c) in enumerate(text):
+    if c == '"':
+      quoted = not quoted
+    elif quoted:
+      continue
+    elif c == "(":
+      depth += 1
+    elif c == ")":
+      depth -= 1
+    elif c == "," and depth == 0:
+      parts.append(text[start:i].strip())
+      start = i + 1
+  parts.append(text[start:].strip())
+  return [ p for p in parts if p ]
+
+class QueryBatcher:
+  """
+  Merges the fields queried with one command (GetProp or Get) during an event loop
+  iteration into a single command, and gives each caller the name(value) parts of
+  the response for its fields:
+
+    (x, speed) = await asyncio.gather(client.queryPosition([ "X()" ]), client.queryProps([ "Tool.PtMeasPar.Speed()" ]))
+
+  A field that is already queued or in flight isn't asked for again, its callers
+  share one result. Any other command sent to the server first sends the queued
+  fields, so queries keep their order relative to commands that may change the
+  answers, and later queries don't share results from before that command. If the
+  merged command fails every caller waiting on it gets the error.
+  """
+  def __init__(self, command):
+    # sends the command for a list of fields, returning its transaction
+    self.command = command
+    # field to the future of its part of the response
+    self.queued = {}
+    self.inFlight = {}
+    self.handle = None
+    self.sending = None
+    self.batches = 0
+    self.requests = 0
+    self.shared = 0
+
+  def load(self, fields):
+    '''
+    Queue fields like "X()" and return a coroutine for their response parts, in order
+    '''
+    loop = asyncio.get_running_loop()
+    futures = []
+    for field in fields:
+      field = field.strip()
+      self.requests += 1
+      fut = self.queued.get(field) or self.inFlight.get(field)
+      if fut is None:
+        fut = self.queued[field] = loop.create_future()
+        if self.handle is None:
+          self.handle = loop.call_soon(self.flush)
+      else:
+        self.shared += 1
+      futures.append(fut)
+    return self._results(futures)
+
+  async def _results(self, futures):
+    # the futures are shared, cancelling one caller mustn't cancel them
+    return [ await asyncio.shield(fut) for fut in futures ]
+
+  def flush(self):
+    '''
+    Send the queued fields as one command
+    '''
+    if self.handle is not None:
+      self.handle.cancel()
+      self.handle = None
+    if not self.queued:
+      return
+    queued = self.queued
+    self.queued = {}
+    self.inFlight.update(queued)
+    self.batches += 1
+    self.sending = transaction = self.command(list(queued))
+    try:
+      complete = transaction.complete()
+    finally:
+      self.sending = None
+    complete.add_done_callback(lambda fut: self._resolve(fut, transaction, queued))
+
+  @property
+  def open(self):
+    '''
+    True while fields are queued or in flight
+    '''
+    return bool(self.queued or self.inFlight)
+
+  def barrier(self):
+    '''
+    Send the queued fields and stop sharing the results of those in flight
+    '''
+    self.flush()
+    self.inFlight.clear()
+
+  def _resolve(self, fut, transaction, queued):
+    for (field, f) in queued.items():
+      if self.inFlight.get(field) is f:
+        del self.inFlight[field]
+    waiting = [ (i, field, f) for (i, (field, f)) in enumerate(queued.items()) if not f.done() ]
+    if fut.cancelled():
+      for (i, field, f) in waiting:
+        f.cancel()
+      return
+    exception = fut.exception()
+    if exception is not None:
+      for (i, field, f) in waiting:
+        f.set_exception(exception)
+      return
+
+    line = transaction.data_list[0] if transaction.data_list else ""
+    parts = split_arguments(line.split("#", 1)[-1].strip())
+    byName = { p[:p.find("(")].strip(): p for p in parts }
+    for (i, field, f) in waiting:
+      # by field name, falling back to the field's position in the response
+      part = byName.get(field[:field.find("(")].strip())
+      if part is None and i < len(parts):
+        part = parts[i]
+      if part is None:
+        f.set_exception(CmmException("No %s in response to %s: %s" % (field, transaction.command, line.strip())))
+      else:
+        f.set_result(part)
+
+
+TRANSPORTS = {
+  "tornado": TornadoTransport,
+  "asyncio": AsyncioTransport,
+}
 
 
 class Client:
-  def __init__(self, host=HOST, port=PORT):
+  def __init__(self, host=HOST, port=PORT, transport="tornado", retention=None, recorder=None):
+    '''
+    transport selects how the client talks to the server, either a name in
+    TRANSPORTS or a callable returning a transport object
+    retention is the RetentionPolicy for finished transactions
+    recorder, e.g. an ipp_capture.CaptureWriter, is given every line sent and received
+    '''
     self.host = host
     self.port = port
-    self.tcpClient = TCPClient()
+    self.transport = TRANSPORTS[transport]() if isinstance(transport, str) else transport()
     self.stream = None
     self.nextTagNum = 1
     self.nextEventTagNum = 1
     self.transactions = {}
+    # Transactions not queued to be sent yet, held weakly so one that is never sent
+    # is dropped with its last reference; they move to transactions when queued
+    self.unsentTransactions = weakref.WeakValueDictionary()
     self.events = {}
     self.buffer = ""
     self.points = []
     self.eventCallbacks = []
     self.eventFutures = []
 
+    # Commands queued in the same event loop iteration are written with a single
+    # stream write. writesIssued vs commandsSent shows how well writes coalesce.
+    self.writeQueue = []
+    self.writeTask = None
+    self.writesIssued = 0
+    self.commandsSent = 0
+
+    self.framer = LineFramer()
+    # TransactionStreams whose queue is full, reading pauses until they drain
+    self.fullStreams = set()
+
+    # Sent transactions that haven't completed or errored, in the order they were sent
+    self.pendingTransactions = OrderedDict()
+
+    # Finished transactions in the order they finished, with the time they finished
+    self.retention = retention or RetentionPolicy()
+    self.finishedTransactions = OrderedDict()
+    self.finishedBytes = 0
+
+    # CommandStats for each command name, e.g. "PtMeas"
+    self.commandStats = {}
+
+    # Report formats set with OnPtMeasReport and OnScanReport, defaults per the I++ spec
+    self.ptMeasReportFormat = "X(),Y(),Z()"
+    self.scanReportFormat = "X(),Y(),Z()"
+
+    self.recorder = recorder
+    self.loopLag = None
+
+    # The server's active coordinate system and PartCsy transformation, mirrored from
+    # the Set/Get commands sent through this client, None until known
+    self.coordSystem = None
+    self.partCsy = None
+
+    # Tool, property and homed state learned from this client's commands
+    self.state = StateCache()
+
+    # Coalesce GetProp and Get queries made in the same event loop iteration
+    self.propQueries = QueryBatcher(self.GetProp)
+    self.positionQueries = QueryBatcher(lambda fields: self.Get(", ".join(fields)))
+    self.queryBatchers = (self.propQueries, self.positionQueries)
+
   def is_connected(self):
-    return not self.stream.closed() if self.stream else False
+    return self.transport.is_connected()
 
   async def connect(self):
     logger.debug(tornado.version)
     try:
       logger.debug('connecting')
-      self.stream = await self.tcpClient.connect(self.host, self.port, timeout=3.0)
-      logger.debug('connected %s' % (self.stream,))
-      
-      self.listenerTask = asyncio.create_task(self.handleMessages())
+      self.framer = LineFramer()
+      self.coordSystem = None
+      self.partCsy = None
+      self.state.invalidate()
+      self.listenerTask = await self.transport.connect(self, timeout=3.0)
+      logger.debug('connected %s' % (self.transport,))
       return True
     except Exception as e:
       logger.error("connect error %s", traceback.format_exc())
@@ -461,8 +1821,11 @@ class Client:
 
   async def disconnect(self):
     try:
-      if self.stream is not None:
-        self.stream.close()
+      self.transport.close()
+      if self.recorder is not None:
+        self.recorder.flush()
+      if self.loopLag is not None:
+        self.loopLag.stop()
     except Exception as e:
       logger.error("disconnect error %s", traceback.format_exc())
       raise e
@@ -471,7 +1834,7 @@ class Client:
     try:
       if isEvent:
         tagNum = self.nextEventTagNum
-        tag = "E%04d" % eventTagNum 
+        tag = "E%04d" % tagNum
         self.nextEventTagNum = self.nextEventTagNum%9999+1 # Get the next event tag between 1 - 9999
       else:
         tagNum = self.nextTagNum
@@ -480,31 +1843,160 @@ class Client:
 
       logger.debug("sendCommand %s, tag %s " % (command, tag))
         
-      transaction = Transaction(tag, command)
-      self.transactions[tag] = transaction
-      
-      transaction.sendCoro = self._coro_send_command(transaction)
+      previous = self.transactions.get(tag)
+      if previous is not None:
+        if previous.tag in self.finishedTransactions:
+          self._evict(previous)
+        else:
+          logger.warning("tag %s reused while transaction %s is still pending", tag, previous.command)
+      elif tag in self.unsentTransactions:
+        logger.warning("tag %s reused while transaction %s is still unsent", tag, self.unsentTransactions[tag].command)
+
+      transaction = Transaction(tag, command, self)
+      self.unsentTransactions[tag] = transaction
       return transaction
     except Exception as e:
       logger.error(e)
       raise e
 
-  async def _coro_send_command(self, transaction):
-    message = "%s %s\r\n" % (transaction.tag, transaction.command)
+  def _transaction_finished(self, transaction):
+    if self.pendingTransactions.get(transaction.tag) is transaction:
+      del self.pendingTransactions[transaction.tag]
+    if transaction.tag in self.finishedTransactions or self.transactions.get(transaction.tag) is not transaction:
+      return
+
+    name = transaction.command[:transaction.command.find("(")]
+    commandStats = self.commandStats.get(name)
+    if commandStats is None:
+      commandStats = self.commandStats[name] = CommandStats()
+    commandStats.record(transaction)
+
+    self.finishedTransactions[transaction.tag] = (transaction, time.monotonic())
+    self.finishedBytes += transaction.nbytes
+    self._evict_finished()
+
+  def _evict_finished(self):
+    policy = self.retention
+    finished = self.finishedTransactions
+    now = time.monotonic()
+    while finished:
+      (transaction, finishedAt) = next(iter(finished.values()))
+      if (policy.maxCount is not None and len(finished) > policy.maxCount) or \
+         (policy.maxBytes is not None and self.finishedBytes > policy.maxBytes) or \
+         (policy.maxAge is not None and now - finishedAt > policy.maxAge):
+        self._evict(transaction)
+      else:
+        break
+
+  def _evict(self, transaction):
+    self.finishedTransactions.pop(transaction.tag)
+    self.finishedBytes -= transaction.nbytes
+    if self.transactions.get(transaction.tag) is transaction:
+      del self.transactions[transaction.tag]
+    if self.retention.onEvict is not None:
+      try:
+        self.retention.onEvict(transaction)
+      except Exception:
+        logger.error("onEvict error %s", traceback.format_exc())
+
+  def memoryUsage(self):
+    '''
+    Returns the number of transactions held by the client and the bytes taken by
+    their data lines
+    '''
+    self._evict_finished()
+    pendingBytes = sum(t.nbytes for t in self.transactions.values() if t.tag not in self.finishedTransactions)
+    return {
+      "transactions": len(self.transactions),
+      "unsentTransactions": len(self.unsentTransactions),
+      "finishedTransactions": len(self.finishedTransactions),
+      "pendingBytes": pendingBytes,
+      "finishedBytes": self.finishedBytes,
+      "totalBytes": pendingBytes + self.finishedBytes,
+    }
+
+  def stats(self):
+    '''
+    Returns counts and latency percentiles of finished transactions by command name
+    '''
+    return { name: commandStats.summary() for (name, commandStats) in self.commandStats.items() }
+
+  def monitorLoopLag(self, interval=0.01):
+    '''
+    Start measuring event loop lag, returns the LoopLagMonitor, stopped on disconnect
+    '''
+    if self.loopLag is None:
+      self.loopLag = LoopLagMonitor(interval)
+    return self.loopLag.start()
+
+  def pipeline(self, wait="complete", raiseOnError=True):
+    '''
+    Returns a Pipeline that queues commands and sends them back-to-back
+    '''
+    return Pipeline(self, wait=wait, raiseOnError=raiseOnError)
+
+  def _queue_write(self, transaction):
+    '''
+    Queue a command line to be written together with every other command queued
+    during the same event loop iteration. Queries batched by queryProps and
+    queryPosition are sent first, see QueryBatcher.
+    '''
+    if not any(transaction is b.sending for b in self.queryBatchers):
+      for batcher in self.queryBatchers:
+        if batcher.open:
+          batcher.barrier()
+    if self.unsentTransactions.get(transaction.tag) is transaction:
+      del self.unsentTransactions[transaction.tag]
+    self.transactions[transaction.tag] = transaction
+    self.writeQueue.append(transaction)
+    if self.writeTask is None:
+      self.writeTask = asyncio.create_task(self._flush_writes())
+
+  async def _flush_writes(self):
+    queue = self.writeQueue
+    self.writeQueue = []
+    self.writeTask = None
+
+    # Index the batch as pending before awaiting the write, since responses to
+    # it can be read before the write completes
+    pending = self.pendingTransactions
+    for transaction in queue:
+      pending[transaction.tag] = transaction
+
+    data = "".join([ "%s %s\r\n" % (t.tag, t.command) for t in queue ]).encode('ascii')
+    if self.recorder is not None:
+      self.recorder.sent(data)
     try:
-      await asyncio.wait_for(self.stream.write(message.encode('ascii')), 3.0)
-    except asyncio.TimeoutError as e:
-      logger.debug("Timeout!")
-      loop = asyncio.get_running_loop()
-      loop.stop()
-      raise e
-    transaction.handle_send()
+      await asyncio.wait_for(self.transport.write(data), 3.0)
+    except Exception as e:
+      if isinstance(e, asyncio.TimeoutError):
+        logger.debug("Timeout!")
+        asyncio.get_running_loop().stop()
+      for transaction in queue:
+        transaction.handle_error("Failed to send command: %r" % (e,), exception=e)
+      return
+
+    self.writesIssued += 1
+    self.commandsSent += len(queue)
+    for transaction in queue:
+      transaction.handle_send()
 
   async def readMessage(self):
     msg = await self.stream.read_until(b"\r\n")
     msg = msg.decode("ascii")
     return msg
 
+  async def readMessages(self):
+    '''
+    Read whatever is available on the stream, up to RECEIVE_SIZE bytes, and
+    return every complete message in it
+    '''
+    while True:
+      chunk = await self.stream.read_bytes(RECEIVE_SIZE, partial=True)
+      msgs = self.framer.feed(chunk)
+      if msgs:
+        return msgs
+
   def addEventCallback(self, callback):
     self.eventCallbacks.append(callback)
 
@@ -536,37 +2028,98 @@ class Client:
     logger.debug("started handling messages")
     try:
       while True:
-        msg = await self.readMessage()
-        logger.debug("handleMessage: %s" % msg)
-        msgTag = msg[0:5]
-        responseKey = msg[6]
-        if msgTag == "E0000":
-          logger.debug("Received E0000 event, calling all registered callbacks")
-          for callback in self.eventCallbacks:
-            logger.debug("Calling callback %s" % (callback,))
-            callback(msg[8:])
-
-        if msgTag in self.transactions:
-          transaction = self.transactions[msgTag]
-          if transaction.status != TransactionStatus.ERROR:
-            if responseKey == IPP_ACK_CHAR:
-              transaction.handle_ack()
-            elif responseKey == IPP_COMPLETE_CHAR:
-              transaction.handle_complete()
-            elif responseKey == IPP_DATA_CHAR:
-              transaction.handle_data(msg)
-            elif responseKey == IPP_ERROR_CHAR:
-              for t in self.transactions.values():
-                if t.fut:
-                  t.handle_error(msg)
-              for f in self.eventFutures:
-                f.set_exception(CmmException(msg))
-              self.eventFutures.clear()
-        else:
-          logger.debug("%s NOT in transactions dict" % msgTag)
+        msgs = await self.readMessages()
+        dispatch = self._dispatch_message
+        for msg in msgs:
+          dispatch(msg)
+        if self.fullStreams:
+          await self._drain_streams()
     except StreamClosedError:
       pass
 
+  async def _drain_streams(self):
+    '''
+    Wait for consumers of full TransactionStreams before reading more
+    '''
+    while self.fullStreams:
+      await self.fullStreams.pop().drained()
+
+  def _dispatch_message(self, msg):
+    logger.debug("handleMessage: %s", msg)
+    if self.recorder is not None:
+      self.recorder.received(msg)
+    if len(msg) < 7:
+      logger.debug("Ignoring malformed message %r", msg)
+      return
+    msgTag = msg[0:5]
+    responseKey = msg[6]
+    if msgTag == "E0000":
+      logger.debug("Received E0000 event, calling all registered callbacks")
+      for callback in self.eventCallbacks:
+        logger.debug("Calling callback %s", callback)
+        callback(msg[8:])
+
+    transaction = self.transactions.get(msgTag)
+    if transaction is not None:
+      if transaction.status != TransactionStatus.ERROR:
+        if responseKey == IPP_DATA_CHAR:
+          transaction.handle_data(msg)
+          dataStream = transaction.dataStream
+          if dataStream is not None and dataStream.full():
+            self.fullStreams.add(dataStream)
+        elif responseKey == IPP_ACK_CHAR:
+          transaction.handle_ack()
+        elif responseKey == IPP_COMPLETE_CHAR:
+          transaction.handle_complete()
+        elif responseKey == IPP_ERROR_CHAR:
+          self._handle_error_message(msgTag, transaction, msg)
+    elif responseKey == IPP_ERROR_CHAR:
+      self._handle_error_message(msgTag, None, msg)
+    else:
+      logger.debug("%s NOT in transactions dict", msgTag)
+
+  def _handle_error_message(self, tag, transaction, msg):
+    '''
+    Route an error to the transaction with its tag. Info and warnings don't fail
+    it. An error that stops the DME also fails the pending main queue commands sent
+    after its command, as the server discards them, or every pending main queue
+    command for an unsolicited E0000 error. Nothing is flushed for a command that
+    isn't pending any more, since what followed it isn't known. Manual probes
+    waiting on an event fail too. Fast queue (E tag) commands are not affected.
+    '''
+    error = parseError(msg)
+    if error.severity < ERROR_SEVERITY_ERROR:
+      logger.warning("%s %s", tag, msg)
+      if transaction is not None:
+        transaction.warning_list.append(msg)
+      return
+
+    stopsDme = error.severity >= ERROR_SEVERITY_STOP or tag == "E0000"
+    if stopsDme:
+      pending = list(self.pendingTransactions.values())
+      if tag == "E0000":
+        flushed = pending
+      elif transaction is not None and self.pendingTransactions.get(transaction.tag) is transaction:
+        flushed = pending[pending.index(transaction) + 1:]
+      else:
+        flushed = []
+      flushed = [ t for t in flushed if not t.tag.startswith("E") ]
+
+    if transaction is not None:
+      transaction.handle_error(msg)
+
+    if stopsDme:
+      # the DME's state is uncertain after it stops
+      self.state.invalidate()
+      self._forgetCoordSystem()
+      for t in flushed:
+        if t.status not in (TransactionStatus.ERROR, TransactionStatus.COMPLETE):
+          t.handle_error("Discarded after %s" % msg, exception=CmmExceptionFlushed("Discarded after %s" % msg))
+      for f in self.eventFutures:
+        if not f.done():
+          f.set_exception(CmmException(msg))
+      self.eventFutures.clear()
+
 
 
   '''
@@ -600,18 +2153,47 @@ class Client:
     return self.sendCommand("ClearAllErrors()")
 
   def GetProp(self, propArr):
+    '''
+    Answered locally when every property's value is known, see StateCache
+    '''
     propsString = ", ".join(propArr)
-    return self.sendCommand("GetProp(%s)" % propsString)
+    state = self.state
+    names = FORMAT_FIELD_RE.findall(propsString)
+    if state.enabled and names and len(names) == len(propArr):
+      if state.known(names):
+        return state.local("GetProp(%s)" % propsString, [ ", ".join(state.format(name) for name in names) ])
+      state.misses += 1
+    transaction = self.sendCommand("GetProp(%s)" % propsString)
+    state.learn(transaction)
+    return transaction
+
+  def queryProps(self, propArr):
+    '''
+    Coroutine for the name(value) response parts of properties, merged with the other
+    property queries made in the same event loop iteration into one GetProp, see QueryBatcher
+    '''
+    return self.propQueries.load(propArr)
 
   def GetPropE(self, propArr):
     '''
     Fast Queue command
     '''
     propsString = ", ".join(propArr)
-    return self.sendCommand("GetPropE(%s)" % propsString, isEvent=true)
+    return self.sendCommand("GetPropE(%s)" % propsString, isEvent=True)
 
   def SetProp(self, setPropString):
-    return self.sendCommand("SetProp(%s)" % setPropString)
+    '''
+    Skipped, returning a completed transaction, when every property already has its value
+    '''
+    state = self.state
+    values = state.parse(setPropString)
+    if state.enabled and values:
+      if state.known(values) and all(state.get(k) == state.value(v) for (k, v) in values.items()):
+        return state.local("SetProp(%s)" % setPropString)
+      state.misses += 1
+    transaction = self.sendCommand("SetProp(%s)" % setPropString)
+    state.changes(transaction, list(values), values)
+    return transaction
   
   def EnumProp(self, pointerString):
     '''
@@ -636,10 +2218,19 @@ class Client:
   I++ DME Methods
   '''
   def Home(self):
-    return self.sendCommand("Home()")
+    transaction = self.sendCommand("Home()")
+    self.state.changes(transaction, [ "IsHomed" ], { "IsHomed": "1" })
+    return transaction
 
   def IsHomed(self):
-    return self.sendCommand("IsHomed()")
+    state = self.state
+    if state.enabled:
+      if state.known([ "IsHomed" ]):
+        return state.local("IsHomed()", [ state.format("IsHomed") ])
+      state.misses += 1
+    transaction = self.sendCommand("IsHomed()")
+    state.learn(transaction)
+    return transaction
 
   def EnableUser(self):
     return self.sendCommand("EnableUser()")
@@ -654,7 +2245,17 @@ class Client:
     '''
     Define the information reported in the result of a PtMeas command
     '''
-    return self.sendCommand("OnPtMeasReport(%s)" % ptMeasFormatString)
+    transaction = self.sendCommand("OnPtMeasReport(%s)" % ptMeasFormatString)
+    def reportFormatSet(transaction, isError=False):
+      self.ptMeasReportFormat = ptMeasFormatString
+    transaction.register_callback('complete', reportFormatSet, True)
+    return transaction
+
+  def ptMeasParser(self):
+    '''
+    Returns the ResponseParser for PtMeas results in the current OnPtMeasReport format
+    '''
+    return compileResponseFormat(self.ptMeasReportFormat)
 
   def OnMoveReportE(self, onMoveReportFormatString):
     '''
@@ -673,7 +2274,7 @@ class Client:
     Response is "ErrStatus(1)" if in error
     Response is "ErrStatus(0)" if ok
     '''
-    return self.sendCommand("GetErrStatusE()", isEvent=true)
+    return self.sendCommand("GetErrStatusE()", isEvent=True)
 
   def GetXtdErrStatus(self):
     '''
@@ -695,6 +2296,14 @@ class Client:
     '''
     return self.sendCommand("Get(%s)" % queryString)
 
+  def queryPosition(self, fields):
+    '''
+    Coroutine for the name(value) response parts of fields like "X()" or "Tool.A()",
+    merged with the other position queries made in the same event loop iteration
+    into one Get, see QueryBatcher
+    '''
+    return self.positionQueries.load(fields)
+
   def GoTo(self, positionString):
     '''
     Move to a target position, including tool rotation
@@ -740,13 +2349,17 @@ class Client:
     '''
     Perform a tool change
     '''
-    return self.sendCommand('ChangeTool("%s")' % toolName)
+    transaction = self.sendCommand('ChangeTool("%s")' % toolName)
+    self.state.changes(transaction, [ "Tool.Name" ], { "Tool.Name": '"%s"' % toolName }, forgetTool=True)
+    return transaction
 
   def SetTool(self, toolName):
     '''
     Force the server to assume a given tool is the active tool
     '''
-    return self.sendCommand("SetTool(\"%s\")" % toolName)
+    transaction = self.sendCommand("SetTool(\"%s\")" % toolName)
+    self.state.changes(transaction, [ "Tool.Name" ], { "Tool.Name": '"%s"' % toolName }, forgetTool=True)
+    return transaction
 
   def AlignTool(self, alignToolString):
     '''
@@ -830,19 +2443,100 @@ class Client:
     '''
     Arg is one of: MachineCsy, MoveableMachineCsy, MultipleArmCsy, RotaryTableVarCsy, PartCsy
     '''
-    return self.sendCommand("SetCoordSystem(%s)" % coodSystemString)
+    transaction = self.sendCommand("SetCoordSystem(%s)" % coodSystemString)
+    # unknown until it completes
+    self.coordSystem = None
+    def coordSystemSet(transaction, isError=False):
+      self.coordSystem = coodSystemString.strip()
+    transaction.register_callback('complete', coordSystemSet, True)
+    transaction.register_callback('error', self._forgetCoordSystem, True)
+    return transaction
 
   def GetCoordSystem(self):
     '''
-    Query which coord sys is selected
-    '''
-    return self.sendCommand("GetCoordSystem()")
+    Query which coord sys is selected, answered locally when it's mirrored
+    '''
+    if self.state.enabled and self.coordSystem is not None:
+      return self.state.local("GetCoordSystem()", [ "CoordSystem(%s)" % self.coordSystem ], hit=False)
+    transaction = self.sendCommand("GetCoordSystem()")
+    def coordSystemRead(transaction, isError=False):
+      if not transaction.data_list:
+        return
+      data = transaction.data_list[0]
+      (start, end) = (data.find("("), data.rfind(")"))
+      coordSystem = data[start + 1:end].strip() if 0 <= start < end else ""
+      if coordSystem:
+        self.coordSystem = coordSystem
+      else:
+        self._forgetCoordSystem()
+    transaction.register_callback('complete', coordSystemRead, True)
+    return transaction
 
   def GetCsyTransformation(self, getCsyTransformationString):
-    return self.sendCommand("GetCsyTransformation(%s)" % getCsyTransformationString)
+    transaction = self.sendCommand("GetCsyTransformation(%s)" % getCsyTransformationString)
+    if getCsyTransformationString.strip() == "PartCsy":
+      def transformationRead(transaction, isError=False):
+        if not transaction.data_list:
+          return
+        data = transaction.data_list[0]
+        values = NUMBER_RE.findall(data[data.find("(") + 1:data.rfind(")")])
+        if len(values) == 6:
+          self.partCsy = Csy(*[ float(v) for v in values ])
+        else:
+          self._forgetCoordSystem()
+      transaction.register_callback('complete', transformationRead, True)
+    return transaction
 
   def SetCsyTransformation(self, setCsyTransformationString):
-    return self.sendCommand("SetCsyTransformation(%s)" % setCsyTransformationString)
+    transaction = self.sendCommand("SetCsyTransformation(%s)" % setCsyTransformationString)
+    values = [ v.strip() for v in setCsyTransformationString.split(",") ]
+    if values[0] == "PartCsy" and len(values) == 7:
+      def transformationSet(transaction, isError=False):
+        self.partCsy = Csy(*[ float(v) for v in values[1:] ])
+      transaction.register_callback('complete', transformationSet, True)
+      transaction.register_callback('error', self._forgetCoordSystem, True)
+    return transaction
+
+  def _forgetCoordSystem(self, transaction=None, isError=False):
+    # the server's state is uncertain after a failed change
+    self.coordSystem = None
+    self.partCsy = None
+
+  async def syncCoordSystem(self):
+    '''
+    Query whichever of the active coordinate system and PartCsy transformation
+    isn't mirrored yet, in one round trip
+    '''
+    queries = []
+    if self.coordSystem is None:
+      queries.append(self.GetCoordSystem())
+    if self.partCsy is None:
+      queries.append(self.GetCsyTransformation("PartCsy"))
+    for transaction in [ t.complete() for t in queries ]:
+      await transaction
+    return (self.coordSystem, self.partCsy)
+
+  def _activeCsy(self):
+    if self.coordSystem == "MachineCsy":
+      return None
+    if self.coordSystem == "PartCsy" and self.partCsy is not None:
+      return self.partCsy
+    raise CmmException("Can't convert coordinates in coordinate system %s, call syncCoordSystem first" % self.coordSystem)
+
+  def toMachine(self, points, directions=False):
+    '''
+    Points or, with directions=True, vectors in the server's active coordinate system
+    to machine coordinates, converted locally with the mirrored PartCsy
+    '''
+    csy = self._activeCsy()
+    return points if csy is None else csy.toMachine(points, directions)
+
+  def fromMachine(self, points, directions=False):
+    '''
+    Points or vectors in machine coordinates to the server's active coordinate system
+    '''
+    csy = self._activeCsy()
+    return points if csy is None else csy.fromMachine(points, directions)
 
   def SaveActiveCoordSystem(self, csyName):
     return self.sendCommand("SaveActiveCoordSystem(%s)" % csyName)
@@ -922,11 +2616,21 @@ class Client:
   '''
   I++ Scanning Methods
   '''
+  def scanResult(self, transaction):
+    '''
+    Parse the data of a finished scan transaction in the current OnScanReport format
+    '''
+    return ScanResult.fromTransaction(transaction, self.scanReportFormat)
+
   def OnScanReport(self, onScanReportString):
     '''
     Define the format of scan reports
     '''
-    return self.sendCommand("OnScanReport(%s)" % onScanReportString)
+    transaction = self.sendCommand("OnScanReport(%s)" % onScanReportString)
+    def reportFormatSet(transaction, isError=False):
+      self.scanReportFormat = onScanReportString
+    transaction.register_callback('complete', reportFormatSet, True)
+    return transaction
 
   def ScanOnCircleHint(self, displacement, form):
     '''
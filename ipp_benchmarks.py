@@ -0,0 +1,491 @@
+'''
+Benchmarks for the I++ client. Run a benchmark by name:
+  python ipp_benchmarks.py reader
+  python ipp_benchmarks.py transports
+  python ipp_benchmarks.py parser
+  python ipp_benchmarks.py scan
+  python ipp_benchmarks.py transactions
+  python ipp_benchmarks.py suite [output.json]
+'''
+import sys
+import socket
+import threading
+import multiprocessing
+import time
+import asyncio
+import json
+import platform
+import tracemalloc
+from abc import ABC, abstractmethod
+import numpy as np
+from tornado.iostream import IOStream, StreamClosedError
+from ipp import Client, Transaction, TRANSPORTS, float3, compileResponseFormat, ScanResult, LoopLagMonitor
+from ipp_offload import Offloader
+from ipp_server import SimulatedServer, SimulatedDme
+import ipp_routines as routines
+
+SCAN_TAG = "00012"
+
+
+def synthetic_scan_response(numLines, tag=SCAN_TAG):
+  '''
+  Bytes of a scan transaction as the server sends them: ack, numLines data lines, complete
+  '''
+  lines = [ "%s &\r\n" % tag ]
+  lines.extend("%s # %.4f, %.4f, %.4f\r\n" % (tag, i*0.01, 50 + i*0.001, -20.0) for i in range(numLines))
+  lines.append("%s %%\r\n" % tag)
+  return "".join(lines).encode("ascii")
+
+
+async def read_until_loop(client):
+  '''
+  The original read path, one read_until and decode per line
+  '''
+  try:
+    while True:
+      client._dispatch_message(await client.readMessage())
+  except StreamClosedError:
+    pass
+
+
+async def chunked_loop(client):
+  await client.handleMessages()
+
+
+async def time_read_loop(readLoop, payload, numLines):
+  (serverSock, clientSock) = socket.socketpair()
+  client = Client()
+  client.stream = IOStream(clientSock)
+  transaction = Transaction(SCAN_TAG, "ScanOnLine()")
+  client.transactions[SCAN_TAG] = transaction
+
+  def serve():
+    serverSock.sendall(payload)
+    serverSock.close()
+  writer = threading.Thread(target=serve)
+
+  start = time.perf_counter()
+  writer.start()
+  await readLoop(client)
+  elapsed = time.perf_counter() - start
+
+  writer.join()
+  client.stream.close()
+  assert len(transaction.data_list) == numLines
+  return elapsed
+
+
+async def reader(numLines=100000):
+  '''
+  Compare per-line read_until with the chunked reader on a synthetic scan response
+  '''
+  numLines = int(numLines)
+  payload = synthetic_scan_response(numLines)
+  for (name, loop) in [ ("read_until", read_until_loop), ("chunked", chunked_loop) ]:
+    elapsed = await time_read_loop(loop, payload, numLines)
+    print("%-10s %8d lines %8.3f s %10.0f lines/s" % (name, numLines, elapsed, numLines / elapsed))
+
+
+def slicing_parse(data):
+  '''
+  The str.find slicing that float3.FromXYZString and readPointData used before ResponseParser
+  '''
+  x = float(data[data.find("X(") + 2 : data.find("), Y")])
+  y = float(data[data.find("Y(") + 2 : data.find("), Z")])
+  z = float(data[data.find("Z(") + 2 : data.rfind(")")])
+  return float3(x,y,z)
+
+
+async def parser(numLines=100000):
+  '''
+  Compare parsing PtMeas results by slicing with the compiled ResponseParser
+  '''
+  numLines = int(numLines)
+  lines = [ "%s # X(%.4f), Y(%.4f), Z(%.4f)\r\n" % (SCAN_TAG, i*0.01, 50 + i*0.001, -20.0) for i in range(numLines) ]
+  responseParser = compileResponseFormat("X(),Y(),Z()")
+  cases = [
+    ("slicing", lambda: [ slicing_parse(line) for line in lines ]),
+    ("parse", lambda: [ responseParser.parse(line) for line in lines ]),
+    ("parseMany", lambda: responseParser.parseMany(lines)),
+    ("parseArray", lambda: responseParser.parseArray(lines)),
+  ]
+  for (name, parse) in cases:
+    start = time.perf_counter()
+    parse()
+    elapsed = time.perf_counter() - start
+    print("%-10s %8d lines %8.3f s %6.2f us/line" % (name, numLines, elapsed, elapsed / numLines * 1e6))
+
+
+def synthetic_scan_lines(numPoints, pointsPerLine=10, tag=SCAN_TAG):
+  '''
+  Scan data lines in the X(),Y(),Z() scan report format, pointsPerLine points to a line
+  '''
+  lines = []
+  for start in range(0, numPoints, pointsPerLine):
+    values = ",".join("%.4f,%.4f,%.4f" % (i*0.01, 50 + i*0.001, -20.0) for i in range(start, min(start + pointsPerLine, numPoints)))
+    lines.append("%s # %s\r\n" % (tag, values))
+  return lines
+
+
+async def scan(*sizes):
+  '''
+  Compare parsing scan data into float3 objects with ScanResult's bulk parsing into an array
+  '''
+  sizes = [ int(s) for s in sizes ] or [ 10000, 100000, 1000000 ]
+  for numPoints in sizes:
+    lines = synthetic_scan_lines(numPoints)
+
+    start = time.perf_counter()
+    points = []
+    for line in lines:
+      values = line[8:].split(",")
+      for i in range(0, len(values), 3):
+        points.append(float3(float(values[i]), float(values[i+1]), float(values[i+2])))
+    perPoint = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = ScanResult.fromLines(lines)
+    bulk = time.perf_counter() - start
+
+    assert len(points) == len(result) == numPoints
+    print("%8d points  float3 %7.3f s  ScanResult %7.3f s  %5.1fx  %10.0f points/s" % (
+      numPoints, perPoint, bulk, perPoint / bulk, numPoints / bulk))
+
+
+class ServerProcess(ABC):
+  """
+  Runs a server in its own process so it doesn't compete with the client for the
+  event loop or the GIL. Subclasses implement serve() to start an asyncio server.
+  """
+  def __init__(self):
+    self.port = None
+
+  @abstractmethod
+  async def serve(self):
+    '''
+    Start listening on a free local port, returns the asyncio Server
+    '''
+
+  def run(self, conn):
+    async def run():
+      server = await self.serve()
+      conn.send(server.sockets[0].getsockname()[1])
+      await server.serve_forever()
+    asyncio.run(run())
+
+  def start(self):
+    (parentConn, childConn) = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(target=self.run, args=(childConn,), daemon=True)
+    self.process.start()
+    self.port = parentConn.recv()
+    return self
+
+  def stop(self):
+    self.process.terminate()
+    self.process.join()
+
+
+class EchoServer(ServerProcess):
+  """
+  Server that acks, echoes the command as a data line and completes every command immediately
+  """
+  @staticmethod
+  async def handle(reader, writer):
+    buffer = b""
+    try:
+      while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+          break
+        lines = (buffer + chunk).split(b"\r\n")
+        buffer = lines.pop()
+        writer.write(b"".join([ b"%s &\r\n%s # %s\r\n%s %%\r\n" % (line[0:5], line[0:5], line[6:], line[0:5]) for line in lines ]))
+    except (asyncio.CancelledError, ConnectionError):
+      pass
+    writer.close()
+
+  async def serve(self):
+    return await asyncio.start_server(EchoServer.handle, "127.0.0.1", 0)
+
+
+class SimulatorProcess(ServerProcess):
+  """
+  The simulated DME from ipp_server, with the given SimulatedDme options
+  """
+  def __init__(self, **dmeOptions):
+    super().__init__()
+    self.dmeOptions = dmeOptions
+
+  async def serve(self):
+    simulator = await SimulatedServer(SimulatedDme(**self.dmeOptions)).start()
+    return simulator.server
+
+
+async def transports(numCommands=20000, numRoundTrips=2000):
+  '''
+  Compare messages/sec and per-message round trip latency of each transport
+  '''
+  numCommands = int(numCommands)
+  numRoundTrips = int(numRoundTrips)
+  server = EchoServer().start()
+  try:
+    for name in TRANSPORTS:
+      client = Client("127.0.0.1", server.port, transport=name)
+      await client.connect()
+
+      latencies = np.empty(numRoundTrips)
+      for i in range(numRoundTrips):
+        start = time.perf_counter()
+        await client.Get("X(),Y(),Z()").complete()
+        latencies[i] = time.perf_counter() - start
+
+      start = time.perf_counter()
+      async with client.pipeline() as p:
+        for i in range(numCommands):
+          p.GoTo("X(%s)" % i)
+      elapsed = time.perf_counter() - start
+
+      await client.disconnect()
+      # every command is answered with ack, data and complete messages
+      print("%-8s %9.0f commands/s %9.0f messages/s   latency p50 %7.1f us  p99 %7.1f us" % (
+        name, numCommands / elapsed, 3 * numCommands / elapsed,
+        np.percentile(latencies, 50) * 1e6, np.percentile(latencies, 99) * 1e6))
+  finally:
+    server.stop()
+
+
+async def transactions(numPipelined=100000, numSerial=100000, window=10000):
+  '''
+  Per-command client overhead for no-op transactions against a local echo server,
+  pipelined window commands at a time (tags wrap at 99999) and awaited one at a time
+  '''
+  numPipelined = int(numPipelined)
+  numSerial = int(numSerial)
+  window = int(window)
+  server = EchoServer().start()
+  try:
+    client = Client("127.0.0.1", server.port)
+    await client.connect()
+
+    start = time.perf_counter()
+    for first in range(0, numPipelined, window):
+      async with client.pipeline() as p:
+        for i in range(first, min(first + window, numPipelined)):
+          p.ClearAllErrors()
+    pipelined = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(numSerial):
+      await client.ClearAllErrors().complete()
+    serial = time.perf_counter() - start
+
+    await client.disconnect()
+    print("pipelined %8d transactions %7.3f s %6.1f us/transaction" % (numPipelined, pipelined, pipelined / numPipelined * 1e6))
+    print("serial    %8d transactions %7.3f s %6.1f us/transaction" % (numSerial, serial, serial / numSerial * 1e6))
+  finally:
+    server.stop()
+
+
+async def bench_throughput(client, numSerial, numPipelined, window):
+  start = time.perf_counter()
+  for i in range(numSerial):
+    await client.Get("X(),Y(),Z()").complete()
+  serial = time.perf_counter() - start
+
+  # every GetProp should reach the server rather than the client's state cache
+  client.state.enabled = False
+  try:
+    start = time.perf_counter()
+    for first in range(0, numPipelined, window):
+      async with client.pipeline() as p:
+        for i in range(first, min(first + window, numPipelined)):
+          p.GetProp(["Tool.PtMeasPar.Speed()"])
+    pipelined = time.perf_counter() - start
+  finally:
+    client.state.enabled = True
+
+  return {
+    "serial": { "transactions": numSerial, "seconds": serial, "transactionsPerSecond": numSerial / serial },
+    "pipelined": { "transactions": numPipelined, "seconds": pipelined, "transactionsPerSecond": numPipelined / pipelined },
+  }
+
+
+def scan_command(numPoints):
+  # a line on the table with numPoints points 0.001mm apart
+  return "0,0,0,%s,0,0,0,0,1,0.001" % ((numPoints - 1) * 0.001)
+
+
+async def bench_scan_ingest(client, numPoints):
+  await client.OnScanReport("X(),Y(),Z()")
+  start = time.perf_counter()
+  scan = await client.ScanOnLine(scan_command(numPoints)).complete()
+  received = time.perf_counter() - start
+  result = client.scanResult(scan)
+  elapsed = time.perf_counter() - start
+  assert len(result) == numPoints
+  numLines = len(scan.data_list)
+  return {
+    "points": numPoints,
+    "lines": numLines,
+    "receiveSeconds": received,
+    "parseSeconds": elapsed - received,
+    "linesPerSecond": numLines / elapsed,
+    "pointsPerSecond": numPoints / elapsed,
+  }
+
+
+async def bench_memory(client, numPoints):
+  '''
+  Python heap retained by a finished scan's data lines and by its ScanResult, scaled to 1M points
+  '''
+  await client.OnScanReport("X(),Y(),Z()")
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    scan = await client.ScanOnLine(scan_command(numPoints)).complete()
+    lines = tracemalloc.get_traced_memory()[0] - before
+    result = client.scanResult(scan)
+    array = tracemalloc.get_traced_memory()[0] - before - lines
+  finally:
+    tracemalloc.stop()
+  scale = 1e6 / numPoints
+  return {
+    "points": numPoints,
+    "dataLinesBytesPer1MPoints": lines * scale,
+    "scanResultBytesPer1MPoints": array * scale,
+    "clientMemoryUsage": client.memoryUsage(),
+  }
+
+
+async def bench_loop_lag(client, numPoints):
+  '''
+  Event loop lag while parsing a scan on the loop and in a worker process, with
+  Gets round tripping alongside to show how long socket handling is held up
+  '''
+  await client.OnScanReport("X(),Y(),Z()")
+  scan = await client.ScanOnLine(scan_command(numPoints)).complete()
+  results = {}
+  with Offloader("process", maxWorkers=1) as offloader:
+    # start the worker before timing
+    await offloader.run(len, [])
+    async def parseInline():
+      return client.scanResult(scan)
+    for (name, parse) in [ ("inline", parseInline), ("offloaded", lambda: offloader.scanResult(scan)) ]:
+      monitor = LoopLagMonitor(interval=0.001).start()
+      done = False
+      async def roundTrips():
+        latencies = []
+        while not done:
+          start = time.perf_counter()
+          await client.Get("X(),Y(),Z()").complete()
+          latencies.append(time.perf_counter() - start)
+        return latencies
+      trips = asyncio.create_task(roundTrips())
+      await asyncio.sleep(0.05)
+      start = time.perf_counter()
+      result = await parse()
+      elapsed = time.perf_counter() - start
+      done = True
+      latencies = await trips
+      monitor.stop()
+      assert len(result) == numPoints
+      results[name] = { "parseSeconds": elapsed, "loopLag": monitor.summary(), "maxGetSeconds": max(latencies) }
+  return results
+
+
+async def bench_routines(client):
+  '''
+  End to end runtime of the ipp_routines helpers against the simulated part. A routine
+  that fails reports its error instead of a time.
+  '''
+  cases = [
+    ("ensure_homed", lambda: routines.ensure_homed(client), None),
+    ("ensure_tool_loaded", lambda: routines.ensure_tool_loaded(client, "Component_3.1.50.4.A0.0-B0.0"), None),
+    # a line along the table
+    ("probe_line", lambda: routines.probe_line(client, float3(300, 300, 0), float3(1, 0, 0), float3(0, 0, 1), 50, 10, 10, 1),
+      "X(300),Y(300),Z(20)"),
+    ("headline", lambda: routines.headline(client, float3(300, 350, 0), float3(1, 0, 0), 50, float3(0, 0, 1), 10, 1, 10),
+      "X(300),Y(350),Z(20)"),
+    # starting just above the reference sphere
+    ("probe_sphere_relative", lambda: routines.probe_sphere_relative(client, 12.5), "X(400),Y(300),Z(123)"),
+  ]
+  results = {}
+  for (name, routine, startPosition) in cases:
+    await client.ClearAllErrors().complete()
+    if startPosition is not None:
+      await client.GoTo("Z(150)").complete()
+      await client.GoTo(startPosition).complete()
+    commandsSent = client.commandsSent
+    start = time.perf_counter()
+    try:
+      await routine()
+      results[name] = { "seconds": time.perf_counter() - start, "commands": client.commandsSent - commandsSent }
+    except Exception as e:
+      results[name] = { "error": repr(e) }
+  return results
+
+
+async def suite(output=None, scanPoints=1000000, numSerial=5000, numPipelined=20000, window=10000):
+  '''
+  Reproducible benchmark suite against the simulated server in its own process. Prints
+  the results as JSON and writes them to output when given, for tracking regressions.
+  '''
+  scanPoints = int(scanPoints)
+  numSerial = int(numSerial)
+  numPipelined = int(numPipelined)
+  window = int(window)
+  server = SimulatorProcess(seed=0).start()
+  try:
+    client = Client("127.0.0.1", server.port)
+    await client.connect()
+    await client.StartSession().complete()
+
+    results = {
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "numpy": np.__version__,
+      "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+      "throughput": await bench_throughput(client, numSerial, numPipelined, window),
+    }
+    stats = client.stats()
+    results["latency"] = {
+      "serial": { key: stats["Get"][key] for key in ("ackLatency", "totalTime") },
+      "pipelined": { key: stats["GetProp"][key] for key in ("ackLatency", "totalTime") },
+    }
+    results["scanIngest"] = await bench_scan_ingest(client, scanPoints)
+    results["memory"] = await bench_memory(client, min(scanPoints, 200000))
+    results["loopLag"] = await bench_loop_lag(client, min(scanPoints, 500000))
+    results["routines"] = await bench_routines(client)
+
+    await client.EndSession().complete()
+    await client.disconnect()
+  finally:
+    server.stop()
+
+  text = json.dumps(results, indent=2, default=float)
+  print(text)
+  if output:
+    with open(output, "w") as f:
+      f.write(text)
+
+
+BENCHMARKS = {
+  "reader": reader,
+  "transports": transports,
+  "parser": parser,
+  "scan": scan,
+  "transactions": transactions,
+  "suite": suite,
+}
+
+async def main():
+  print(sys.argv, file=sys.stderr)
+  selectedBenchmark = sys.argv[1] if len(sys.argv) > 1 else None
+  if selectedBenchmark not in BENCHMARKS:
+    print("Unrecognized benchmark name %s, expected one of %s" % (selectedBenchmark, ", ".join(BENCHMARKS)), file=sys.stderr)
+    sys.exit(1)
+
+  await BENCHMARKS[selectedBenchmark](*sys.argv[2:])
+
+if __name__ == "__main__":
+  asyncio.run(main())
@@ -0,0 +1,261 @@
+'''
+Record the I++ traffic of a Client to a capture file, and replay or summarize captures.
+  python ipp_capture.py summary capture.ippcap
+  python ipp_capture.py replay capture.ippcap [port] [speed]
+
+A capture is an append-only sequence of records, each a little endian header of
+seconds since the session started (float64), direction (uint8) and length (uint32)
+followed by that many bytes. Every line sent or received is one record. Each
+recording session starts with a START record holding the wall clock time, so
+several sessions can be appended to the same file.
+
+  client = Client(host, port, recorder=CaptureWriter("shopfloor.ippcap"))
+'''
+import sys
+import time
+import struct
+import asyncio
+import logging
+from collections import namedtuple
+from ipp import Histogram, IPP_ACK_CHAR, IPP_COMPLETE_CHAR, IPP_ERROR_CHAR
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<dBI")
+
+SENT = 0
+RECEIVED = 1
+START = 2
+
+CAPTURE_MAGIC = b"IPPCAP1"
+
+Record = namedtuple("Record", [ "time", "direction", "data" ])
+
+
+class CaptureWriter:
+  """
+  Appends the lines a Client sends and receives to a capture file, timestamped
+  with time.monotonic() relative to when the writer was created
+  """
+  def __init__(self, path, bufferSize=1 << 16):
+    self.path = path
+    self.file = open(path, "ab", buffering=bufferSize)
+    self.start = time.monotonic()
+    self.records = 0
+    self.write(START, b"%s %.6f" % (CAPTURE_MAGIC, time.time()))
+
+  def write(self, direction, data):
+    self.file.write(RECORD_HEADER.pack(time.monotonic() - self.start, direction, len(data)) + data)
+    self.records += 1
+
+  def sent(self, data):
+    '''
+    Record the command lines in one write to the server
+    '''
+    timestamp = time.monotonic() - self.start
+    pack = RECORD_HEADER.pack
+    self.file.write(b"".join([ pack(timestamp, SENT, len(line)) + line for line in data.splitlines(True) ]))
+    self.records += data.count(b"\n")
+
+  def received(self, msg):
+    self.write(RECEIVED, msg.encode("ascii"))
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def read_capture(path):
+  '''
+  Yields every Record in a capture file, START records included
+  '''
+  headerSize = RECORD_HEADER.size
+  with open(path, "rb") as f:
+    data = f.read()
+  offset = 0
+  while offset + headerSize <= len(data):
+    (timestamp, direction, length) = RECORD_HEADER.unpack_from(data, offset)
+    offset += headerSize
+    if offset + length > len(data):
+      logger.warning("Truncated record at the end of %s", path)
+      break
+    yield Record(timestamp, direction, data[offset:offset+length])
+    offset += length
+
+
+def read_sessions(path):
+  '''
+  Returns the recording sessions in a capture file as (wall clock start time, records) pairs
+  '''
+  sessions = []
+  for record in read_capture(path):
+    if record.direction == START:
+      if not record.data.startswith(CAPTURE_MAGIC):
+        raise ValueError("%s is not an I++ capture" % path)
+      sessions.append((float(record.data[len(CAPTURE_MAGIC):]), []))
+    elif sessions:
+      sessions[-1][1].append(record)
+    else:
+      raise ValueError("%s doesn't start with a START record" % path)
+  return sessions
+
+
+def summarize(records):
+  '''
+  Per command counts, errors and latency percentiles (send to ack, send to
+  complete or error, in seconds) of the transactions in a session's records
+  '''
+  sent = {}
+  commands = {}
+  for record in records:
+    line = record.data.decode("ascii")
+    tag = line[0:5]
+    if record.direction == SENT:
+      name = line[6:line.find("(")].strip()
+      sent[tag] = (name, record.time)
+      continue
+    if tag not in sent or len(line) < 7:
+      continue
+    (name, sentAt) = sent[tag]
+    stats = commands.get(name)
+    if stats is None:
+      stats = commands[name] = { "count": 0, "errors": 0, "ackLatency": Histogram(), "totalTime": Histogram() }
+    key = line[6]
+    if key == IPP_ACK_CHAR:
+      stats["ackLatency"].record(record.time - sentAt)
+    elif key in (IPP_COMPLETE_CHAR, IPP_ERROR_CHAR):
+      stats["count"] += 1
+      if key == IPP_ERROR_CHAR:
+        stats["errors"] += 1
+      stats["totalTime"].record(record.time - sentAt)
+      del sent[tag]
+  return {
+    name: dict(stats, ackLatency=stats["ackLatency"].summary(), totalTime=stats["totalTime"].summary())
+    for (name, stats) in commands.items()
+  }
+
+
+class ReplayServer:
+  """
+  Plays a recorded session back to a client. Each received line is sent once the
+  client has sent every command that preceded it in the capture, and no earlier
+  than its recorded delay after the last of them, divided by speed. With speed
+  None lines are sent as soon as their commands arrive. The client should repeat
+  the recorded session's commands; lines that differ are counted in mismatches.
+
+    async with ReplayServer("shopfloor.ippcap", speed=10) as server:
+      client = Client("127.0.0.1", server.port)
+  """
+  def __init__(self, path, speed=1.0, session=0, host="127.0.0.1", port=0):
+    (self.startTime, self.records) = read_sessions(path)[session]
+    self.speed = speed
+    self.host = host
+    self.port = port
+    self.server = None
+    self.mismatches = 0
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle, self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+    return self
+
+  async def stop(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+  async def __aenter__(self):
+    return await self.start()
+
+  async def __aexit__(self, *exc):
+    await self.stop()
+
+  async def handle(self, reader, writer):
+    loop = asyncio.get_running_loop()
+    # arrival time of each line the client sent
+    arrivals = []
+    arrived = asyncio.Event()
+    expected = [ record.data for record in self.records if record.direction == SENT ]
+
+    async def receive():
+      buffer = b""
+      try:
+        while True:
+          chunk = await reader.read(65536)
+          if not chunk:
+            break
+          lines = (buffer + chunk).split(b"\r\n")
+          buffer = lines.pop()
+          now = loop.time()
+          for line in lines:
+            line += b"\r\n"
+            i = len(arrivals)
+            if i >= len(expected) or line != expected[i]:
+              logger.warning("Replay expected %r, received %r", expected[i] if i < len(expected) else None, line)
+              self.mismatches += 1
+            arrivals.append(now)
+          arrived.set()
+      except ConnectionError:
+        pass
+      # wake the player so it sees the client is gone
+      arrived.set()
+
+    receiver = asyncio.create_task(receive())
+    try:
+      numSent = 0
+      anchor = None
+      for record in self.records:
+        if record.direction == SENT:
+          numSent += 1
+          anchor = record.time
+          continue
+        while len(arrivals) < numSent:
+          if receiver.done():
+            return
+          arrived.clear()
+          await arrived.wait()
+        if self.speed and anchor is not None:
+          delay = (record.time - anchor) / self.speed - (loop.time() - arrivals[numSent - 1])
+          if delay > 0:
+            await writer.drain()
+            await asyncio.sleep(delay)
+        writer.write(record.data)
+      await writer.drain()
+      await receiver
+    except (asyncio.CancelledError, ConnectionError):
+      pass
+    finally:
+      receiver.cancel()
+      writer.close()
+
+
+async def replay(path, port=1294, speed=1.0):
+  speed = float(speed) if speed != "None" else None
+  server = await ReplayServer(path, speed=speed, host="0.0.0.0", port=int(port)).start()
+  print("Replaying %s on port %s" % (path, server.port))
+  await server.server.serve_forever()
+
+async def summary(path):
+  for (startTime, records) in read_sessions(path):
+    print("Session started %s, %d records" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(startTime)), len(records)))
+    for (name, stats) in summarize(records).items():
+      print("  %-24s %6d commands %4d errors  ack p50 %8.1f ms  total p50 %8.1f ms  p99 %8.1f ms" % (
+        name, stats["count"], stats["errors"], stats["ackLatency"].get("p50", 0) * 1e3,
+        stats["totalTime"].get("p50", 0) * 1e3, stats["totalTime"].get("p99", 0) * 1e3))
+
+async def main():
+  selected = sys.argv[1]
+  if selected not in ("replay", "summary"):
+    print("Unrecognized command %s" % selected)
+    sys.exit(0)
+  await globals()[selected](*sys.argv[2:])
+
+if __name__ == "__main__":
+  asyncio.run(main())
@@ -0,0 +1,337 @@
+'''
+Least squares fits of lines, planes, circles, spheres and cylinders to measured points.
+
+  sphere = fit_sphere(await probe_sphere_relative(client, 12.5))
+  print(sphere.center, sphere.radius, sphere.form)
+
+Points can be a list of float3, an N x 3 array or a ScanResult. Fits return
+namedtuples with float3 points and vectors, the residual of every point (signed
+distance from the fitted feature, unsigned for lines), their rms and the form
+error: the width of the zone holding every point, max - min residual (twice the
+largest distance for lines).
+
+The Incremental* classes refine a fit point by point as PtMeas results arrive.
+Lines, planes, circles and spheres keep running sums so adding a point and
+refitting is O(1); residuals are computed when the result is requested.
+'''
+from collections import namedtuple
+import numpy as np
+from scipy.optimize import least_squares
+from ipp import float3, toPointArray
+
+LineFit = namedtuple("LineFit", [ "point", "direction", "residuals", "rms", "form" ])
+PlaneFit = namedtuple("PlaneFit", [ "point", "normal", "residuals", "rms", "form" ])
+CircleFit = namedtuple("CircleFit", [ "center", "normal", "radius", "residuals", "rms", "form" ])
+SphereFit = namedtuple("SphereFit", [ "center", "radius", "residuals", "rms", "form" ])
+CylinderFit = namedtuple("CylinderFit", [ "point", "axis", "radius", "residuals", "rms", "form" ])
+
+
+def _check(points, minimum):
+  points = toPointArray(points)
+  if len(points) < minimum:
+    raise ValueError("At least %d points are needed, got %d" % (minimum, len(points)))
+  return points
+
+def _rms(residuals):
+  return float(np.sqrt(np.mean(residuals * residuals)))
+
+def _zone(residuals):
+  return float(residuals.max() - residuals.min())
+
+def _basis(normal):
+  '''
+  Two unit vectors perpendicular to normal and each other
+  '''
+  helper = np.eye(3)[np.argmin(np.abs(normal))]
+  u = np.cross(normal, helper)
+  u /= np.linalg.norm(u)
+  return (u, np.cross(normal, u))
+
+def _principal(scatter):
+  '''
+  Principal directions of a scatter matrix, by ascending variance
+  '''
+  return np.linalg.eigh(scatter)[1].T
+
+
+def _line_result(points, centroid, direction):
+  offsets = points - centroid
+  distances = np.linalg.norm(offsets - np.outer(offsets @ direction, direction), axis=1)
+  return LineFit(float3(centroid), float3(direction), distances, _rms(distances), 2 * float(distances.max()))
+
+def fit_line(points):
+  '''
+  Line through the centroid along the direction of largest spread
+  '''
+  points = _check(points, 2)
+  centroid = points.mean(axis=0)
+  direction = np.linalg.svd(points - centroid, full_matrices=False)[2][0]
+  return _line_result(points, centroid, direction)
+
+
+def _plane_result(points, centroid, normal):
+  residuals = (points - centroid) @ normal
+  return PlaneFit(float3(centroid), float3(normal), residuals, _rms(residuals), _zone(residuals))
+
+def fit_plane(points, normal=None):
+  '''
+  Plane through the centroid normal to the direction of least spread, oriented
+  along normal when given
+  '''
+  points = _check(points, 3)
+  centroid = points.mean(axis=0)
+  fitted = np.linalg.svd(points - centroid, full_matrices=False)[2][2]
+  if normal is not None and fitted @ np.asarray(normal, dtype=np.float64) < 0:
+    fitted = -fitted
+  return _plane_result(points, centroid, fitted)
+
+
+def _refine_sphere(points, center):
+  '''
+  Gauss-Newton iterations on the geometric distances, from an algebraic estimate
+  '''
+  radius = np.linalg.norm(points - center, axis=1).mean()
+  for i in range(20):
+    offsets = points - center
+    distances = np.linalg.norm(offsets, axis=1)
+    residuals = distances - radius
+    jacobian = np.column_stack([ -offsets / distances[:,None], -np.ones(len(points)) ])
+    step = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+    center = center + step[:-1]
+    radius += step[-1]
+    if np.abs(step).max() < 1e-12 * max(1.0, radius):
+      break
+  return (center, radius)
+
+def _algebraic_sphere(AtA, Atb):
+  solution = np.linalg.solve(AtA, Atb)
+  return solution[:-1]
+
+def _sphere_system(points):
+  A = np.column_stack([ 2 * points, np.ones(len(points)) ])
+  return (A.T @ A, A.T @ (points * points).sum(axis=1))
+
+def _sphere_result(points, center, radius):
+  residuals = np.linalg.norm(points - center, axis=1) - radius
+  return SphereFit(float3(center), float(radius), residuals, _rms(residuals), _zone(residuals))
+
+def fit_sphere(points):
+  '''
+  Geometric least squares sphere, starting from the algebraic fit
+  '''
+  points = _check(points, 4)
+  center = _algebraic_sphere(*_sphere_system(points))
+  return _sphere_result(points, *_refine_sphere(points, center))
+
+
+def _algebraic_circle(AtA, Atb, centroid, normal):
+  '''
+  Algebraic sphere fit with its center constrained to the circle's plane
+  '''
+  kkt = np.zeros((5, 5))
+  kkt[:4,:4] = 2 * AtA
+  kkt[:3,4] = kkt[4,:3] = normal
+  rhs = np.append(2 * Atb, centroid @ normal)
+  return np.linalg.solve(kkt, rhs)[:3]
+
+def _circle_result(points, center, normal, radius):
+  offsets = points - center
+  inPlane = offsets - np.outer(offsets @ normal, normal)
+  residuals = np.linalg.norm(inPlane, axis=1) - radius
+  return CircleFit(float3(center), float3(normal), float(radius), residuals, _rms(residuals), _zone(residuals))
+
+def fit_circle(points, normal=None):
+  '''
+  Circle in the best fit plane of points (or the plane normal to normal through their
+  centroid), fitted geometrically to the points projected onto the plane
+  '''
+  points = _check(points, 3)
+  centroid = points.mean(axis=0)
+  if normal is None:
+    normal = np.linalg.svd(points - centroid, full_matrices=False)[2][2]
+  normal = np.asarray(normal, dtype=np.float64)
+  normal = normal / np.linalg.norm(normal)
+  (u, v) = _basis(normal)
+  planar = np.column_stack([ (points - centroid) @ u, (points - centroid) @ v, np.zeros(len(points)) ])
+  center = _algebraic_circle(*_sphere_system(planar), np.zeros(3), np.array([ 0.0, 0.0, 1.0 ]))
+  (center, radius) = _refine_sphere(planar[:,:2], center[:2])
+  return _circle_result(points, centroid + center[0] * u + center[1] * v, normal, radius)
+
+
+def _cylinder_residuals(params, points, axis0, u, v, point0):
+  axis = axis0 + params[0] * u + params[1] * v
+  axis /= np.linalg.norm(axis)
+  offsets = points - (point0 + params[2] * u + params[3] * v)
+  return np.linalg.norm(np.cross(offsets, axis), axis=1) - params[4]
+
+def _cylinder_result(points, point, axis, radius):
+  residuals = np.linalg.norm(np.cross(points - point, axis), axis=1) - radius
+  return CylinderFit(float3(point), float3(axis), float(radius), residuals, _rms(residuals), _zone(residuals))
+
+def _fit_cylinder_from(points, axis0):
+  centroid = points.mean(axis=0)
+  (u, v) = _basis(axis0)
+  circle = fit_circle(points, normal=axis0)
+  point0 = np.asarray(circle.center)
+  point0 = point0 - ((point0 - centroid) @ axis0) * axis0
+  solution = least_squares(_cylinder_residuals, [ 0, 0, 0, 0, circle.radius ], args=(points, axis0, u, v, point0), method="lm")
+  axis = axis0 + solution.x[0] * u + solution.x[1] * v
+  axis /= np.linalg.norm(axis)
+  point = point0 + solution.x[2] * u + solution.x[3] * v
+  # the point on the axis nearest the centroid
+  point = point + ((centroid - point) @ axis) * axis
+  return (solution.cost, _cylinder_result(points, point, axis, abs(solution.x[4])))
+
+def fit_cylinder(points, axis=None):
+  '''
+  Geometric least squares cylinder. Without an approximate axis, the directions of
+  most and least spread of the points are tried, which suit long cylinders and
+  short bands respectively.
+  '''
+  points = _check(points, 5)
+  if axis is not None:
+    axis = np.asarray(axis, dtype=np.float64)
+    candidates = [ axis / np.linalg.norm(axis) ]
+  else:
+    directions = np.linalg.svd(points - points.mean(axis=0), full_matrices=False)[2]
+    candidates = [ directions[0], directions[2] ]
+  return min((_fit_cylinder_from(points, c) for c in candidates), key=lambda fit: fit[0])[1]
+
+
+class IncrementalFit:
+  """
+  Base for fits refined point by point. Points are kept in a growing array so
+  residuals can be computed for the result.
+  """
+  minimumPoints = 1
+
+  def __init__(self, points=None):
+    self.points = np.empty((16, 3))
+    self.count = 0
+    if points is not None:
+      self.extend(points)
+
+  def add(self, point):
+    self.extend([ point ])
+    return self
+
+  def extend(self, points):
+    points = toPointArray(points)
+    needed = self.count + len(points)
+    if needed > len(self.points):
+      grown = np.empty((max(needed, 2 * len(self.points)), 3))
+      grown[:self.count] = self.points[:self.count]
+      self.points = grown
+    self.points[self.count:needed] = points
+    self.count = needed
+    self._update(points)
+    return self
+
+  def __len__(self):
+    return self.count
+
+  def _update(self, points):
+    pass
+
+  def result(self):
+    if self.count < self.minimumPoints:
+      raise ValueError("At least %d points are needed, got %d" % (self.minimumPoints, self.count))
+    return self._result(self.points[:self.count])
+
+
+class _MomentFit(IncrementalFit):
+  """
+  Keeps the sums of the points and of their outer products
+  """
+  def _update(self, points):
+    if self.count == len(points):
+      # shift by the first point to keep the sums well conditioned
+      self.origin = points[0].copy()
+      self.total = np.zeros(3)
+      self.outer = np.zeros((3, 3))
+    shifted = points - self.origin
+    self.total += shifted.sum(axis=0)
+    self.outer += shifted.T @ shifted
+
+  def _moments(self):
+    mean = self.total / self.count
+    scatter = self.outer - self.count * np.outer(mean, mean)
+    return (self.origin + mean, _principal(scatter))
+
+
+class IncrementalLine(_MomentFit):
+  minimumPoints = 2
+
+  def _result(self, points):
+    (centroid, directions) = self._moments()
+    return _line_result(points, centroid, directions[2])
+
+
+class IncrementalPlane(_MomentFit):
+  minimumPoints = 3
+
+  def _result(self, points):
+    (centroid, directions) = self._moments()
+    return _plane_result(points, centroid, directions[0])
+
+
+class IncrementalSphere(_MomentFit):
+  """
+  Algebraic sphere fit from running sums, optionally refined geometrically
+  """
+  minimumPoints = 4
+
+  def __init__(self, points=None, refine=False):
+    self.refine = refine
+    super().__init__(points)
+
+  def _update(self, points):
+    super()._update(points)
+    if self.count == len(points):
+      self.AtA = np.zeros((4, 4))
+      self.Atb = np.zeros(4)
+    shifted = points - self.origin
+    (AtA, Atb) = _sphere_system(shifted)
+    self.AtA += AtA
+    self.Atb += Atb
+
+  def _result(self, points):
+    solution = np.linalg.solve(self.AtA, self.Atb)
+    center = solution[:-1]
+    if self.refine:
+      (center, radius) = _refine_sphere(points - self.origin, center)
+    else:
+      radius = np.sqrt(solution[-1] + center @ center)
+    return _sphere_result(points, self.origin + center, radius)
+
+
+class IncrementalCircle(IncrementalSphere):
+  """
+  Circle from the running sums: the best fit plane and an algebraic sphere fit
+  with its center constrained to that plane
+  """
+  minimumPoints = 3
+
+  def _result(self, points):
+    (centroid, directions) = self._moments()
+    normal = directions[0]
+    center = _algebraic_circle(self.AtA, self.Atb, centroid - self.origin, normal)
+    offsets = points - self.origin - center
+    radius = np.linalg.norm(offsets - np.outer(offsets @ normal, normal), axis=1).mean()
+    return _circle_result(points, self.origin + center, normal, radius)
+
+
+class IncrementalCylinder(IncrementalFit):
+  """
+  Refits the cylinder from its previous axis as points arrive
+  """
+  minimumPoints = 5
+
+  def __init__(self, points=None, axis=None):
+    self.axis = axis
+    super().__init__(points)
+
+  def _result(self, points):
+    fit = fit_cylinder(points, axis=self.axis)
+    self.axis = np.asarray(fit.axis)
+    return fit
@@ -0,0 +1,140 @@
+'''
+Local kinematic model of an A/B probe head, to convert between Tool.A/Tool.B angles
+and tool alignment vectors without CalcToolAlignment and CalcToolAngles round trips.
+
+  head = HeadKinematics()
+  await head.calibrate(client)
+  alignments = head.alignments(a, b)
+  (a, b) = head.angles(alignments)
+
+A tilts the tool away from vertical and B rotates it about the machine's Z axis:
+with no offsets the alignment is (sin A sin B, -sin A cos B, cos A). Calibration
+fits zero offsets for A and B and a small tilt of the head's mounting to
+CalcToolAlignment responses, and reports the largest remaining error.
+'''
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.spatial.transform import Rotation
+from ipp import float3, NUMBER_RE
+
+# Calibration poses, A from vertical to horizontal at several B angles
+CALIBRATION_ANGLES = [ (a, b) for a in (0.0, 30.0, 60.0, 90.0) for b in (-180.0, -90.0, -45.0, 0.0, 45.0, 90.0, 135.0) ]
+
+
+class HeadKinematics:
+  """
+  A/B head model, see the module docstring. Single conversions are cached by
+  their inputs quantized to resolution (degrees, or a unit vector component).
+  """
+  def __init__(self, aOffset=0.0, bOffset=0.0, mount=None, resolution=1e-6, cacheSize=100000):
+    self.aOffset = aOffset
+    self.bOffset = bOffset
+    # rotation from the head's frame to the machine's
+    self.mount = np.identity(3) if mount is None else np.asarray(mount, dtype=np.float64)
+    self.resolution = resolution
+    self.cacheSize = cacheSize
+    self.cache = {}
+    self.hits = 0
+    self.misses = 0
+    self.calibrationError = None
+
+  def alignments(self, a, b):
+    '''
+    N x 3 unit alignment vectors for arrays of A and B angles in degrees
+    '''
+    a = np.radians(np.asarray(a, dtype=np.float64) + self.aOffset).reshape(-1)
+    b = np.radians(np.asarray(b, dtype=np.float64) + self.bOffset).reshape(-1)
+    local = np.column_stack([ np.sin(a) * np.sin(b), -np.sin(a) * np.cos(b), np.cos(a) ])
+    return local @ self.mount.T
+
+  def angles(self, alignments, b=0.0):
+    '''
+    Arrays of A and B angles in degrees for N x 3 alignment vectors, B is taken from
+    b (scalar or array) where the tool is vertical and B is undefined
+    '''
+    local = np.asarray(alignments, dtype=np.float64).reshape(-1, 3) @ self.mount
+    local = local / np.linalg.norm(local, axis=1)[:,None]
+    a = np.degrees(np.arccos(np.clip(local[:,2], -1, 1))) - self.aOffset
+    horizontal = np.hypot(local[:,0], local[:,1]) > 1e-9
+    angles = np.degrees(np.arctan2(local[:,0], -local[:,1])) - self.bOffset
+    b = np.where(horizontal, angles, np.broadcast_to(np.asarray(b, dtype=np.float64), a.shape))
+    return (a, b)
+
+  def _cached(self, key, compute):
+    value = self.cache.get(key)
+    if value is None:
+      self.misses += 1
+      if len(self.cache) >= self.cacheSize:
+        self.cache.clear()
+      value = self.cache[key] = compute()
+    else:
+      self.hits += 1
+    return value
+
+  def alignment(self, a, b):
+    '''
+    float3 alignment for one A and B
+    '''
+    q = self.resolution
+    key = ("alignment", round(a / q), round(b / q))
+    return self._cached(key, lambda: float3(*self.alignments(a, b)[0].tolist()))
+
+  def angle(self, alignment, b=0.0):
+    '''
+    (A, B) for one alignment vector
+    '''
+    q = self.resolution
+    key = ("angles", round(alignment[0] / q), round(alignment[1] / q), round(alignment[2] / q), round(b / q))
+    return self._cached(key, lambda: tuple(float(v[0]) for v in self.angles([ tuple(alignment) ], b)))
+
+  def _set(self, params):
+    self.aOffset = float(params[0])
+    self.bOffset = float(params[1])
+    self.mount = Rotation.from_rotvec([ params[2], params[3], 0 ]).as_matrix()
+    self.cache.clear()
+
+  @staticmethod
+  def errors(expected, actual):
+    '''
+    Angles in degrees between rows of two N x 3 arrays of alignments
+    '''
+    expected = expected / np.linalg.norm(expected, axis=1)[:,None]
+    actual = actual / np.linalg.norm(actual, axis=1)[:,None]
+    return np.degrees(np.arccos(np.clip((expected * actual).sum(axis=1), -1, 1)))
+
+  async def measure(self, client, angles=CALIBRATION_ANGLES):
+    '''
+    The server's alignments, in machine coordinates, for a sequence of (A, B) pairs.
+    The CalcToolAlignment queries are all sent at once.
+    '''
+    await client.syncCoordSystem()
+    async with client.pipeline() as p:
+      queries = [ p.CalcToolAlignment("Tool.A(%s),Tool.B(%s)" % (a, b)) for (a, b) in angles ]
+    measured = np.array([ [ float(v) for v in NUMBER_RE.findall(q.data_list[0][q.data_list[0].find("("):]) ][:3] for q in queries ])
+    return client.toMachine(measured, directions=True)
+
+  async def validate(self, client, angles=CALIBRATION_ANGLES):
+    '''
+    Largest angle in degrees between the model's alignments and the server's
+    '''
+    angles = np.asarray(angles, dtype=np.float64)
+    measured = await self.measure(client, angles.tolist())
+    return float(self.errors(measured, self.alignments(angles[:,0], angles[:,1])).max())
+
+  async def calibrate(self, client, angles=CALIBRATION_ANGLES):
+    '''
+    Fit the A and B offsets and mount tilt to the server's alignments, returns the
+    largest remaining error in degrees
+    '''
+    angles = np.asarray(angles, dtype=np.float64)
+    measured = await self.measure(client, angles.tolist())
+
+    def residuals(params):
+      self._set(params)
+      return (self.alignments(angles[:,0], angles[:,1]) - measured).reshape(-1)
+
+    rotvec = Rotation.from_matrix(self.mount).as_rotvec()
+    solution = least_squares(residuals, [ self.aOffset, self.bOffset, rotvec[0], rotvec[1] ])
+    self._set(solution.x)
+    self.calibrationError = float(self.errors(measured, self.alignments(angles[:,0], angles[:,1])).max())
+    return self.calibrationError
@@ -0,0 +1,197 @@
+'''
+Run heavy post-processing (scan parsing, fitting, deviation analysis) in a process
+or thread pool so it doesn't block the event loop that reads the client's socket.
+
+  offloader = Offloader()
+  result = await offloader.scanResult(scanTransaction)
+  deviations = await offloader.run(point_deviations, result.xyz, center, radius=12.5)
+
+With the process pool, NumPy arrays are passed to workers and returned from them
+through shared memory rather than pickled. Scan data goes to the worker as its
+raw text in one shared uint8 buffer: joining the lines is the only work done on
+the event loop. Functions must be importable by the workers, i.e. defined at
+module level.
+'''
+import os
+import asyncio
+import functools
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from ipp import ScanResult, compileResponseFormat, parseScanLines
+
+# Arrays smaller than this are cheaper to pickle than to put in shared memory
+SHARED_MEMORY_MIN_BYTES = 64 * 1024
+
+
+class SharedArray:
+  """
+  Picklable description of an array held in a shared memory block
+  """
+  def __init__(self, name, shape, dtype):
+    self.name = name
+    self.shape = shape
+    self.dtype = dtype
+
+  @classmethod
+  def create(cls, array, track=True):
+    '''
+    Copy an array into a new shared memory block, returns (SharedArray, block)
+    '''
+    array = np.ascontiguousarray(array)
+    block = _shared_memory(track, create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return (cls(block.name, array.shape, array.dtype.str), block)
+
+  def attach(self, track=True):
+    '''
+    Returns (array view, block) of an existing block; close the block when done with the view
+    '''
+    block = _shared_memory(track, name=self.name)
+    return (np.ndarray(self.shape, np.dtype(self.dtype), buffer=block.buf), block)
+
+
+def _shared_memory(track, **kwargs):
+  '''
+  Blocks are unlinked by the process that owns them: the event loop's process.
+  Workers open and create them untracked where SharedMemory supports it (Python
+  3.13). Before that they register them with the resource tracker, which the
+  Offloader starts before its workers so they share it with the event loop's
+  process, and the owner's unlink unregisters them.
+  '''
+  if not track:
+    try:
+      return shared_memory.SharedMemory(track=False, **kwargs)
+    except TypeError:
+      pass
+  return shared_memory.SharedMemory(**kwargs)
+
+
+def _share(value, blocks, track=True):
+  if isinstance(value, np.ndarray):
+    if value.nbytes >= SHARED_MEMORY_MIN_BYTES:
+      (shared, block) = SharedArray.create(value, track)
+      blocks.append(block)
+      return shared
+    # may be a view into a block that is about to be closed
+    return np.array(value)
+  return value
+
+def _unshare(value, blocks):
+  if isinstance(value, SharedArray):
+    (array, block) = value.attach(track=False)
+    blocks.append(block)
+    return array
+  return value
+
+
+def _call_in_worker(fn, args, kwargs):
+  '''
+  Runs in the worker: attach shared arguments, call fn and share array results
+  '''
+  blocks = []
+  resultBlocks = []
+  try:
+    result = fn(*[ _unshare(a, blocks) for a in args ], **{ k: _unshare(v, blocks) for (k, v) in kwargs.items() })
+    if isinstance(result, tuple):
+      result = tuple(_share(r, resultBlocks, track=False) for r in result)
+    else:
+      result = _share(result, resultBlocks, track=False)
+  finally:
+    for block in blocks + resultBlocks:
+      block.close()
+  return result
+
+
+def _collect(value):
+  '''
+  Copy an array out of a block a worker created and free the block, taking over its tracking
+  '''
+  if not isinstance(value, SharedArray):
+    return value
+  (view, block) = value.attach()
+  array = view.copy()
+  del view
+  block.close()
+  block.unlink()
+  return array
+
+def _collect_result(result):
+  if isinstance(result, tuple):
+    return tuple(_collect(r) for r in result)
+  return _collect(result)
+
+def _discard_result(future):
+  '''
+  Free the blocks of a result nobody is waiting for any more
+  '''
+  if not future.cancelled() and future.exception() is None:
+    _collect_result(future.result())
+
+
+class Offloader:
+  """
+  Dispatches functions to a process pool (kind="process") or thread pool
+  (kind="thread") and returns their results as awaitables. Threads suit NumPy
+  work that releases the GIL and avoid copying; processes suit pure Python work.
+  """
+  def __init__(self, kind="process", maxWorkers=None, mpContext=None):
+    self.kind = kind
+    if kind == "process":
+      if os.name == "posix":
+        # workers inherit a running tracker instead of starting their own
+        resource_tracker.ensure_running()
+      self.executor = concurrent.futures.ProcessPoolExecutor(maxWorkers, mp_context=mpContext)
+    elif kind == "thread":
+      self.executor = concurrent.futures.ThreadPoolExecutor(maxWorkers)
+    else:
+      raise ValueError("Unknown executor kind %s" % kind)
+
+  async def run(self, fn, *args, **kwargs):
+    '''
+    Run fn(*args, **kwargs) in the pool without blocking the event loop
+    '''
+    loop = asyncio.get_running_loop()
+    if self.kind == "thread":
+      return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    blocks = []
+    try:
+      sharedArgs = [ _share(a, blocks) for a in args ]
+      sharedKwargs = { k: _share(v, blocks) for (k, v) in kwargs.items() }
+      future = self.executor.submit(_call_in_worker, fn, sharedArgs, sharedKwargs)
+      try:
+        result = await asyncio.wrap_future(future)
+      except asyncio.CancelledError:
+        # the worker may still finish, its result blocks are freed when it does
+        future.add_done_callback(_discard_result)
+        raise
+    finally:
+      for block in blocks:
+        block.close()
+        block.unlink()
+    return _collect_result(result)
+
+  async def scanResult(self, transaction, format=None):
+    '''
+    ScanResult.fromTransaction with the parsing done in the pool. format defaults to
+    the transaction's client's OnScanReport format. Only unlabeled scan data is
+    offloaded, labeled lines are parsed in place.
+    '''
+    if format is None:
+      format = transaction.client.scanReportFormat if transaction.client is not None else "X(),Y(),Z()"
+    lines = transaction.data_list
+    parser = compileResponseFormat(format)
+    if not lines or "(" in lines[0] or parser.width is None:
+      return ScanResult.fromLines(lines, format)
+    text = np.frombuffer("".join(lines).encode("ascii"), dtype=np.uint8)
+    return ScanResult(await self.run(parseScanLines, text, parser.width), format)
+
+  def shutdown(self, wait=True):
+    self.executor.shutdown(wait=wait)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.shutdown()
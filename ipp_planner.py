@@ -0,0 +1,136 @@
+'''
+Order PtMeas targets to minimize air moves and head reorientation between them.
+
+  plan = plan_measurements(positions, normals, alignments, start=currentPosition)
+  points = await run_probe_plan(client, plan.commands)
+
+Each target is probed from an approach point clearance along its normal: the plan
+moves to the approach point (aligning the tool when an alignment is given), measures
+and retracts back to it before moving on. The estimated time from one target to the
+next is the straight line distance between their approach points at the GoTo speed
+plus the angle between their tool alignments at the head's angular speed. Moves
+aren't checked for collisions with the part.
+
+The order is found with a nearest neighbor tour improved by 2-opt, both working on
+an N x N cost matrix, so memory grows with the square of the number of targets
+(about 8 MB per thousand targets squared).
+'''
+from collections import namedtuple
+import numpy as np
+from ipp import toPointArray
+
+MeasurementPlan = namedtuple("MeasurementPlan", [ "order", "commands", "cost", "initialCost" ])
+
+
+def travel_costs(points, alignments=None, speed=100.0, angularSpeed=90.0):
+  '''
+  N x N matrix of estimated seconds between points (mm) with optional tool alignments,
+  speed in mm/s and angularSpeed in degrees/s
+  '''
+  points = toPointArray(points)
+  squared = (points * points).sum(axis=1)
+  distances = np.sqrt(np.maximum(squared[:,None] + squared[None,:] - 2 * points @ points.T, 0))
+  costs = distances / speed
+  if alignments is not None:
+    alignments = toPointArray(alignments)
+    alignments = alignments / np.linalg.norm(alignments, axis=1)[:,None]
+    angles = np.degrees(np.arccos(np.clip(alignments @ alignments.T, -1, 1)))
+    costs += angles / angularSpeed
+  return costs
+
+
+def path_cost(order, costs):
+  order = np.asarray(order)
+  return float(costs[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbor(costs, start=0):
+  '''
+  Path through every node of costs starting at start, always moving to the cheapest unvisited node
+  '''
+  n = len(costs)
+  visited = np.zeros(n, dtype=bool)
+  order = np.empty(n, dtype=np.intp)
+  order[0] = current = start
+  visited[start] = True
+  for i in range(1, n):
+    row = np.where(visited, np.inf, costs[current])
+    order[i] = current = int(np.argmin(row))
+    visited[current] = True
+  return order
+
+
+def two_opt(order, costs, maxPasses=50):
+  '''
+  Improve a path with fixed first and last nodes by reversing segments while that
+  shortens it. Each step evaluates every segment starting at one edge at once.
+  Costs must be symmetric.
+  '''
+  order = np.array(order)
+  n = len(order)
+  for p in range(maxPasses):
+    improved = False
+    for i in range(n - 3):
+      # replacing edges (a, b) and (c, d) with (a, c) and (b, d) reverses b..c
+      a = order[i]
+      b = order[i + 1]
+      c = order[i + 2:n - 1]
+      d = order[i + 3:n]
+      deltas = costs[a, c] + costs[b, d] - costs[a, b] - costs[c, d]
+      j = int(np.argmin(deltas))
+      if deltas[j] < -1e-12:
+        order[i + 1:i + j + 3] = order[i + 1:i + j + 3][::-1]
+        improved = True
+    if not improved:
+      break
+  return order
+
+
+def _format(values):
+  return ",".join("%s" % v for v in values)
+
+def plan_measurements(positions, normals, alignments=None, start=None, clearance=5.0, speed=100.0, angularSpeed=90.0, maxPasses=50):
+  '''
+  Order PtMeas targets (positions with IJK normals and optional tool alignments, each
+  N x 3 arrays, float3Arrays or lists of float3) starting from start, and build the
+  GoTo and PtMeas commands to measure them, see the module docstring. Returns a
+  MeasurementPlan with the order as indices into the targets, the commands as
+  (command, arguments) pairs for ipp_routines.run_probe_plan, and the estimated
+  seconds of travel in that order and in the given order.
+  '''
+  positions = toPointArray(positions)
+  if len(positions) == 0:
+    return MeasurementPlan(np.empty(0, int), [], 0.0, 0.0)
+  normals = toPointArray(normals)
+  normals = normals / np.linalg.norm(normals, axis=1)[:,None]
+  approaches = positions + clearance * normals
+  n = len(positions)
+
+  # node 0 is the start and node n + 1 a free end, so the path may finish anywhere
+  nodes = np.vstack([ approaches[:1] if start is None else np.asarray(start, dtype=np.float64).reshape(1, 3), approaches, approaches[:1] ])
+  nodeAlignments = None
+  if alignments is not None:
+    alignments = toPointArray(alignments)
+    nodeAlignments = np.vstack([ alignments[:1], alignments, alignments[:1] ])
+  costs = travel_costs(nodes, nodeAlignments, speed, angularSpeed)
+  if start is None:
+    # start at whichever target the tour picks first
+    costs[0,:] = costs[:,0] = 0
+  costs[-1,:] = costs[:,-1] = 0
+
+  initial = np.arange(n + 2)
+  path = nearest_neighbor(costs[:-1,:-1], 0)
+  path = two_opt(np.append(path, n + 1), costs, maxPasses)
+  order = path[1:-1] - 1
+
+  commands = []
+  for t in order.tolist():
+    approach = "X(%s),Y(%s),Z(%s)" % tuple(approaches[t].tolist())
+    if alignments is not None:
+      commands.append(("GoTo", "%s,Tool.Alignment(%s)" % (approach, _format(alignments[t].tolist()))))
+    else:
+      commands.append(("GoTo", approach))
+    commands.append(("PtMeas", "X(%s),Y(%s),Z(%s),IJK(%s)" % (tuple(positions[t].tolist()) + (_format(normals[t].tolist()),))))
+    commands.append(("GoTo", approach))
+
+  return MeasurementPlan(order, commands, path_cost(path, costs), path_cost(initial, costs))
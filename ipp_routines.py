@@ -3,12 +3,13 @@ A set of routines that perform common command sequeunces and can be used in cons
 '''
 import sys
 import ipp
-from ipp import Client, TransactionCallbacks, waitForEvent, setEvent, waitForCommandComplete, float3, CmmException
+from ipp import Client, TransactionCallbacks, waitForEvent, setEvent, waitForCommandComplete, float3, float3Array, CmmException, readPointData
 import asyncio
 from tornado.ioloop import IOLoop
 import math
 from scipy.spatial.transform import Rotation as R
 import numpy as np
+from ipp_kinematics import HeadKinematics
 import logging
 logger = logging.getLogger(__name__)
 
@@ -17,43 +18,62 @@ HOST = "10.0.0.1"
 PORT = 1294
 
 async def set_part_csy(client, csy):
-  await client.SetCsyTransformation("PartCsy, %s, %s, %s, %s, %s, %s" % (csy.x, csy.y, csy.z, csy.theta, csy.psi, csy.phi)).complete()
-  await client.SetCoordSystem("PartCsy").complete()
+  '''
+  Make csy the server's active PartCsy. Nothing is sent if the client already mirrors it,
+  otherwise both commands go out together and cost one round trip.
+  '''
+  current = client.partCsy
+  if client.coordSystem == "PartCsy" and current is not None and \
+      (current.x, current.y, current.z, current.theta, current.psi, current.phi) == (csy.x, csy.y, csy.z, csy.theta, csy.psi, csy.phi):
+    return
+  transformation = client.SetCsyTransformation("PartCsy, %s, %s, %s, %s, %s, %s" % (csy.x, csy.y, csy.z, csy.theta, csy.psi, csy.phi)).complete()
+  coordSystem = client.SetCoordSystem("PartCsy").complete()
+  await transformation
+  await coordSystem
 
 async def probe_sphere_relative(client, radius):
+  '''
+  Probe the top and three sides of a sphere below the current position, along the
+  machine axes. The probing is planned in machine coordinates and converted to the
+  server's active coordinate system locally rather than switching it to MachineCsy.
+  Returns the points in machine coordinates.
+  '''
   pts = []
 
-  await client.SetCoordSystem("MachineCsy").complete()
+  await client.syncCoordSystem()
   await client.SetProp("Tool.PtMeasPar.HeadTouch(0)").ack()
   getCurrPosCmd = await client.Get("X(),Y(),Z()").data()
-  start_pos = float3.FromXYZString(getCurrPosCmd.data_list[0])
-  pt_meas = await client.PtMeas("%s,IJK(0,0,1)" % ((start_pos + float3(0, 0, -10)).ToXYZString())).data()
-  top_pt = float3.FromXYZString(pt_meas.data_list[0])
+  start_pos = client.toMachine(float3.FromXYZString(getCurrPosCmd.data_list[0]))
+
+  def goTo(pos):
+    return client.GoTo(client.fromMachine(pos).ToXYZString())
+
+  async def ptMeas(pos, normal):
+    pt_meas = await client.PtMeas("%s,%s" % (client.fromMachine(pos).ToXYZString(), client.fromMachine(normal, directions=True).ToIJKString())).data()
+    return client.toMachine(float3.FromXYZString(pt_meas.data_list[0]))
+
+  top_pt = await ptMeas(start_pos + float3(0, 0, -10), float3(0, 0, 1))
 
   pts.append(top_pt)
 
   #from CNC +X (probe in -X)
-  await client.GoTo((top_pt + float3(radius + 5, 0, 5)).ToXYZString()).ack()
-  await client.GoTo((top_pt + float3(radius + 5, 0, -radius)).ToXYZString()).ack()
-  pt_meas = await self.client.PtMeas("%s,IJK(1,0,0)" % ((top_pt + float3(radius, 0, -radius)).ToXYZString())).data()
-  pt = float3.FromXYZString(pt_meas.data_list[0])
-  pts.append(pt)
+  await goTo(top_pt + float3(radius + 5, 0, 5)).ack()
+  await goTo(top_pt + float3(radius + 5, 0, -radius)).ack()
+  pts.append(await ptMeas(top_pt + float3(radius, 0, -radius), float3(1, 0, 0)))
 
   #from CNC +Y (probe in -Y)
-  await client.GoTo((top_pt + float3(radius + 5, radius +5, -radius)).ToXYZString()).ack()
-  await client.GoTo((top_pt + float3(0, radius +5, -radius)).ToXYZString()).ack()
-  pt_meas = await client.PtMeas("%s,IJK(0,1,0)" % ((top_pt + float3(0, radius, -radius)).ToXYZString())).data()
-  pt = float3.FromXYZString(pt_meas.data_list[0])
-  pts.append(pt)
+  await goTo(top_pt + float3(radius + 5, radius +5, -radius)).ack()
+  await goTo(top_pt + float3(0, radius +5, -radius)).ack()
+  pts.append(await ptMeas(top_pt + float3(0, radius, -radius), float3(0, 1, 0)))
 
   #from CNC -X (probe in +X)
-  await client.GoTo((top_pt + float3(-(radius + 5), radius +5, -radius)).ToXYZString()).ack()
-  await client.GoTo((top_pt + float3(-(radius + 5), 0, -radius)).ToXYZString()).ack()
-  pt_meas = await client.PtMeas("%s,IJK(-1,0,0)" % ((top_pt + float3(-radius, 0, -radius)).ToXYZString())).data()
-  pt = float3.FromXYZString(pt_meas.data_list[0])
-  pts.append(pt)
+  await goTo(top_pt + float3(-(radius + 5), radius +5, -radius)).ack()
+  await goTo(top_pt + float3(-(radius + 5), 0, -radius)).ack()
+  pts.append(await ptMeas(top_pt + float3(-radius, 0, -radius), float3(-1, 0, 0)))
 
-  await client.GoTo(start_pos.ToXYZString()).complete()
+  # back up over the sphere rather than through it
+  await goTo(top_pt + float3(-(radius + 5), 0, 5)).ack()
+  await goTo(start_pos).complete()
 
   return pts
 
@@ -119,29 +139,65 @@ async def ensure_tool_loaded(client,toolName):
 # async def probeLineInParallelPlane(client, startPos, lineVec, length, clearance, direction, plane):
 
 
-async def probe_line(client, startPos, lineVec, faceNorm, length, clearance, numPoints, direction):
+def _format_rows(template, *columns):
+  '''
+  One command argument string per row of the given float3Arrays or N x k arrays
+  '''
+  rows = np.column_stack([ np.asarray(c, dtype=np.float64).reshape(len(c), -1) for c in columns ]).tolist()
+  return [ template % tuple(row) for row in rows ]
+
+def _line_positions(startPos, lineVec, length, numPoints):
+  return startPos + float3Array.outer(np.linspace(0, length, numPoints), lineVec)
+
+async def run_probe_plan(client, plan, pipelined=True):
+  '''
+  Runs a plan, a list of (command, arguments) pairs such as ("GoTo", "X(1),Y(2),Z(3)"),
+  and returns the points measured by its PtMeas commands in order.
+
+  Pipelined, the whole plan is written back-to-back so the server never idles waiting
+  for the next command, and the results are read as they arrive. An error stops the
+  plan with the first CmmException once every command has settled. With pipelined
+  False each command completes before the next is sent.
+  '''
+  if not pipelined:
+    points = []
+    for (command, arguments) in plan:
+      transaction = await getattr(client, command)(arguments).complete()
+      if command == "PtMeas":
+        points.append(float3.FromXYZString(transaction.data_list[0]))
+    return points
+
+  async with client.pipeline() as p:
+    measurements = [ getattr(p, command)(arguments) for (command, arguments) in plan ]
+  return [ float3.FromXYZString(t.data_list[0]) for ((command, arguments), t) in zip(plan, measurements) if command == "PtMeas" ]
+
+
+async def probe_line(client, startPos, lineVec, faceNorm, length, clearance, numPoints, direction, pipelined=True):
   '''
   uses CMM motion
   '''
   toolLength = 117.8
   global points
-  points = []
 
   startApproachPos = startPos + faceNorm * clearance
-  probeAlignVec = float3(np.cross(lineVec,faceNorm))*direction
-
-  await client.GoTo("Tool.Alignment(%s, %s, %s, %s,%s,%s)" % ( -probeAlignVec.x, -probeAlignVec.y, -probeAlignVec.z, -faceNorm.x,-faceNorm.y,-faceNorm.z )).complete()
-  await client.GoTo("%s" % ( startApproachPos.ToXYZString() )).complete()
-  await client.SetProp("Tool.PtMeasPar.HeadTouch(0)").complete()
-  for step in range(numPoints):
-    fracLen = step / numPoints * length
-    approachPos = startApproachPos + lineVec * (step / (numPoints-1) * length)
-    contactPos = startPos + lineVec * (step / (numPoints-1) * length)
-    logger.debug("ContactPos %s" % contactPos)
-    await client.GoTo("X(%s),Y(%s),Z(%s),Tool.Alignment(%s, %s, %s, %s,%s,%s)" % (approachPos.x,approachPos.y,approachPos.z, -probeAlignVec.x, -probeAlignVec.y, -probeAlignVec.z, -faceNorm.x,-faceNorm.y,-faceNorm.z)).complete()
-    ptMeas = await client.PtMeas("X(%s),Y(%s),Z(%s),IJK(%s,%s,%s)" % (contactPos.x,contactPos.y,contactPos.z,faceNorm.x,faceNorm.y,faceNorm.z)).complete()
-    pt = float3.FromXYZString(ptMeas.data_list[0])
-    points.append(pt)
+  probeAlignVec = lineVec.cross(faceNorm)*direction
+  alignment = "Tool.Alignment(%s, %s, %s, %s,%s,%s)" % ( -probeAlignVec.x, -probeAlignVec.y, -probeAlignVec.z, -faceNorm.x,-faceNorm.y,-faceNorm.z )
+
+  contactPositions = _line_positions(startPos, lineVec, length, numPoints)
+  approachPositions = contactPositions + faceNorm * clearance
+  goTos = _format_rows("X(%s),Y(%s),Z(%s)," + alignment, approachPositions)
+  ptMeases = _format_rows("X(%%s),Y(%%s),Z(%%s),IJK(%s,%s,%s)" % (faceNorm.x,faceNorm.y,faceNorm.z), contactPositions)
+
+  plan = [
+    ("GoTo", alignment),
+    ("GoTo", startApproachPos.ToXYZString()),
+    ("SetProp", "Tool.PtMeasPar.HeadTouch(0)"),
+  ]
+  for (goTo, ptMeas) in zip(goTos, ptMeases):
+    plan.append(("GoTo", goTo))
+    plan.append(("PtMeas", ptMeas))
+
+  points = await run_probe_plan(client, plan, pipelined)
   return points
 
 
@@ -155,20 +211,19 @@ async def omni_headprobe_line(client, startPos, lineVec, faceNorm, length, conta
   '''
   return False
 
-async def headline(client, startPos, lineVec, length, face_norm, numPoints, direction, clearance, angle=0):
+async def headline(client, startPos, lineVec, length, face_norm, numPoints, direction, clearance, angle=0, pipelined=True):
   '''
   headline
   '''
   logger.debug('headline')
   toolLength = 117.8
-  points = []
 
   lineVec = lineVec.normalize()
 
   midPos = startPos + (0.5 * length) * lineVec
   logger.debug('midPos %s' % (midPos,))
 
-  perpVec = float3(direction*np.cross(lineVec,face_norm)).normalize()
+  perpVec = (direction*lineVec.cross(face_norm)).normalize()
   logger.debug('perpVec %s' % (perpVec,))
 
   r = R.from_rotvec(math.radians(angle)*lineVec)
@@ -178,19 +233,17 @@ async def headline(client, startPos, lineVec, length, face_norm, numPoints, dire
   midPosApproach = midPos + clearance*face_norm
   logger.debug('midPosApproach %s' % (midPosApproach,))
 
-  await client.GoTo("X(%s),Y(%s),Z(%s),Tool.Alignment(%s,%s,%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, rot_perp_vec[0],rot_perp_vec[1],rot_perp_vec[2])).complete()
-  await client.SetProp("Tool.PtMeasPar.HeadTouch(1)").complete()
-  for step in range(numPoints):
-    fracLen = step / numPoints * length
-    contactPos = startPos + lineVec * (step / (numPoints-1) * length)
-    ptMeas = await client.PtMeas("X(%s),Y(%s),Z(%s),IJK(%s,%s,%s)" % (contactPos.x,contactPos.y,contactPos.z,face_norm.x,face_norm.y,face_norm.z)).complete()
-    pt = float3.FromXYZString(ptMeas.data_list[0])
-    points.append(pt)
-  return points
+  contactPositions = _line_positions(startPos, lineVec, length, numPoints)
+  plan = [
+    ("GoTo", "X(%s),Y(%s),Z(%s),Tool.Alignment(%s,%s,%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, rot_perp_vec[0],rot_perp_vec[1],rot_perp_vec[2])),
+    ("SetProp", "Tool.PtMeasPar.HeadTouch(1)"),
+  ]
+  plan.extend(("PtMeas", ptMeas) for ptMeas in _format_rows("X(%%s),Y(%%s),Z(%%s),IJK(%s,%s,%s)" % (face_norm.x,face_norm.y,face_norm.z), contactPositions))
+  return await run_probe_plan(client, plan, pipelined)
 
 
 
-async def headprobe_line_xz(client, startPos, lineVec, length, faceNorm, numPoints, direction, headPos, aAngle=90):
+async def headprobe_line_xz(client, startPos, lineVec, length, faceNorm, numPoints, direction, headPos, aAngle=90, pipelined=True):
   '''
   headProbeLine for faces (approximately) parallel to CMM Y-axis
   line up A-90, B-0 (or B-180) with mid pos
@@ -205,7 +258,6 @@ async def headprobe_line_xz(client, startPos, lineVec, length, faceNorm, numPoin
   '''
   logger.debug('headprobe_line_xz 1')
   toolLength = 117.8
-  points = []
 
   midPos = startPos + (0.5 * length) * lineVec
   logger.debug('midPos %s' % (midPos,))
@@ -217,29 +269,19 @@ async def headprobe_line_xz(client, startPos, lineVec, length, faceNorm, numPoin
 
   midPosContactAngle = math.atan2(direction*lineVec.z, direction*lineVec.y)*180/math.pi
   midPosB = 0 if headPos < 0 else 180
-  await client.GoTo("X(%s),Y(%s),Z(%s),Tool.A(%s),Tool.B(%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, aAngle, midPosB)).complete()
   # xyToolLength = toolLength * math.sin(probeAngle*math.pi/180)
   # centerRot = midPosApproach + float3(xyToolLength * math.sin(midPosAngle),xyToolLength * math.cos(midPosAngle),0)
-  # logger.debug(midPosApproach)
-  # logger.debug(centerRot)
-  # input()
-  await client.SetProp("Tool.PtMeasPar.HeadTouch(1)").complete()
-  # input()
-  for step in range(numPoints):
-    fracLen = step / numPoints * length
-    contactPos = startPos + lineVec * (step / (numPoints-1) * length)
-    logger.debug("ContactPos %s" % contactPos)
-    # probeTravelVec = contactPos - centerRot
-    # approachPos = contactPos - (0.5*probeTravelVec)
-    # logger.debug("ApproachPos %s" % approachPos)
-    # input()
-    ptMeas = await client.PtMeas("X(%s),Y(%s),Z(%s),IJK(%s,%s,%s)" % (contactPos.x,contactPos.y,contactPos.z,perpVec.x,perpVec.y,perpVec.z)).complete()
-    pt = float3.FromXYZString(ptMeas.data_list[0])
-    points.append(pt)
-  return points
+  contactPositions = _line_positions(startPos, lineVec, length, numPoints)
+  logger.debug("ContactPositions %s" % contactPositions)
+  plan = [
+    ("GoTo", "X(%s),Y(%s),Z(%s),Tool.A(%s),Tool.B(%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, aAngle, midPosB)),
+    ("SetProp", "Tool.PtMeasPar.HeadTouch(1)"),
+  ]
+  plan.extend(("PtMeas", ptMeas) for ptMeas in _format_rows("X(%%s),Y(%%s),Z(%%s),IJK(%s,%s,%s)" % (perpVec.x,perpVec.y,perpVec.z), contactPositions))
+  return await run_probe_plan(client, plan, pipelined)
 
 
-async def headprobe_line_yz(client, startPos, lineVec, length, faceNorm, numPoints, direction):
+async def headprobe_line_yz(client, startPos, lineVec, length, faceNorm, numPoints, direction, pipelined=True):
   '''
   headProbeLine for faces (approximately) parallel to CMM X-axis
   line up A-90, B-0 (or B-180) with mid pos
@@ -253,33 +295,40 @@ async def headprobe_line_yz(client, startPos, lineVec, length, faceNorm, numPoin
   line up b-perp-to-lineVec
   '''
   toolLength = 117.8
-  points = []
 
   midPos = startPos + (0.5 * length) * lineVec
 
   perpVec = float3(-1 * direction * lineVec.z, lineVec.y, direction*lineVec.x).normalize()
   midPosApproach = midPos + perpVec * 10
   midPosB = -90 if direction < 0 else 90
-  await client.GoTo("X(%s),Y(%s),Z(%s),Tool.A(%s),Tool.B(%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, 90, midPosB)).ack()
-  await client.SetProp("Tool.PtMeasPar.HeadTouch(1)").complete()
-
-  for step in range(numPoints):
-    fracLen = step / numPoints * length
-    contactPos = startPos + lineVec * (step / (numPoints-1) * length)
-    logger.debug("ContactPos %s" % contactPos)
-    ptMeas = await client.PtMeas("X(%s),Y(%s),Z(%s),IJK(%s,%s,%s)" % (contactPos.x,contactPos.y,contactPos.z,perpVec.x,0,perpVec.z)).complete()
-    pt = float3.FromXYZString(ptMeas.data_list[0])
-    points.append(pt)
-  return points
+
+  contactPositions = _line_positions(startPos, lineVec, length, numPoints)
+  logger.debug("ContactPositions %s" % contactPositions)
+  plan = [
+    ("GoTo", "X(%s),Y(%s),Z(%s),Tool.A(%s),Tool.B(%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, 90, midPosB)),
+    ("SetProp", "Tool.PtMeasPar.HeadTouch(1)"),
+  ]
+  plan.extend(("PtMeas", ptMeas) for ptMeas in _format_rows("X(%%s),Y(%%s),Z(%%s),IJK(%s,%s,%s)" % (perpVec.x,0,perpVec.z), contactPositions))
+  return await run_probe_plan(client, plan, pipelined)
+
+
+def head_b_angles(kinematics, directions, reference):
+  '''
+  B angles pointing the probe along directions (N x 3), in the head routines' B
+  convention (90 degrees behind the head model's), within 180 degrees of reference
+  '''
+  (a, b) = kinematics.angles(directions)
+  return reference + (b - 90 - reference + 180) % 360 - 180
 
 
-async def headprobe_line(client, startPos, lineVec, length, clearance, numPoints, surfaceWidth, direction, probeAngle):
+async def headprobe_line(client, startPos, lineVec, length, clearance, numPoints, surfaceWidth, direction, probeAngle, pipelined=True, kinematics=None):
   '''
-  only works for horizontal (constant Z) lines
+  only works for horizontal (constant Z) lines, kinematics is the HeadKinematics
+  model, the nominal head if not given
   '''
+  kinematics = HeadKinematics() if kinematics is None else kinematics
   toolLength = 117.8
   global points
-  points = []
 
 
   # angle = 2*180/math.pi*math.atan(0.5*length/clearance)
@@ -287,34 +336,23 @@ async def headprobe_line(client, startPos, lineVec, length, clearance, numPoints
   perpVec = float3(-1 * direction * lineVec.y, direction * lineVec.x, lineVec.z).normalize()
   midPosApproach = midPos + perpVec * clearance
   midPosAngle = math.atan2(-1*direction*lineVec.x, direction*lineVec.y)*180/math.pi
-  await client.GoTo("X(%s),Y(%s),Z(%s),Tool.A(%s),Tool.B(%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, 0, midPosAngle)).ack()
   xyToolLength = toolLength * math.sin(probeAngle*math.pi/180)
   centerRot = midPosApproach + float3(xyToolLength * math.sin(midPosAngle),xyToolLength * math.cos(midPosAngle),0)
-  # input()
   # await client.SetProp("Tool.PtMeasPar.HeadTouch(1)").ack()
-  # input()
-  for step in range(numPoints):
-    fracLen = step / (numPoints-1) * length
-    contactPos = startPos + lineVec * (step / (numPoints-1) * length)
-    len_on_face_from_mid_pos = direction * (0.5 * length - fracLen)
-    b_angle = midPosAngle - math.atan2(len_on_face_from_mid_pos,clearance) * 180/math.pi
-    await client.GoTo("Tool.A(%s),Tool.B(%s)" % ( 2, b_angle)).complete()
-
-    # probeTravelVec = contactPos - centerRot
-    # # approachPos = contactPos - (0.5*probeTravelVec)
-    # approachPos = contactPos - (0.5*probeTravelVec)
-    # logger.debug("ApproachPos %s" % approachPos)
-    # # input()
-    # try:
-    #   await client.GoTo("Tool.A(%s)" % ( probeAngle -2 )).ack()
-    #   ptMeas = await client.PtMeas("X(%s),Y(%s),Z(%s),IJK(%s,%s,%s)" % (contactPos.x,contactPos.y,contactPos.z,perpVec.x,perpVec.y,0)).complete()
-    # except CmmException as e:
-    #   logger.debug("CmmException in headProbeLine, raising")
-    #   raise e
-    ptMeas = await client.PtMeas("X(%s),Y(%s),Z(%s),IJK(%s,%s,%s)" % (contactPos.x,contactPos.y,contactPos.z,perpVec.x,perpVec.y,0)).data()
-    pt = float3.FromXYZString(ptMeas.data_list[0])
-    points.append(pt)
-    await client.GoTo("Tool.A(0)").send()
+
+  # B angle that points the probe at each contact from the approach position
+  contactPositions = _line_positions(startPos, lineVec, length, numPoints)
+  b_angles = head_b_angles(kinematics, (contactPositions - midPosApproach).array * (1, 1, 0), midPosAngle)
+  goTos = _format_rows("Tool.A(2),Tool.B(%s)", b_angles)
+  ptMeases = _format_rows("X(%%s),Y(%%s),Z(%%s),IJK(%s,%s,%s)" % (perpVec.x,perpVec.y,0), contactPositions)
+
+  plan = [ ("GoTo", "X(%s),Y(%s),Z(%s),Tool.A(%s),Tool.B(%s)" % ( midPosApproach.x, midPosApproach.y, midPosApproach.z, 0, midPosAngle)) ]
+  for (goTo, ptMeas) in zip(goTos, ptMeases):
+    plan.append(("GoTo", goTo))
+    plan.append(("PtMeas", ptMeas))
+    plan.append(("GoTo", "Tool.A(0)"))
+
+  points = await run_probe_plan(client, plan, pipelined)
   return points
 
 
@@ -335,21 +373,12 @@ Foreach angular step
   Find the expected contact point: intersection of line from midpoint along angle with feature line
   Step back on this line a fraction to define the approach point
 '''
-async def headOnlyLineOnVerticalFace(client, startPos, lineVec, length, numPoints, surfaceWidth, direction, probeAngle):
-
-  global calcToolAlignmentData
-
-  async def getData(data):
-    global calcToolAlignmentData
-    logger.debug("getData")
-    logger.debug(data)
-    calcToolAlignmentData = data[data.find("(") + 1:data.find("))") - 2]
-
-  getPosDataCallback = getData
-  await waitForCommandComplete(client.CalcToolAlignment, "Tool.A(15),Tool.B(-90)", otherCallbacks={'data': getData})
+async def headOnlyLineOnVerticalFace(client, startPos, lineVec, length, numPoints, surfaceWidth, direction, probeAngle, kinematics=None):
+  kinematics = HeadKinematics() if kinematics is None else kinematics
 
+  # tool alignments come from the local head model rather than CalcToolAlignment
   logger.debug("------------------------------")
-  logger.debug("calcToolAlignmentData: %s" % calcToolAlignmentData)
+  logger.debug("tool alignment: %s" % kinematics.alignment(15, -90))
 
   #perpendicular vector in XY plane
   logger.debug("startPos %s " % startPos)
@@ -378,10 +407,7 @@ async def headOnlyLineOnVerticalFace(client, startPos, lineVec, length, numPoint
   async def ptMeasData(data):
     global points
     logger.debug("ptmeas: %s" % data)
-    x = float(data[data.find("X(") + 2 : data.find("), Y")])
-    y = float(data[data.find("Y(") + 2 : data.find("), Z")])
-    z = float(data[data.find("Z(") + 2 : data.find(")\r\n")])
-    pt = float3(x,y,z)
+    pt = readPointData(data)
     points.append(pt)
 
   startAngle = -90 + halfAngle
@@ -390,13 +416,13 @@ async def headOnlyLineOnVerticalFace(client, startPos, lineVec, length, numPoint
   endPos = startPos + lineVec * length
   endPosApproach = endPos + perpVec * 10
 
-  await waitForCommandComplete(client.CalcToolAlignment, "Tool.A(15),Tool.B(%s)" % startAngle, otherCallbacks={'data': getData})
+  logger.debug("tool alignment: %s" % kinematics.alignment(15, startAngle))
   await waitForCommandComplete(client.PtMeas, "X(%s),Y(%s),Z(%s),IJK(0.371,.928,-0.16)" % (startPosApproach.x,startPosApproach.y,startPosApproach.z), otherCallbacks={'data': ptMeasData})
   input()
-  await waitForCommandComplete(client.CalcToolAlignment, "Tool.A(15),Tool.B(%s)" % -90, otherCallbacks={'data': getData})
+  logger.debug("tool alignment: %s" % kinematics.alignment(15, -90))
   await waitForCommandComplete(client.PtMeas, "X(%s),Y(%s),Z(%s),IJK(0.99,0,-0.16)" % (midPosApproach.x,midPosApproach.y,midPosApproach.z), otherCallbacks={'data': ptMeasData})
   input()
-  await waitForCommandComplete(client.CalcToolAlignment, "Tool.A(15),Tool.B(%s)" % (-90 - halfAngle)  , otherCallbacks={'data': getData})
+  logger.debug("tool alignment: %s" % kinematics.alignment(15, -90 - halfAngle))
   await waitForCommandComplete(client.PtMeas, "X(%s),Y(%s),Z(%s),IJK(0.371,-.928,-0.16)" % (endPosApproach.x,endPosApproach.y,endPosApproach.z), otherCallbacks={'data': ptMeasData})
   # await waitForCommandComplete(client.PtMeas, "X(%s),Y(%s),Z(%s),IJK(-0.096,0.24,0),Tool.Alignment(%s)" % (midPosApproach.x,midPosApproach.y,midPosApproach.z,calcToolAlignmentData), otherCallbacks={'data': ptMeasData})
 
@@ -0,0 +1,851 @@
+'''
+A simulated I++ DME server for running the client, routines and benchmarks without a CMM.
+  python ipp_server.py [port]
+
+Main queue commands are acked as they arrive and executed one at a time, fast queue
+(E tag) commands are answered immediately. Probing and scanning intersect the probe's
+path with a synthetic part made of planes, spheres and cylinders.
+'''
+import sys
+import re
+import math
+import asyncio
+import logging
+import traceback
+from collections import deque
+import numpy as np
+from ipp import Csy, NUMBER_RE, FORMAT_FIELD_RE, IPP_ACK_CHAR, IPP_COMPLETE_CHAR, IPP_DATA_CHAR, IPP_ERROR_CHAR
+
+logger = logging.getLogger(__name__)
+
+PORT = 1294
+
+# Field with its arguments, like X(1.5) or Tool.Alignment(0,0,1)
+ARGUMENT_RE = re.compile(r'([A-Za-z_][\w.]*)\(([^()]*)\)')
+
+ERR_ILLEGAL_COMMAND = (2, 6, "Illegal command")
+ERR_ARGUMENTS = (2, 7, "Illegal arguments")
+ERR_ERROR_STATE = (2, 500, "Use ClearAllErrors to continue")
+ERR_ABORTED = (2, 501, "Transaction aborted")
+ERR_NOT_HOMED = (2, 502, "Machine not homed")
+ERR_PROPERTY = (2, 1000, "Property not supported")
+ERR_TOOL = (2, 1001, "Tool not found")
+ERR_OUT_OF_VOLUME = (2, 1005, "Position out of machine volume")
+ERR_SURFACE_NOT_FOUND = (2, 1006, "Surface not found")
+ERR_COLLISION = (3, 1009, "Collision")
+
+DEFAULT_PROPS = {
+  "Tool.GoToPar.Speed": 100.0,
+  "Tool.GoToPar.Accel": 500.0,
+  "Tool.PtMeasPar.Speed": 10.0,
+  "Tool.PtMeasPar.Accel": 100.0,
+  "Tool.PtMeasPar.Approach": 2.0,
+  "Tool.PtMeasPar.Search": 4.0,
+  "Tool.PtMeasPar.Retract": 2.0,
+  "Tool.PtMeasPar.HeadTouch": 0.0,
+  "Tool.ScanPar.Speed": 10.0,
+  "Tool.ScanPar.Accel": 100.0,
+}
+
+DEFAULT_TOOLS = {
+  "UnDefTool": 0.0,
+  "RefTool": 0.0,
+  "Component_3.1.50.4.A0.0-B0.0": 1.5,
+}
+
+# Commands that are accepted but have no effect in the simulation
+NOOP_COMMANDS = {
+  "StartSession", "StopDaemon", "StopAllDaemons", "EnableUser", "DisableUser", "ReQualify",
+  "ScanOnLineHint", "ScanOnCircleHint", "ScanOnCurveHint", "ScanUnknownHint", "ScanOnCurveDensity",
+  "ScanUnknownDensity", "UseSmallestAngleToAlignTool",
+}
+
+FAST_COMMANDS = { "AbortE", "GetErrStatusE", "GetPropE" }
+
+
+class DmeError(Exception):
+  """
+  An error the simulated DME reports for the command it is executing
+  """
+  def __init__(self, error, detail=None):
+    (self.severity, self.code, self.text) = error
+    if detail:
+      self.text = "%s: %s" % (self.text, detail)
+    super().__init__(self.text)
+
+
+def _rows(a):
+  return np.atleast_2d(np.asarray(a, dtype=np.float64))
+
+def _normalize(v):
+  v = np.asarray(v, dtype=np.float64)
+  return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+def _dot(a, b):
+  return np.einsum('ij,ij->i', a, b)
+
+
+class Plane:
+  """
+  Infinite plane through point with the given normal, touchable from either side
+  """
+  def __init__(self, point, normal):
+    self.point = np.asarray(point, dtype=np.float64)
+    self.normal = _normalize(normal)
+
+  def intersect(self, origins, directions):
+    '''
+    Distance along each ray to the plane, inf for rays that miss, and the surface normals facing the rays
+    '''
+    denom = directions @ self.normal
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = ((self.point - origins) @ self.normal) / denom
+    t[~(t >= 0)] = np.inf
+    normals = np.where((denom > 0)[:,None], -self.normal, self.normal)
+    return (t, normals)
+
+
+class Sphere:
+  """
+  Sphere, touchable from outside or from inside
+  """
+  def __init__(self, center, radius):
+    self.center = np.asarray(center, dtype=np.float64)
+    self.radius = float(radius)
+
+  def intersect(self, origins, directions):
+    oc = origins - self.center
+    b = _dot(oc, directions)
+    disc = b*b - (_dot(oc, oc) - self.radius*self.radius)
+    with np.errstate(invalid='ignore'):
+      root = np.sqrt(disc)
+    t = -b - root
+    t = np.where(t >= 0, t, -b + root)
+    t[~(t >= 0)] = np.inf
+    normals = (origins + directions * np.where(np.isfinite(t), t, 0)[:,None] - self.center) / self.radius
+    normals = np.where((_dot(normals, directions) > 0)[:,None], -normals, normals)
+    return (t, normals)
+
+
+class Cylinder:
+  """
+  Open cylinder of the given length from point along axis, touchable from outside or from inside
+  """
+  def __init__(self, point, axis, radius, length):
+    self.point = np.asarray(point, dtype=np.float64)
+    self.axis = _normalize(axis)
+    self.radius = float(radius)
+    self.length = float(length)
+
+  def intersect(self, origins, directions):
+    axis = self.axis
+    oc = origins - self.point
+    d = directions - np.outer(directions @ axis, axis)
+    o = oc - np.outer(oc @ axis, axis)
+    a = _dot(d, d)
+    b = _dot(o, d)
+    disc = b*b - a*(_dot(o, o) - self.radius*self.radius)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      root = np.sqrt(disc)
+      near = (-b - root) / a
+      far = (-b + root) / a
+    t = np.full(len(origins), np.inf)
+    # the nearest root in front of the ray that lies within the cylinder's length
+    for candidate in (far, near):
+      along = _dot(oc + directions * np.where(np.isfinite(candidate), candidate, 0)[:,None], np.broadcast_to(axis, oc.shape))
+      valid = (candidate >= 0) & (along >= 0) & (along <= self.length)
+      t = np.where(valid, candidate, t)
+    hits = oc + directions * np.where(np.isfinite(t), t, 0)[:,None]
+    normals = (hits - np.outer(hits @ axis, axis)) / self.radius
+    normals = np.where((_dot(normals, directions) > 0)[:,None], -normals, normals)
+    return (t, normals)
+
+
+class Part:
+  """
+  A part made of features with an intersect(origins, directions) method, in machine coordinates
+  """
+  def __init__(self, features):
+    self.features = list(features)
+
+  @classmethod
+  def default(cls):
+    '''
+    A table at Z=0 with a reference sphere and a cylindrical boss on it
+    '''
+    return cls([
+      Plane((0, 0, 0), (0, 0, 1)),
+      Sphere((400, 300, 100), 12.5),
+      Cylinder((200, 300, 0), (0, 0, 1), 25, 60),
+    ])
+
+  def touch(self, origins, directions, maxDistance):
+    '''
+    Touch points and surface normals where rays first hit the part, and a mask of
+    the rays that hit within maxDistance
+    '''
+    origins = _rows(origins)
+    directions = _rows(directions)
+    t = np.full(len(origins), np.inf)
+    normals = np.zeros_like(origins)
+    for feature in self.features:
+      (ft, fn) = feature.intersect(origins, directions)
+      closer = ft < t
+      t = np.where(closer, ft, t)
+      normals[closer] = fn[closer]
+    hit = t <= maxDistance
+    points = origins + directions * np.where(hit, t, 0)[:,None]
+    return (points, normals, hit)
+
+
+def head_alignment(a, b):
+  '''
+  Tool alignment vector of an A/B head, A tilting away from vertical and B rotating about Z
+  '''
+  (a, b) = (math.radians(a), math.radians(b))
+  return np.array([ math.sin(a)*math.sin(b), -math.sin(a)*math.cos(b), math.cos(a) ])
+
+def head_angles(alignment, b=0.0):
+  '''
+  A and B angles for a tool alignment vector, keeping B when the tool is vertical
+  '''
+  (i, j, k) = _normalize(alignment)
+  a = math.degrees(math.acos(max(-1.0, min(1.0, k))))
+  if math.hypot(i, j) > 1e-9:
+    b = math.degrees(math.atan2(i, -j))
+  return (a, b)
+
+
+def _arguments(args):
+  return { name: value for (name, value) in ARGUMENT_RE.findall(args) }
+
+def _numbers(text):
+  return [ float(v) for v in NUMBER_RE.findall(text) ]
+
+def _number(name, value):
+  try:
+    return float(value)
+  except ValueError:
+    raise DmeError(ERR_ARGUMENTS, "%s(%s)" % (name, value))
+
+def _vector(text):
+  values = _numbers(text)
+  if len(values) < 3:
+    raise DmeError(ERR_ARGUMENTS, text)
+  return values[:3]
+
+def _format(v):
+  return "%.4f" % v
+
+def _format_vector(v):
+  return "%.6f, %.6f, %.6f" % tuple(v)
+
+
+class Reply:
+  """
+  Writes the responses to one command
+  """
+  def __init__(self, writer, tag):
+    self.writer = writer
+    self.tag = tag
+
+  def send(self, key, text=None):
+    line = "%s %s %s\r\n" % (self.tag, key, text) if text is not None else "%s %s\r\n" % (self.tag, key)
+    self.writer.write(line.encode("ascii"))
+
+  def data(self, text):
+    self.send(IPP_DATA_CHAR, text)
+
+  def error(self, severity, code, command, text):
+    self.send(IPP_ERROR_CHAR, 'Error(%d, %04d, "%s", "%s")' % (severity, code, command, text))
+
+  async def drain(self):
+    await self.writer.drain()
+
+
+class SimulatedDme:
+  """
+  Machine state and command implementations of the simulated DME. Positions are
+  kept in machine coordinates and converted to and from the active coordinate system.
+
+  ackLatency and executeLatency are seconds added before each ack and each command's
+  execution. With realTime, moves and scans also take as long as their distance at the
+  GoToPar, PtMeasPar and ScanPar speeds. noise is the standard deviation in mm added
+  to touch points.
+  """
+  def __init__(self, part=None, ackLatency=0.0, executeLatency=0.0, realTime=False, noise=0.0, seed=None,
+               volume=((0, 0, 0), (1000, 1000, 600)), homed=True, tools=None, props=None, pointsPerLine=10):
+    self.part = part if part is not None else Part.default()
+    self.ackLatency = ackLatency
+    self.executeLatency = executeLatency
+    self.realTime = realTime
+    self.noise = noise
+    self.rng = np.random.default_rng(seed)
+    self.volume = (np.asarray(volume[0], dtype=np.float64), np.asarray(volume[1], dtype=np.float64))
+    self.homePosition = self.volume[1].copy()
+    self.position = self.homePosition.copy()
+    self.homed = homed
+    self.tools = dict(tools or DEFAULT_TOOLS)
+    self.tool = "UnDefTool"
+    self.toolA = 0.0
+    self.toolB = 0.0
+    self.props = dict(DEFAULT_PROPS)
+    self.props.update(props or {})
+    self.pointsPerLine = pointsPerLine
+    self.ptMeasFormat = [ "X", "Y", "Z" ]
+    self.scanFormat = [ "X", "Y", "Z" ]
+    self.coordSystem = "MachineCsy"
+    self.partCsy = Csy(0, 0, 0, 0, 0, 0)
+    self.errors = []
+    self.errorState = False
+    self.commandsExecuted = 0
+    self.commands = { name[3:].lower(): getattr(self, name) for name in dir(self) if name.startswith("do_") }
+
+  '''
+  Coordinate systems
+  '''
+  def toMachine(self, points, directions=False):
+    '''
+    Points (or direction vectors) in the active coordinate system to machine coordinates
+    '''
+    if self.coordSystem == "PartCsy":
+      return self.partCsy.toMachine(_rows(points), directions)
+    return _rows(points).copy()
+
+  def fromMachine(self, points, directions=False):
+    if self.coordSystem == "PartCsy":
+      return self.partCsy.fromMachine(_rows(points), directions)
+    return _rows(points).copy()
+
+  '''
+  Motion
+  '''
+  def _checkHomed(self):
+    if not self.homed:
+      raise DmeError(ERR_NOT_HOMED)
+
+  def _checkVolume(self, point):
+    if np.any(point < self.volume[0] - 1e-6) or np.any(point > self.volume[1] + 1e-6):
+      raise DmeError(ERR_OUT_OF_VOLUME, "%s" % (point.tolist(),))
+
+  async def _travel(self, distance, speedProp):
+    if self.realTime and distance > 0:
+      await asyncio.sleep(distance / self.props[speedProp])
+
+  async def moveTo(self, target):
+    '''
+    Move in a straight line, stopping with a collision error if the path hits the part
+    '''
+    self._checkVolume(target)
+    delta = target - self.position
+    distance = float(np.linalg.norm(delta))
+    if distance > 0:
+      (points, _, hit) = self.part.touch(self.position, delta / distance, distance)
+      if hit[0]:
+        stop = points[0]
+        await self._travel(float(np.linalg.norm(stop - self.position)), "Tool.GoToPar.Speed")
+        self.position = stop
+        raise DmeError(ERR_COLLISION, "at %s" % (stop.tolist(),))
+    await self._travel(distance, "Tool.GoToPar.Speed")
+    self.position = target
+
+  def probe(self, points, normals):
+    '''
+    Touch the part along each nominal point's normal, searching from Approach mm
+    outside the surface to Search mm inside it
+    '''
+    approach = self.props["Tool.PtMeasPar.Approach"]
+    search = self.props["Tool.PtMeasPar.Search"]
+    (hits, hitNormals, hit) = self.part.touch(points + normals * approach, -normals, approach + search)
+    if self.noise:
+      hits = hits + self.rng.normal(0, self.noise, hits.shape)
+    return (hits, hitNormals, hit)
+
+  def _columns(self, fields, points, normals):
+    '''
+    Report values in the active coordinate system, one row per point
+    '''
+    points = self.fromMachine(points)
+    normals = self.fromMachine(normals, directions=True)
+    columns = []
+    for field in fields:
+      if field == "X":
+        columns.append(points[:,0:1])
+      elif field == "Y":
+        columns.append(points[:,1:2])
+      elif field == "Z":
+        columns.append(points[:,2:3])
+      elif field in ("IJK", "IJKAct"):
+        columns.append(normals)
+      elif field == "R":
+        columns.append(np.full((len(points), 1), self.tools[self.tool]))
+      elif field == "Tool.A":
+        columns.append(np.full((len(points), 1), self.toolA))
+      elif field == "Tool.B":
+        columns.append(np.full((len(points), 1), self.toolB))
+      else:
+        columns.append(np.zeros((len(points), 1)))
+    return np.hstack(columns)
+
+  def _report(self, fields, point, normal):
+    row = self._columns(fields, point, normal)[0]
+    values = []
+    i = 0
+    for field in fields:
+      if field in ("IJK", "IJKAct"):
+        values.append("%s(%s)" % (field, _format_vector(row[i:i+3])))
+        i += 3
+      else:
+        values.append("%s(%s)" % (field, _format(row[i])))
+        i += 1
+    return ", ".join(values)
+
+  '''
+  Execution
+  '''
+  def parse(self, command):
+    '''
+    Split a command into its name and argument string
+    '''
+    start = command.find("(")
+    if start < 0 or not command.endswith(")"):
+      raise DmeError(ERR_ILLEGAL_COMMAND, command)
+    return (command[:start], command[start+1:-1])
+
+  async def execute(self, name, args, reply):
+    handler = self.commands.get(name.lower())
+    if handler is None:
+      if name not in NOOP_COMMANDS:
+        raise DmeError(ERR_ILLEGAL_COMMAND, name)
+    else:
+      await handler(args, reply)
+    self.commandsExecuted += 1
+
+  def recordError(self, error):
+    self.errors.append(error)
+    if error.severity >= 3:
+      self.errorState = True
+
+  '''
+  I++ commands
+  '''
+  async def do_EndSession(self, args, reply):
+    self.ptMeasFormat = [ "X", "Y", "Z" ]
+    self.scanFormat = [ "X", "Y", "Z" ]
+
+  async def do_ClearAllErrors(self, args, reply):
+    self.errors.clear()
+    self.errorState = False
+
+  async def do_GetErrorInfo(self, args, reply):
+    for (i, error) in enumerate(self.errors):
+      reply.data('ErrorInfo(%d, %04d, "%s")' % (i, error.code, error.text))
+
+  async def do_GetErrStatusE(self, args, reply):
+    reply.data("ErrStatus(%d)" % (1 if self.errorState else 0))
+
+  async def do_GetXtdErrStatus(self, args, reply):
+    reply.data("IsHomed(%d)" % self.homed)
+    reply.data("IsUserEnabled(0)")
+    for error in self.errors:
+      reply.data('Error(%d, %04d, "", "%s")' % (error.severity, error.code, error.text))
+
+  async def do_GetDMEVersion(self, args, reply):
+    reply.data('DMEVersion("1.4")')
+
+  async def do_GetMachineClass(self, args, reply):
+    reply.data("GetMachineClass(CartCMM)")
+
+  async def do_IsUserEnabled(self, args, reply):
+    reply.data("IsUserEnabled(0)")
+
+  async def do_IsHomed(self, args, reply):
+    reply.data("IsHomed(%d)" % self.homed)
+
+  async def do_Home(self, args, reply):
+    await self._travel(float(np.linalg.norm(self.homePosition - self.position)), "Tool.GoToPar.Speed")
+    self.position = self.homePosition.copy()
+    self.homed = True
+
+  async def do_Get(self, args, reply):
+    position = self.fromMachine(self.position)[0]
+    values = []
+    for (name, _) in ARGUMENT_RE.findall(args):
+      if name in ("X", "Y", "Z"):
+        values.append("%s(%s)" % (name, _format(position["XYZ".index(name)])))
+      elif name == "Tool.A":
+        values.append("Tool.A(%s)" % _format(self.toolA))
+      elif name == "Tool.B":
+        values.append("Tool.B(%s)" % _format(self.toolB))
+      elif name == "R":
+        values.append("R(%s)" % _format(self.tools[self.tool]))
+      else:
+        raise DmeError(ERR_ARGUMENTS, name)
+    reply.data(", ".join(values))
+
+  def _target(self, arguments):
+    target = self.fromMachine(self.position)[0]
+    for (i, axis) in enumerate("XYZ"):
+      if axis in arguments:
+        target[i] = _number(axis, arguments[axis])
+    return self.toMachine(target)[0]
+
+  def _setHead(self, arguments):
+    if "Tool.Alignment" in arguments:
+      alignment = self.toMachine(_vector(arguments["Tool.Alignment"]), directions=True)[0]
+      (self.toolA, self.toolB) = head_angles(alignment, self.toolB)
+    if "Tool.A" in arguments:
+      self.toolA = _number("Tool.A", arguments["Tool.A"])
+    if "Tool.B" in arguments:
+      self.toolB = _number("Tool.B", arguments["Tool.B"])
+
+  async def do_GoTo(self, args, reply):
+    self._checkHomed()
+    arguments = _arguments(args)
+    # the target is checked before the head moves
+    target = self._target(arguments)
+    self._setHead(arguments)
+    await self.moveTo(target)
+
+  async def do_PtMeas(self, args, reply):
+    self._checkHomed()
+    arguments = _arguments(args)
+    nominal = self._target(arguments)
+    if "IJK" in arguments:
+      normal = self.toMachine(_vector(arguments["IJK"]), directions=True)[0]
+    else:
+      normal = self.position - nominal
+    if not np.any(normal):
+      normal = np.array([ 0.0, 0.0, 1.0 ])
+    normal = _normalize(normal)
+    self._checkVolume(nominal)
+
+    approach = self.props["Tool.PtMeasPar.Approach"]
+    search = self.props["Tool.PtMeasPar.Search"]
+    start = nominal + normal * approach
+    await self._travel(float(np.linalg.norm(start - self.position)), "Tool.GoToPar.Speed")
+    (points, normals, hit) = self.probe(nominal[None,:], normal[None,:])
+    if not hit[0]:
+      await self._travel(approach + search, "Tool.PtMeasPar.Speed")
+      self.position = nominal - normal * search
+      raise DmeError(ERR_SURFACE_NOT_FOUND)
+    await self._travel(float(np.linalg.norm(points[0] - start)), "Tool.PtMeasPar.Speed")
+    self.position = points[0] + normal * self.props["Tool.PtMeasPar.Retract"]
+    reply.data(self._report(self.ptMeasFormat, points, normals))
+
+  async def do_OnPtMeasReport(self, args, reply):
+    self.ptMeasFormat = FORMAT_FIELD_RE.findall(args.replace(" ", ""))
+
+  async def do_OnScanReport(self, args, reply):
+    self.scanFormat = FORMAT_FIELD_RE.findall(args.replace(" ", ""))
+
+  def _prop(self, name):
+    if name == "Tool.Name":
+      return '"%s"' % self.tool
+    if name not in self.props:
+      raise DmeError(ERR_PROPERTY, name)
+    return "%g" % self.props[name]
+
+  async def do_GetProp(self, args, reply):
+    reply.data(", ".join("%s(%s)" % (name, self._prop(name)) for (name, _) in ARGUMENT_RE.findall(args)))
+
+  do_GetPropE = do_GetProp
+
+  async def do_SetProp(self, args, reply):
+    arguments = _arguments(args)
+    values = {}
+    for (name, value) in arguments.items():
+      self._prop(name)
+      values[name] = _number(name, value)
+    self.props.update(values)
+
+  async def do_EnumTools(self, args, reply):
+    for name in self.tools:
+      reply.data('"%s"' % name)
+
+  def _toolName(self, args):
+    name = args.strip().strip('"')
+    if name not in self.tools:
+      raise DmeError(ERR_TOOL, name)
+    return name
+
+  async def do_ChangeTool(self, args, reply):
+    self.tool = self._toolName(args)
+
+  async def do_SetTool(self, args, reply):
+    self.tool = self._toolName(args)
+
+  async def do_CalcToolAlignment(self, args, reply):
+    arguments = _arguments(args)
+    alignment = head_alignment(_number("Tool.A", arguments.get("Tool.A", self.toolA)), _number("Tool.B", arguments.get("Tool.B", self.toolB)))
+    reply.data("Tool.Alignment(%s)" % _format_vector(self.fromMachine(alignment, directions=True)[0]))
+
+  async def do_CalcToolAngles(self, args, reply):
+    alignment = self.toMachine(_vector(args), directions=True)[0]
+    (a, b) = head_angles(alignment, self.toolB)
+    reply.data("Tool.A(%s), Tool.B(%s)" % (_format(a), _format(b)))
+
+  async def do_AlignTool(self, args, reply):
+    alignment = self.toMachine(_vector(args), directions=True)[0]
+    (self.toolA, self.toolB) = head_angles(alignment, self.toolB)
+
+  async def do_SetCoordSystem(self, args, reply):
+    name = args.strip()
+    if name not in ("MachineCsy", "MoveableMachineCsy", "MultipleArmCsy", "RotaryTableVarCsy", "PartCsy"):
+      raise DmeError(ERR_ARGUMENTS, name)
+    self.coordSystem = name
+
+  async def do_GetCoordSystem(self, args, reply):
+    reply.data("CoordSystem(%s)" % self.coordSystem)
+
+  async def do_SetCsyTransformation(self, args, reply):
+    values = [ v.strip() for v in args.split(",") ]
+    if values[0] != "PartCsy" or len(values) != 7:
+      raise DmeError(ERR_ARGUMENTS, args)
+    self.partCsy = Csy(*[ float(v) for v in values[1:] ])
+
+  async def do_GetCsyTransformation(self, args, reply):
+    csy = self.partCsy
+    reply.data("GetCsyTransformation(%s)" % ", ".join(_format(v) for v in (csy.x, csy.y, csy.z, csy.theta, csy.psi, csy.phi)))
+
+  async def scan(self, points, normals, reply):
+    '''
+    Probe nominal scan points (in machine coordinates) and stream them in the scan report
+    format, pointsPerLine points to a data line
+    '''
+    self._checkHomed()
+    if len(points) == 0:
+      raise DmeError(ERR_ARGUMENTS, "no points")
+    (hits, hitNormals, hit) = self.probe(points, normals)
+    if not hit.all():
+      raise DmeError(ERR_SURFACE_NOT_FOUND, "at %s" % (points[np.argmin(hit)].tolist(),))
+    await self.moveTo(hits[0] + normals[0] * self.props["Tool.PtMeasPar.Approach"])
+
+    values = self._columns(self.scanFormat, hits, hitNormals)
+    perLine = self.pointsPerLine
+    width = values.shape[1]
+    lineFormat = ",".join([ "%.4f" ] * (width * perLine))
+    batch = 100 * perLine
+    for start in range(0, len(values), batch):
+      chunk = values[start:start+batch]
+      full = len(chunk) // perLine * perLine
+      lines = [ lineFormat % tuple(row) for row in chunk[:full].reshape(-1, width * perLine).tolist() ]
+      if full < len(chunk):
+        lines.append(",".join([ "%.4f" ] * ((len(chunk) - full) * width)) % tuple(chunk[full:].ravel().tolist()))
+      for line in lines:
+        reply.data(line)
+      await reply.drain()
+      if self.realTime:
+        segment = hits[start:start+batch+1]
+        await self._travel(float(np.linalg.norm(np.diff(segment, axis=0), axis=1).sum()), "Tool.ScanPar.Speed")
+    self.position = hits[-1] + hitNormals[-1] * self.props["Tool.PtMeasPar.Retract"]
+
+  async def do_ScanOnLine(self, args, reply):
+    values = _numbers(args)
+    if len(values) != 10 or values[9] <= 0:
+      raise DmeError(ERR_ARGUMENTS, args)
+    start = self.toMachine(values[0:3])[0]
+    end = self.toMachine(values[3:6])[0]
+    normal = _normalize(self.toMachine(values[6:9], directions=True)[0])
+    count = max(2, int(round(np.linalg.norm(end - start) / values[9])) + 1)
+    points = start + np.linspace(0, 1, count)[:,None] * (end - start)
+    await self.scan(points, np.broadcast_to(normal, points.shape), reply)
+
+  def _arc(self, values, lead=0.0):
+    '''
+    Nominal points and normals of a circle or helix scan. The surface normal leans
+    from the radial direction towards the plane normal by the surface angle.
+    '''
+    center = self.toMachine(values[0:3])[0]
+    start = self.toMachine(values[3:6])[0]
+    axis = self.toMachine(values[6:9], directions=True)[0]
+    (delta, sfa, step) = values[9:12]
+    if step <= 0:
+      raise DmeError(ERR_ARGUMENTS, "StepW %s" % step)
+    if np.linalg.norm(axis) < 1e-9:
+      raise DmeError(ERR_ARGUMENTS, "IJK %s" % (values[6:9],))
+    axis = _normalize(axis)
+    radial = (start - center) - np.dot(start - center, axis) * axis
+    radius = np.linalg.norm(radial)
+    if radius < 1e-9:
+      raise DmeError(ERR_ARGUMENTS, "radius 0")
+    u = radial / radius
+    v = np.cross(axis, u)
+    angles = np.radians(np.linspace(0, delta, max(2, int(round(abs(delta) / step)) + 1)))
+    directions = np.outer(np.cos(angles), u) + np.outer(np.sin(angles), v)
+    points = center + directions * radius + np.outer(angles / (2*math.pi) * lead, axis)
+    points += np.dot(start - center, axis) * axis
+    normals = math.cos(math.radians(sfa)) * directions + math.sin(math.radians(sfa)) * axis
+    return (points, normals)
+
+  async def do_ScanOnCircle(self, args, reply):
+    values = _numbers(args)
+    if len(values) != 12:
+      raise DmeError(ERR_ARGUMENTS, args)
+    await self.scan(*self._arc(values), reply)
+
+  async def do_ScanOnHelix(self, args, reply):
+    values = _numbers(args)
+    if len(values) != 13:
+      raise DmeError(ERR_ARGUMENTS, args)
+    await self.scan(*self._arc(values, lead=values[12]), reply)
+
+
+class Session:
+  """
+  One client connection: its writer, the main queue and the command executing from it
+  """
+  def __init__(self, writer):
+    self.writer = writer
+    self.queue = deque()
+    self.wakeup = asyncio.Event()
+    self.current = None
+    self.executor = None
+
+
+class SimulatedServer:
+  """
+  Serves a SimulatedDme over TCP. Main queue commands are acked as they arrive and
+  executed in order; fast queue commands are answered as soon as they're read.
+  After an error of severity 3 or more the commands queued behind it are discarded
+  and later ones fail until ClearAllErrors.
+
+    async with SimulatedServer(SimulatedDme(realTime=True)) as server:
+      client = Client("127.0.0.1", server.port)
+  """
+  def __init__(self, dme=None, host="127.0.0.1", port=0):
+    self.dme = dme if dme is not None else SimulatedDme()
+    self.host = host
+    self.port = port
+    self.server = None
+    self.connections = set()
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle, self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+    return self
+
+  async def stop(self):
+    for task in list(self.connections):
+      task.cancel()
+    self.server.close()
+    await self.server.wait_closed()
+
+  async def __aenter__(self):
+    return await self.start()
+
+  async def __aexit__(self, *exc):
+    await self.stop()
+
+  async def handle(self, reader, writer):
+    connection = asyncio.current_task()
+    self.connections.add(connection)
+    session = Session(writer)
+    session.executor = asyncio.create_task(self.executeCommands(session))
+    buffer = b""
+    try:
+      while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+          break
+        lines = (buffer + chunk).split(b"\r\n")
+        buffer = lines.pop()
+        for line in lines:
+          await self.receive(session, line.decode("ascii"))
+    except (asyncio.CancelledError, ConnectionError):
+      pass
+    finally:
+      session.executor.cancel()
+      self.connections.discard(connection)
+      writer.close()
+
+  async def receive(self, session, line):
+    tag = line[0:5]
+    command = line[6:].strip()
+    reply = Reply(session.writer, tag)
+    if self.dme.ackLatency:
+      await asyncio.sleep(self.dme.ackLatency)
+    reply.send(IPP_ACK_CHAR)
+    if tag.startswith("E"):
+      name = command[:command.find("(")]
+      if name == "AbortE":
+        self.abort(session)
+        reply.send(IPP_COMPLETE_CHAR)
+      elif name in FAST_COMMANDS:
+        await self.run(reply, command)
+      else:
+        reply.error(ERR_ILLEGAL_COMMAND[0], ERR_ILLEGAL_COMMAND[1], name, "Not a fast queue command")
+    else:
+      session.queue.append((reply, command))
+      session.wakeup.set()
+
+  def abort(self, session):
+    '''
+    Fail the executing command and every queued one
+    '''
+    for (reply, command) in session.queue:
+      reply.error(ERR_ABORTED[0], ERR_ABORTED[1], command[:command.find("(")], ERR_ABORTED[2])
+    session.queue.clear()
+    if session.current is not None:
+      session.current.cancel()
+
+  async def executeCommands(self, session):
+    queue = session.queue
+    while True:
+      while not queue:
+        session.wakeup.clear()
+        await session.wakeup.wait()
+      (reply, command) = queue.popleft()
+      if self.dme.executeLatency:
+        await asyncio.sleep(self.dme.executeLatency)
+      current = session.current = asyncio.create_task(self.run(reply, command))
+      try:
+        severity = await asyncio.shield(current)
+      except asyncio.CancelledError:
+        if not current.cancelled():
+          current.cancel()
+          raise
+        reply.error(ERR_ABORTED[0], ERR_ABORTED[1], command[:command.find("(")], ERR_ABORTED[2])
+        continue
+      finally:
+        session.current = None
+      if severity >= 3:
+        # the DME stops, discarding everything queued behind the failed command
+        queue.clear()
+
+  async def run(self, reply, command):
+    '''
+    Execute a command and send its result, returning the severity of its error or 0
+    '''
+    dme = self.dme
+    name = command[:command.find("(")]
+    try:
+      (name, args) = dme.parse(command)
+      if dme.errorState and name != "ClearAllErrors":
+        raise DmeError(ERR_ERROR_STATE)
+      await dme.execute(name, args, reply)
+    except DmeError as e:
+      logger.debug("%s %s failed: %s", reply.tag, command, e.text)
+      dme.recordError(e)
+      reply.error(e.severity, e.code, name, e.text)
+      return e.severity
+    except Exception as e:
+      # a command the simulator can't handle mustn't stop the main queue
+      logger.warning("%s %s failed: %s", reply.tag, command, traceback.format_exc())
+      error = DmeError(ERR_ARGUMENTS, str(e))
+      dme.recordError(error)
+      reply.error(error.severity, error.code, name, error.text)
+      return error.severity
+    reply.send(IPP_COMPLETE_CHAR)
+    return 0
+
+
+async def main():
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+  server = await SimulatedServer(SimulatedDme(realTime=True), host="0.0.0.0", port=port).start()
+  print("Simulated I++ server listening on port %s" % server.port)
+  await server.server.serve_forever()
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(main())
@@ -0,0 +1,247 @@
+'''
+Columnar on-disk store for measured points, read back through memory maps so
+queries over millions of points only touch the rows they select.
+
+  store = MeasurementStore("results")
+  store.append(points, normals, part="bracket-0042", feature="top_face", tool="Component_3.1.50.4.A0.0-B0.0", csy=csy)
+  for (batch, xyz) in store.query(part="bracket-0042", start=yesterday).batches():
+    ...
+
+Points are appended in batches, one per call to append. Every column is a raw
+little endian file that is only ever appended to: x, y, z, i, j, k per point and
+the start row, count, time and categorical codes of each batch. Part, feature,
+tool and Csy values are coded with the dictionary in dictionary.json. Batches are
+appended in time order, so the batch table is the index for time range and
+part/feature queries.
+'''
+import os
+import json
+import time
+import numpy as np
+from ipp import toPointArray
+
+POINT_COLUMNS = { "x": "<f8", "y": "<f8", "z": "<f8", "i": "<f8", "j": "<f8", "k": "<f8" }
+
+BATCH_COLUMNS = {
+  "start": "<i8",
+  "count": "<i8",
+  "time": "<f8",
+  "part": "<i4",
+  "feature": "<i4",
+  "tool": "<i4",
+  "csy": "<i4",
+}
+
+CATEGORIES = ("part", "feature", "tool", "csy")
+
+DICTIONARY_FILE = "dictionary.json"
+
+
+def _csy_key(csy):
+  if csy is None or isinstance(csy, str):
+    return csy
+  return "Csy(%r, %r, %r, %r, %r, %r)" % (csy.x, csy.y, csy.z, csy.theta, csy.psi, csy.phi)
+
+
+class MeasurementSet:
+  """
+  The batches a query selected. Arrays are read from the memory maps when asked for.
+  """
+  def __init__(self, store, batchIndices):
+    self.store = store
+    self.batchIndices = batchIndices
+
+  def __len__(self):
+    return int(self.store._batch("count")[self.batchIndices].sum())
+
+  def _ranges(self):
+    starts = self.store._batch("start")[self.batchIndices]
+    counts = self.store._batch("count")[self.batchIndices]
+    return zip(starts.tolist(), (starts + counts).tolist())
+
+  def _gather(self, names):
+    columns = [ self.store._column(name) for name in names ]
+    ranges = list(self._ranges())
+    out = np.empty((sum(end - start for (start, end) in ranges), len(names)))
+    row = 0
+    for (start, end) in ranges:
+      for (c, column) in enumerate(columns):
+        out[row:row + end - start, c] = column[start:end]
+      row += end - start
+    return out
+
+  @property
+  def xyz(self):
+    return self._gather("xyz")
+
+  @property
+  def ijk(self):
+    return self._gather("ijk")
+
+  def metadata(self):
+    '''
+    One dict per selected batch with its time, row count and decoded categories
+    '''
+    store = self.store
+    rows = []
+    for b in self.batchIndices.tolist():
+      row = { "batch": b, "time": float(store._batch("time")[b]), "count": int(store._batch("count")[b]) }
+      for category in CATEGORIES:
+        row[category] = store.decode(category, int(store._batch(category)[b]))
+      rows.append(row)
+    return rows
+
+  def batches(self):
+    '''
+    Yields (metadata, N x 3 points) for each selected batch, reading one batch at a time
+    '''
+    store = self.store
+    for (row, (start, end)) in zip(self.metadata(), self._ranges()):
+      yield (row, np.column_stack([ store._column(name)[start:end] for name in "xyz" ]))
+
+
+class MeasurementStore:
+  """
+  Append-only columnar store of measured points in a directory, see the module docstring
+  """
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+    dictionaryPath = os.path.join(path, DICTIONARY_FILE)
+    if os.path.exists(dictionaryPath):
+      with open(dictionaryPath) as f:
+        self.dictionary = json.load(f)
+    else:
+      self.dictionary = { category: [] for category in CATEGORIES }
+    self.codes = { category: { value: code for (code, value) in enumerate(values) } for (category, values) in self.dictionary.items() }
+    self.maps = {}
+    self._recover()
+
+  def _file(self, name):
+    return os.path.join(self.path, name + ".bin")
+
+  def _length(self, name, dtype):
+    path = self._file(name)
+    return os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0
+
+  def _recover(self):
+    '''
+    Drop rows of a partially written append, point columns are written before the batch row
+    '''
+    self.numBatches = min(self._length("batch_" + name, dtype) for (name, dtype) in BATCH_COLUMNS.items())
+    rows = min(self._length(name, dtype) for (name, dtype) in POINT_COLUMNS.items())
+    if self.numBatches:
+      ends = self._batch("start") + self._batch("count")
+      while self.numBatches and ends[self.numBatches - 1] > rows:
+        self.numBatches -= 1
+    self.numRows = int((self._batch("start") + self._batch("count"))[-1]) if self.numBatches else 0
+    for (name, dtype) in POINT_COLUMNS.items():
+      self._truncate(name, dtype, self.numRows)
+    for (name, dtype) in BATCH_COLUMNS.items():
+      self._truncate("batch_" + name, dtype, self.numBatches)
+    self.maps.clear()
+
+  def _truncate(self, name, dtype, length):
+    path = self._file(name)
+    size = length * np.dtype(dtype).itemsize
+    if not os.path.exists(path):
+      open(path, "wb").close()
+    elif os.path.getsize(path) != size:
+      os.truncate(path, size)
+
+  def _map(self, name, dtype, length):
+    m = self.maps.get(name)
+    if m is None or len(m) != length:
+      m = np.memmap(self._file(name), dtype=dtype, mode="r", shape=(length,)) if length else np.empty(0, dtype=dtype)
+      self.maps[name] = m
+    return m
+
+  def _column(self, name):
+    return self._map(name, POINT_COLUMNS[name], self.numRows)
+
+  def _batch(self, name):
+    return self._map("batch_" + name, BATCH_COLUMNS[name], self.numBatches)
+
+  def encode(self, category, value):
+    '''
+    Code of a categorical value, adding it to the dictionary if it's new; -1 for None
+    '''
+    if category == "csy":
+      value = _csy_key(value)
+    if value is None:
+      return -1
+    code = self.codes[category].get(value)
+    if code is None:
+      code = self.codes[category][value] = len(self.dictionary[category])
+      self.dictionary[category].append(value)
+      self._saveDictionary()
+    return code
+
+  def decode(self, category, code):
+    return None if code < 0 else self.dictionary[category][code]
+
+  def _saveDictionary(self):
+    path = os.path.join(self.path, DICTIONARY_FILE)
+    with open(path + ".tmp", "w") as f:
+      json.dump(self.dictionary, f)
+    os.replace(path + ".tmp", path)
+
+  def append(self, points, normals=None, part=None, feature=None, tool=None, csy=None, timestamp=None):
+    '''
+    Append a batch of points (N x 3 array, list of float3 or ScanResult) with optional
+    normals (missing ones are stored as NaN) and metadata. timestamp defaults to now
+    and must not be earlier than the last batch's. Returns the batch number.
+    '''
+    xyz = toPointArray(points)
+    if normals is None and hasattr(points, "columns") and "i" in points.columns:
+      normals = points.ijk
+    ijk = np.full_like(xyz, np.nan) if normals is None else toPointArray(normals)
+    if ijk.shape != xyz.shape:
+      raise ValueError("%d normals for %d points" % (len(ijk), len(xyz)))
+    timestamp = time.time() if timestamp is None else float(timestamp)
+    if self.numBatches and timestamp < self._batch("time")[-1]:
+      raise ValueError("Batches must be appended in time order")
+
+    batch = {
+      "start": self.numRows,
+      "count": len(xyz),
+      "time": timestamp,
+    }
+    for (category, value) in zip(CATEGORIES, (part, feature, tool, csy)):
+      batch[category] = self.encode(category, value)
+
+    for (c, name) in enumerate("xyz"):
+      self._write(name, xyz[:,c].astype(POINT_COLUMNS[name]))
+    for (c, name) in enumerate("ijk"):
+      self._write(name, ijk[:,c].astype(POINT_COLUMNS[name]))
+    for (name, dtype) in BATCH_COLUMNS.items():
+      self._write("batch_" + name, np.array([ batch[name] ], dtype=dtype))
+
+    self.numRows += len(xyz)
+    self.numBatches += 1
+    return self.numBatches - 1
+
+  def _write(self, name, array):
+    with open(self._file(name), "ab") as f:
+      f.write(array.tobytes())
+
+  def __len__(self):
+    return self.numRows
+
+  def query(self, part=None, feature=None, tool=None, start=None, end=None):
+    '''
+    MeasurementSet of the batches matching every given category value and with
+    start <= time < end. The time range is found by binary search of the batch times.
+    '''
+    times = self._batch("time")
+    first = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+    last = self.numBatches if end is None else int(np.searchsorted(times, end, side="left"))
+    selected = np.arange(first, max(first, last))
+    for (category, value) in (("part", part), ("feature", feature), ("tool", tool)):
+      if value is None:
+        continue
+      code = self.codes[category].get(value)
+      if code is None:
+        return MeasurementSet(self, selected[:0])
+      selected = selected[self._batch(category)[selected] == code]
+    return MeasurementSet(self, selected)
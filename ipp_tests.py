@@ -288,10 +288,7 @@ async def surfaceSquareMachineTouchZ(length=25.4):
 
   async def getData(data):
     global startPos
-    x = float(data[data.find("X(") + 2 : data.find("), Y")])
-    y = float(data[data.find("Y(") + 2 : data.find("), Z")])
-    z = float(data[data.find("Z(") + 2 : data.find(")\r\n")])
-    startPos = float3(x,y,z)
+    startPos = readPointData(data)
 
   getPosDataCallback = getData
   await waitForCommandComplete(client.Get, "X(),Y(),Z()", otherCallbacks={'data': getData})
@@ -303,10 +300,7 @@ async def surfaceSquareMachineTouchZ(length=25.4):
   async def ptMeasData(data):
     global points
     print("ptmeas: %s" % data)
-    x = float(data[data.find("X(") + 2 : data.find("), Y")])
-    y = float(data[data.find("Y(") + 2 : data.find("), Z")])
-    z = float(data[data.find("Z(") + 2 : data.find(")\r\n")])
-    pt = float3(x,y,z)
+    pt = readPointData(data)
     points.append(pt)
 
   await waitForCommandComplete(client.PtMeas, "X(%s),Y(%s),Z(%s),IJK(0,0,1)" % (startPos.x,startPos.y,startPos.z), otherCallbacks={'data': ptMeasData})
@@ -363,10 +357,7 @@ async def linePlusYHeadTouchMinusX():
 
   async def getData(data):
     global startPos
-    x = float(data[data.find("X(") + 2 : data.find("), Y")])
-    y = float(data[data.find("Y(") + 2 : data.find("), Z")])
-    z = float(data[data.find("Z(") + 2 : data.find(")\r\n")])
-    startPos = float3(x,y,z)
+    startPos = readPointData(data)
 
   getPosDataCallback = getData
   await waitForCommandComplete(client.Get, "X(),Y(),Z()", otherCallbacks={'data': getData})
@@ -380,10 +371,7 @@ async def linePlusYHeadTouchMinusX():
   async def ptMeasData(data):
     global points
     print("ptmeas: %s" % data)
-    x = float(data[data.find("X(") + 2 : data.find("), Y")])
-    y = float(data[data.find("Y(") + 2 : data.find("), Z")])
-    z = float(data[data.find("Z(") + 2 : data.find(")\r\n")])
-    pt = float3(x,y,z)
+    pt = readPointData(data)
     points.append(pt)
 
   await waitForCommandComplete(client.PtMeas, "X(%s),Y(%s),Z(%s),IJK(0,0.988,-0.156)" % (startPos.x,startPos.y,startPos.z), otherCallbacks={'data': ptMeasData})
@@ -1,7 +1,87 @@
+import os
+import sys
+import math
+import asyncio
+import subprocess
+import time
+import pytest
 from pytest import approx
 import numpy as np
 
-from ipp import Csy
+from ipp_server import SimulatedServer, SimulatedDme
+from ipp_store import MeasurementStore
+from ipp_offload import Offloader
+import ipp_routines as routines
+from ipp_planner import plan_measurements
+from ipp_kinematics import HeadKinematics
+from ipp_fit import fit_line, fit_plane, fit_circle, fit_sphere, fit_cylinder, IncrementalLine, IncrementalPlane, IncrementalSphere, IncrementalCircle, IncrementalCylinder
+from ipp_capture import CaptureWriter, ReplayServer, read_sessions, summarize, SENT, RECEIVED
+from ipp import Csy, Client, StateCache, CmmException, CmmExceptionFlushed, TransactionStatus, LineFramer, RetentionPolicy, LoopLagMonitor, Transaction, Histogram, compileResponseFormat, split_arguments, float3, float3Array, ScanResult
+
+class FakeServer:
+  '''
+  Minimal I++ server that acks, echoes the command as data and completes every command
+  '''
+  def __init__(self):
+    self.received = []
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+    self.port = self.server.sockets[0].getsockname()[1]
+
+  async def handle(self, reader, writer):
+    try:
+      await self.serve(reader, writer)
+    except (asyncio.CancelledError, ConnectionError):
+      pass
+    writer.close()
+
+  async def serve(self, reader, writer):
+    while True:
+      line = await reader.readline()
+      if not line:
+        break
+      line = line.decode("ascii").strip()
+      self.received.append(line)
+      tag, cmd = line[0:5], line[6:]
+      if cmd.startswith("ScanOnLine("):
+        # ScanOnLine(n) scans n points, 10 points to a line
+        numPoints = int(cmd[11:-1])
+        writer.write(("%s &\r\n" % tag).encode("ascii"))
+        for start in range(0, numPoints, 10):
+          values = ",".join("%s,%s,%s" % (i, i, i) for i in range(start, min(start + 10, numPoints)))
+          writer.write(("%s # %s\r\n" % (tag, values)).encode("ascii"))
+          await writer.drain()
+        writer.write(("%s %%\r\n" % tag).encode("ascii"))
+      elif cmd == "Hold()":
+        # never completes
+        writer.write(("%s &\r\n" % tag).encode("ascii"))
+      elif cmd.startswith("Fail("):
+        # Fail(severity) errors with that severity
+        severity = cmd[5:-1]
+        writer.write(('%s &\r\n%s ! Error(%s, 1006, "PtMeas", "Surface not found")\r\n' % (tag, tag, severity)).encode("ascii"))
+        if int(severity) < 2:
+          # warnings don't stop the command from completing
+          writer.write(("%s %%\r\n" % tag).encode("ascii"))
+      else:
+        writer.write(("%s &\r\n%s # %s\r\n%s %%\r\n" % (tag, tag, cmd, tag)).encode("ascii"))
+
+  async def stop(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+def run_with_client(test, transport="tornado", retention=None):
+  async def run():
+    server = FakeServer()
+    await server.start()
+    client = Client("127.0.0.1", server.port, transport=transport, retention=retention)
+    await client.connect()
+    try:
+      await test(client, server)
+    finally:
+      await client.disconnect()
+      await server.stop()
+  asyncio.run(run())
 
 def test_csy_conversions():
   # euler angles with gimbal lock
@@ -42,3 +122,676 @@ def test_csy_conversions3():
                                   [ -1, 0, 0, 134 ],
                                   [  0, 0, 1, 126.5 ],
                                   [  0, 0, 0, 1 ]]))
+
+def test_csy_transforms():
+  csy = Csy(653.0, 134.0, 126.5, 34, 34, 155)
+  mat = csy.toMatrix4()
+  points = np.array([ [ 0, 0, 0 ], [ 1, 2, 3 ], [ -10, 5, 7 ] ])
+
+  machine = csy.toMachine(points)
+  assert machine == approx(points @ mat[:3,:3].T + mat[:3,3])
+  assert csy.fromMachine(machine) == approx(points)
+  assert csy.transformVectors(points) == approx(points @ mat[:3,:3].T)
+  assert tuple(csy.toMachine(float3(1, 2, 3))) == approx(tuple(machine[1]))
+  assert csy.inverseMatrix4() @ mat == approx(np.identity(4))
+
+  # composition and inverse
+  feature = Csy(10, 0, 5, 0, 0, 90)
+  assert (csy @ feature).toMatrix4() == approx(mat @ feature.toMatrix4())
+  assert (csy @ csy.inverse()).toMatrix4() == approx(np.identity(4))
+
+  # the cached matrix follows changes
+  csy.x = 0
+  assert csy.toMatrix4()[0,3] == 0 and csy.toMachine(float3(0, 0, 0)).x == 0
+
+  csys = [ Csy(1, 2, 3, 10, 20, 30), Csy(653.0, 134.0, 126.5, 0, -90, 0) ]
+  mats = Csy.toMatrix4Array(csys)
+  assert mats.shape == (2, 4, 4) and mats[1] == approx(csys[1].toMatrix4())
+  assert Csy.fromMatrix4Array(mats)[0].theta == approx(10)
+
+@pytest.mark.parametrize("transport", [ "tornado", "asyncio" ])
+def test_pipeline(transport):
+  async def test(client, server):
+    async with client.pipeline() as p:
+      for i in range(5):
+        p.GoTo("X(%s)" % i)
+
+    assert list(p.result.keys()) == [ "%05d" % i for i in range(1, 6) ]
+    assert server.received == [ "%05d GoTo(X(%s))" % (i+1, i) for i in range(5) ]
+    for (tag, t) in p.result.items():
+      assert t.status == TransactionStatus.COMPLETE
+      assert p.result.data(tag) == [ "%s # %s\r\n" % (tag, t.command) ]
+    assert len(p.result.errors) == 0
+
+    # all five commands were queued in one iteration and written together
+    assert client.commandsSent == 5
+    assert client.writesIssued == 1
+
+  run_with_client(test, transport)
+
+def test_line_framer_partial_lines():
+  framer = LineFramer()
+  assert framer.feed(b"00001 &\r\n00001 # X(1), Y") == [ "00001 &\r\n" ]
+  assert framer.feed(b"(2), Z(3)\r") == []
+  assert framer.feed(b"\n00001 %\r\n") == [ "00001 # X(1), Y(2), Z(3)\r\n", "00001 %\r\n" ]
+  assert len(framer.buffer) == 0
+
+def test_retention_evicts_oldest_finished():
+  evicted = []
+  async def test(client, server):
+    for i in range(5):
+      await client.GoTo("X(%s)" % i).complete()
+
+    assert [ t.tag for t in evicted ] == [ "00001", "00002", "00003" ]
+    assert list(client.transactions.keys()) == [ "00004", "00005" ]
+    usage = client.memoryUsage()
+    assert usage["finishedTransactions"] == 2
+    assert usage["finishedBytes"] == sum(t.nbytes for t in client.transactions.values())
+
+    # a transaction that is never sent isn't kept once it's dropped
+    unsent = client.GoTo("X(6)")
+    assert client.memoryUsage()["unsentTransactions"] == 1 and unsent.tag not in client.transactions
+    del unsent
+    assert client.memoryUsage()["unsentTransactions"] == 0 and len(client.transactions) == 2
+
+  run_with_client(test, retention=RetentionPolicy(maxCount=2, onEvict=evicted.append))
+
+def test_histogram_percentiles():
+  h = Histogram()
+  for i in range(1, 1001):
+    h.record(i * 1e-3)
+
+  assert h.count == 1000
+  assert h.percentile(50) == approx(0.5, rel=0.15)
+  assert h.percentile(99) == approx(0.99, rel=0.15)
+  assert h.percentile(100) == h.max == 1.0
+  assert h.percentile(0) == h.min == 1e-3
+
+def test_stats():
+  async def test(client, server):
+    for i in range(3):
+      await client.GoTo("X(%s)" % i).complete()
+    get = await client.Get("X(),Y(),Z()").complete()
+
+    stats = client.stats()
+    assert stats["GoTo"]["count"] == 3
+    assert stats["Get"]["count"] == 1
+    assert stats["GoTo"]["ackLatency"]["count"] == 3
+    assert stats["GoTo"]["totalTime"]["p50"] > 0
+    # wire bytes of the data lines, not the memory they take
+    assert stats["Get"]["bytesReceived"]["total"] == get.bytesReceived == len(get.data_list[0])
+
+  run_with_client(test)
+
+def test_float3_array():
+  v = float3(1, 2, 3)
+  assert not hasattr(v, "__dict__") and v.values == (1, 2, 3)
+  assert tuple(float3(1, 0, 0).cross(float3(0, 1, 0))) == (0, 0, 1)
+
+  points = float3(10, 0, 0) + float3Array.outer([ 0, 1, 2 ], float3(0, 1, 0))
+  assert isinstance(points, float3Array) and points.array.tolist() == [ [10, 0, 0], [10, 1, 0], [10, 2, 0] ]
+  assert tuple(points[2]) == (10, 2, 0) and len(points[1:]) == 2
+  assert (points - v).array[0].tolist() == [ 9, -2, -3 ]
+  assert points.dot(float3(0, 1, 0)).tolist() == [ 0, 1, 2 ]
+  assert (points * np.array([ 1, 2, 3 ])).y.tolist() == [ 0, 2, 6 ]
+  assert points.cross(float3(0, 0, 1)).array[1].tolist() == [ 1, -10, 0 ]
+  assert points.normalize().norm() == approx(1)
+  assert points.ToXYZStrings()[1] == float3(10.0, 1.0, 0.0).ToXYZString()
+  assert float3Array([ float3(1, 2, 3), (4, 5, 6) ]).array.shape == (2, 3)
+
+def test_response_parser():
+  parser = compileResponseFormat("X(), Y(), Z(), IJK(), Tool.A(), Tool.B()")
+  assert parser is compileResponseFormat("X(),Y(),Z(),IJK(),Tool.A(),Tool.B()")
+
+  line = "00012 # X(1.5), Y(-2), Z(3e1), IJK(0,0.6,0.8), Tool.A(90), Tool.B(-45)\r\n"
+  r = parser.parse(line)
+  assert (r.x, r.y, r.z, r.tool_a, r.tool_b) == (1.5, -2.0, 30.0, 90.0, -45.0)
+  assert tuple(r.ijk) == (0.0, 0.6, 0.8)
+  assert [ (m.x, tuple(m.ijk), m.tool_b) for m in parser.parseMany([ line, line ]) ] == [ (1.5, (0.0, 0.6, 0.8), -45.0) ] * 2
+  assert parser.parseArray([ line, line ]).shape == (2, 8)
+
+  assert compileResponseFormat("Tool.Name()").parse('00003 # Tool.Name("Component_3.1")\r\n').tool_name == "Component_3.1"
+  assert tuple(float3.FromXYZString("00001 # X(1), Y(2), Z(3)\r\n")) == (1.0, 2.0, 3.0)
+
+def test_scan_result():
+  lines = [ "00012 # 1,2,3,0,0,1,4,5,6,0,1,0\r\n", "00012 # 7,8,9,1,0,0\r\n" ]
+  result = ScanResult.fromLines(lines, "X(),Y(),Z(),IJK()")
+  assert result.array.shape == (3, 6)
+  assert result.columns == [ "x", "y", "z", "i", "j", "k" ]
+  assert result.xyz.tolist() == [ [1, 2, 3], [4, 5, 6], [7, 8, 9] ]
+  assert result.ijk.tolist() == [ [0, 0, 1], [0, 1, 0], [1, 0, 0] ]
+
+  labeled = ScanResult.fromLines([ "00012 # X(1), Y(2), Z(3)\r\n" ])
+  assert labeled.xyz.tolist() == [ [1, 2, 3] ]
+
+  with pytest.raises(ValueError):
+    ScanResult.fromLines([ "00012 # 1,2,3,4\r\n" ])
+  with pytest.raises(ValueError):
+    ScanResult.fromLines([ "00012 # 1,2,x\r\n" ])
+
+@pytest.mark.parametrize("transport", [ "tornado", "asyncio" ])
+def test_transaction_stream(transport):
+  async def test(client, server):
+    scan = client.ScanOnLine("20000")
+    stream = scan.stream(batchSize=50, maxQueue=100, parser=ScanResult.fromLines, retain=False)
+    numPoints = 0
+    maxQueued = 0
+    async for result in stream:
+      numPoints += len(result)
+      maxQueued = max(maxQueued, len(stream.queue))
+      await asyncio.sleep(0)
+
+    assert numPoints == 20000
+    assert scan.status == TransactionStatus.COMPLETE
+    assert scan.data_list == []
+    # one 64k chunk holds at most a few hundred of these lines
+    assert maxQueued < 1000
+
+    # batches larger than the queue come out short instead of stalling reading
+    async def readAll(stream):
+      return sum([ len(lines) async for lines in stream ])
+    assert await asyncio.wait_for(readAll(client.ScanOnLine("5000").stream(batchSize=1000, maxQueue=100, parser=ScanResult.fromLines)), 10) == 5000
+
+    # leaving early closes the stream, so reading goes on for later commands
+    async with client.ScanOnLine("20000").stream(batchSize=10, maxQueue=100) as stream:
+      async for lines in stream:
+        break
+    assert stream.closed
+    get = await asyncio.wait_for(client.Get("X()").complete(), 10)
+    assert get.status == TransactionStatus.COMPLETE
+
+  run_with_client(test, transport)
+
+def test_transaction_is_awaitable():
+  async def test(client, server):
+    goTo = await client.GoTo("X(1)")
+    assert goTo.status == TransactionStatus.COMPLETE
+    # stages already reached resolve immediately
+    assert await goTo.ack() is goTo
+    assert await goTo.complete() is goTo
+
+    get = client.Get("X()")
+    assert (await get.data()).data_list == [ "%s # Get(X())\r\n" % get.tag ]
+    assert get.sentAt <= get.ackAt <= get.firstDataAt
+
+  run_with_client(test)
+
+def test_errors_are_scoped_to_their_transaction():
+  async def test(client, server):
+    before = client.sendCommand("Hold()")
+    failed = client.sendCommand("Fail(2)")
+    after = client.sendCommand("Hold()")
+    warned = client.sendCommand("Fail(1)")
+    # send them together, in order
+    acks = [ t.ack() for t in (before, failed, after, warned) ]
+    with pytest.raises(CmmException):
+      await failed
+    await warned
+    await asyncio.gather(acks[0], acks[2])
+    assert "Surface not found" in warned.warning_list[0]
+    assert before.status == after.status == TransactionStatus.ACK
+
+    # an error that stops the DME discards the commands sent after it
+    stopped = client.sendCommand("Fail(3)")
+    queued = client.sendCommand("Hold()")
+    futures = [ stopped.complete(), queued.complete() ]
+    with pytest.raises(CmmException):
+      await futures[0]
+    with pytest.raises(CmmExceptionFlushed):
+      await futures[1]
+    assert before.status == after.status == TransactionStatus.ACK
+    assert list(client.pendingTransactions.values()) == [ before, after ]
+
+    # a late error for a finished command doesn't flush the commands still pending
+    done = await client.GoTo("X(1)")
+    client._dispatch_message('%s ! Error(3, 1006, "GoTo", "Late")' % done.tag)
+    assert before.status == after.status == TransactionStatus.ACK
+
+  run_with_client(test)
+
+def run_with_simulator(test, **dmeOptions):
+  async def run():
+    async with SimulatedServer(SimulatedDme(**dmeOptions)) as server:
+      client = Client("127.0.0.1", server.port)
+      await client.connect()
+      try:
+        await test(client, server.dme)
+      finally:
+        await client.disconnect()
+  asyncio.run(run())
+
+def test_simulator_probing_and_scanning():
+  async def test(client, dme):
+    await client.StartSession()
+    await client.GoTo("X(300),Y(300),Z(50)")
+    ptMeas = await client.PtMeas("X(300),Y(300),Z(0),IJK(0,0,1)").complete()
+    assert float3.FromXYZString(ptMeas.data_list[0]).values == approx((300, 300, 0))
+
+    with pytest.raises(CmmException, match="Surface not found"):
+      await client.PtMeas("X(300),Y(300),Z(30),IJK(0,0,1)")
+
+    await client.OnScanReport("X(),Y(),Z(),IJK()")
+    scan = client.ScanOnLine("0,0,0,100,0,0,0,0,1,0.01")
+    await scan
+    result = client.scanResult(scan)
+    assert len(result) == 10001
+    assert result.xyz[-1] == approx((100, 0, 0))
+    assert result.ijk[0] == approx((0, 0, 1))
+
+    # positions are reported in the active coordinate system; the scan ended at X100, Y0, Z2
+    await client.SetCsyTransformation("PartCsy, 300, 300, 0, 0, 0, 0")
+    await client.SetCoordSystem("PartCsy")
+    position = await client.Get("X(),Y(),Z()").complete()
+    assert float3.FromXYZString(position.data_list[0]).values == approx((-200, -300, 2))
+
+    # bad arguments fail their command without stopping the main queue
+    with pytest.raises(CmmException, match="Illegal arguments"):
+      await client.SetProp("Tool.PtMeasPar.Speed(fast)")
+    with pytest.raises(CmmException, match="Illegal arguments"):
+      await client.ScanOnCircle("0,0,0,0,0,0,0,0,1,360,0,1")
+    with pytest.raises(CmmException, match="Illegal arguments"):
+      await client.SetCsyTransformation("PartCsy, a, 0, 0, 0, 0, 0")
+    position = await client.Get("X(),Y(),Z()").complete()
+    assert float3.FromXYZString(position.data_list[0]).values == approx((-200, -300, 2))
+
+  run_with_simulator(test)
+
+def test_client_mirrors_coordinate_system():
+  async def test(client, dme):
+    await client.StartSession()
+    (coordSystem, partCsy) = await client.syncCoordSystem()
+    assert coordSystem == "MachineCsy" and partCsy.toMatrix4() == approx(np.identity(4))
+    csy = Csy(100, 50, 0, 0, 0, 90)
+    await routines.set_part_csy(client, csy)
+    assert client.coordSystem == "PartCsy" and client.partCsy.toMatrix4() == approx(csy.toMatrix4())
+    # already active, nothing is sent
+    commandsSent = client.commandsSent
+    await routines.set_part_csy(client, csy)
+    assert client.commandsSent == commandsSent
+
+    position = await client.Get("X(),Y(),Z()").complete()
+    assert tuple(client.toMachine(float3.FromXYZString(position.data_list[0]))) == approx((1000, 1000, 600))
+
+    # probing along the machine axes without leaving PartCsy, points come back in machine coordinates
+    await client.GoTo(client.fromMachine(float3(400, 300, 123)).ToXYZString()).complete()
+    points = await routines.probe_sphere_relative(client, 12.5)
+    assert [ float3(*p).norm() for p in np.array(points) - (400, 300, 100) ] == approx([ 12.5 ] * 4, abs=1e-6)
+    assert dme.coordSystem == "PartCsy" and client.commandStats["SetCoordSystem"].count == 1
+
+  run_with_simulator(test)
+
+  # replies that can't be parsed leave the coordinate system unknown
+  client = Client()
+  for (query, reply) in ((lambda: client.GetCoordSystem(), "CoordSystem()"), (lambda: client.GetCsyTransformation("PartCsy"), "GetCsyTransformation(1, 2)")):
+    (client.coordSystem, client.partCsy) = (None, Csy(1, 2, 3, 0, 0, 0))
+    transaction = query()
+    transaction.handle_complete()
+    assert client.partCsy is not None
+    transaction = query()
+    transaction.data_list = [ "00001 # %s\r\n" % reply ]
+    transaction.handle_complete()
+    assert client.coordSystem is None and client.partCsy is None
+
+def test_pipelined_probe_line():
+  async def test(client, dme):
+    await client.StartSession()
+    results = {}
+    for pipelined in (False, True):
+      await client.GoTo("X(300),Y(300),Z(20)")
+      writesIssued = client.writesIssued
+      results[pipelined] = await routines.probe_line(client, float3(300, 300, 0), float3(1, 0, 0), float3(0, 0, 1), 50, 10, 20, 1, pipelined=pipelined)
+      results[pipelined, "writes"] = client.writesIssued - writesIssued
+    assert [ p.values for p in results[True] ] == [ p.values for p in results[False] ]
+    assert results[True][-1].values == approx((350, 300, 0))
+    # the whole plan goes out in one write instead of one per command
+    assert results[True, "writes"] == 1 and results[False, "writes"] == 43
+
+  run_with_simulator(test)
+
+def test_measurement_planner():
+  # targets along the table in shuffled order
+  xs = np.random.default_rng(0).permutation(np.arange(200, 700, 25.0))
+  positions = np.column_stack([ xs, np.full(len(xs), 500.0), np.zeros(len(xs)) ])
+  plan = plan_measurements(positions, [ float3(0, 0, 1) ] * len(xs), start=float3(800, 500, 5))
+  assert xs[plan.order].tolist() == sorted(xs, reverse=True)
+  assert plan.cost == approx(600 / 100) and plan.cost < plan.initialCost
+
+  empty = plan_measurements([], [], start=float3(800, 500, 5))
+  assert empty.order.tolist() == [] and empty.commands == [] and empty.cost == empty.initialCost == 0
+
+  async def test(client, dme):
+    await client.StartSession()
+    await client.GoTo("X(800),Y(500),Z(5)")
+    points = await routines.run_probe_plan(client, plan.commands)
+    assert [ p.x for p in points ] == sorted(xs, reverse=True)
+
+  run_with_simulator(test)
+
+def test_head_kinematics():
+  head = HeadKinematics(aOffset=2, bOffset=-3)
+  async def test(client, dme):
+    await client.StartSession()
+    assert await head.validate(client) > 1
+    # alignments are reported in the active frame and converted back
+    await routines.set_part_csy(client, Csy(10, 20, 0, 30, 0, 45))
+    assert await head.calibrate(client) < 1e-4
+    assert head.aOffset == approx(0, abs=1e-4) and head.bOffset == approx(0, abs=1e-4)
+
+  run_with_simulator(test)
+
+  (a, b) = (np.array([ 0, 15, 45, 90 ]), np.array([ 10, -90, 30, 180 ]))
+  alignments = head.alignments(a, b)
+  assert alignments[1] == approx((-math.sin(math.radians(15)), 0, math.cos(math.radians(15))), abs=1e-4)
+  (a2, b2) = head.angles(alignments, b=10)
+  assert a2 == approx(a, abs=1e-4) and (b2 - b + 180) % 360 - 180 == approx(0, abs=1e-3)
+  assert head.alignment(15, -90) is head.alignment(15, -90) and head.hits == 1
+
+  # fixed pairs of the I++ A/B convention: A tilts from vertical, B turns about Z from -Y towards +X
+  nominal = HeadKinematics()
+  pairs = [
+    ((0, 0), (0, 0, 1)),
+    ((90, 0), (0, -1, 0)),
+    ((90, 90), (1, 0, 0)),
+    ((90, -90), (-1, 0, 0)),
+    ((15, -90), (-0.258819, 0, 0.965926)),
+    ((45, 180), (0, 0.707107, 0.707107)),
+  ]
+  for ((a, b), alignment) in pairs:
+    assert tuple(nominal.alignment(a, b)) == approx(alignment, abs=1e-6)
+    assert nominal.angle(alignment, b) == approx((a, b), abs=1e-4)
+
+  # headprobe_line's B angles from the head model equal the ones its original atan2
+  # formula gave: a 20 mm line along X probed from 10 mm off its middle
+  contacts = np.array([ [ 0, 0, 0 ], [ 10, 0, 0 ], [ 20, 0, 0 ] ])
+  assert routines.head_b_angles(nominal, contacts - (10, 10, 0), -90) == approx([ -135, -90, -45 ])
+
+def test_state_cache():
+  async def test(client, dme):
+    await client.StartSession()
+    tool = "Component_3.1.50.4.A0.0-B0.0"
+    for i in range(2):
+      commandsSent = client.commandsSent
+      await routines.ensure_homed(client)
+      await routines.ensure_tool_loaded(client, tool)
+    # the second time round both are answered locally
+    assert client.commandsSent == commandsSent and client.state.homed and client.state.get("Tool.Name") == tool
+
+    await client.SetProp("Tool.PtMeasPar.HeadTouch(1)")
+    commandsSent = client.commandsSent
+    await client.SetProp("Tool.PtMeasPar.HeadTouch(1)")
+    speed = await client.GetProp([ "Tool.PtMeasPar.HeadTouch()" ])
+    assert client.commandsSent == commandsSent and speed.data_list[0].endswith("Tool.PtMeasPar.HeadTouch(1)\r\n")
+    await client.SetProp("Tool.PtMeasPar.HeadTouch(0)")
+    assert client.commandsSent == commandsSent + 1 and dme.props["Tool.PtMeasPar.HeadTouch"] == 0
+
+    # a change pending when a query is answered isn't overwritten by the query's older value
+    pending = client.SetProp("Tool.PtMeasPar.Speed(20)")
+    await client.GetProp([ "Tool.PtMeasPar.Speed()" ])
+    await pending
+    assert client.state.get("Tool.PtMeasPar.Speed") == 20
+
+    # errors that stop the DME forget everything
+    await client.GoTo("Z(200)")
+    with pytest.raises(CmmException):
+      await client.GoTo("X(400),Y(300),Z(100)")
+    assert client.state.homed is None and client.state.get("Tool.Name") is None
+    assert client.state.hits == 4 and client.state.misses > 0
+
+    # answers from the mirrored coordinate system aren't counted as hits
+    await client.ClearAllErrors()
+    await client.SetCoordSystem("MachineCsy")
+    await client.GetCoordSystem()
+    assert client.state.hits == 4
+
+  run_with_simulator(test)
+
+  # local answers repeat the value text the server sent
+  state = StateCache()
+  query = Transaction("00001", 'GetProp(Tool.Mode(), Tool.Name())')
+  state.learn(query)
+  query.data_list = [ '00001 # Tool.Mode(ON), Tool.Name("Probe")\r\n' ]
+  query.handle_complete()
+  assert state.format("Tool.Mode") == "Tool.Mode(ON)" and state.get("Tool.Name") == "Probe"
+
+def test_query_batching():
+  assert split_arguments('X(1), IJK(0,0,1), Tool.Name("A,B(1)")') == [ "X(1)", "IJK(0,0,1)", 'Tool.Name("A,B(1)")' ]
+
+  async def test(client, dme):
+    await client.GoTo("X(10),Y(20),Z(30)")
+    commandsSent = client.commandsSent
+    results = await asyncio.gather(
+      client.queryPosition([ "X()", "Y()" ]),
+      client.queryPosition([ "Z()", "X()" ]),
+      client.queryProps([ "Tool.PtMeasPar.Speed()" ]),
+      client.queryProps([ "Tool.GoToPar.Speed()", "Tool.PtMeasPar.Speed()" ]),
+    )
+    # one Get and one GetProp, X() and Tool.PtMeasPar.Speed() asked for once
+    assert client.commandsSent == commandsSent + 2
+    assert results[:2] == [ [ "X(10.0000)", "Y(20.0000)" ], [ "Z(30.0000)", "X(10.0000)" ] ]
+    assert results[3][1] == results[2][0] == "Tool.PtMeasPar.Speed(%g)" % dme.props["Tool.PtMeasPar.Speed"]
+    assert client.positionQueries.shared == 1 and client.propQueries.batches == 1
+
+    # queries made after a move see its result, not the earlier in-flight query's
+    before = client.queryPosition([ "X()" ])
+    moved = client.GoTo("X(15)").complete()
+    after = client.queryPosition([ "X()" ])
+    (x0, _, x1) = await asyncio.gather(before, moved, after)
+    assert (x0, x1) == ([ "X(10.0000)" ], [ "X(15.0000)" ])
+
+    with pytest.raises(CmmException):
+      await asyncio.gather(client.queryPosition([ "Q()" ]), client.queryPosition([ "X()" ]))
+
+  run_with_simulator(test)
+
+def test_query_batching_failures():
+  async def test(client, server):
+    # the echo server answers Get(X(), Y()) with one part
+    with pytest.raises(CmmException, match="No Y"):
+      await client.queryPosition([ "X()", "Y()" ])
+
+    # cancelling the merged command cancels its callers
+    query = asyncio.ensure_future(client.queryPosition([ "Z()" ]))
+    while not client.positionQueries.inFlight:
+      await asyncio.sleep(0)
+    get = list(client.transactions.values())[-1]
+    assert get.command == "Get(Z())"
+    get.complete().cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await query
+
+  run_with_client(test)
+
+def test_simulator_collision_stops_dme():
+  async def test(client, dme):
+    await client.GoTo("X(400),Y(300),Z(150)")
+    # the second move runs through the reference sphere
+    queued = [ client.GoTo("Z(140)"), client.GoTo("Z(50)"), client.Get("X(),Y(),Z()") ]
+    futures = [ t.complete() for t in queued ]
+    # the fast queue is answered while the main queue is busy moving
+    errStatus = await client.GetErrStatusE().complete()
+    assert queued[1].status != TransactionStatus.COMPLETE
+    assert "ErrStatus(0)" in errStatus.data_list[0]
+
+    await futures[0]
+    with pytest.raises(CmmException, match="Collision"):
+      await futures[1]
+    with pytest.raises(CmmExceptionFlushed):
+      await futures[2]
+
+    with pytest.raises(CmmException, match="ClearAllErrors"):
+      await client.Get("X(),Y(),Z()")
+    await client.ClearAllErrors()
+    position = await client.Get("X(),Y(),Z()").complete()
+    assert float3.FromXYZString(position.data_list[0]).z == approx(112.5)
+
+  run_with_simulator(test, realTime=True, props={ "Tool.GoToPar.Speed": 500.0 })
+
+def test_capture_and_replay(tmp_path):
+  path = str(tmp_path / "session.ippcap")
+
+  async def session(client):
+    await client.StartSession()
+    await client.GoTo("X(1)")
+    scan = await client.ScanOnLine("25").complete()
+    return scan.data_list
+
+  async def record():
+    server = FakeServer()
+    await server.start()
+    client = Client("127.0.0.1", server.port, recorder=CaptureWriter(path))
+    await client.connect()
+    data = await session(client)
+    await client.disconnect()
+    client.recorder.close()
+    await server.stop()
+    return data
+  recorded = asyncio.run(record())
+
+  [ (startTime, records) ] = read_sessions(path)
+  assert [ r.data for r in records if r.direction == SENT ] == [ b"00001 StartSession()\r\n", b"00002 GoTo(X(1))\r\n", b"00003 ScanOnLine(25)\r\n" ]
+  assert sum(r.direction == RECEIVED for r in records) == 3 + 3 + 5
+  assert summarize(records)["ScanOnLine"]["count"] == 1
+
+  async def replay():
+    async with ReplayServer(path, speed=None) as server:
+      client = Client("127.0.0.1", server.port)
+      await client.connect()
+      data = await session(client)
+      await client.disconnect()
+      assert server.mismatches == 0
+      return data
+  assert asyncio.run(replay()) == recorded
+
+def test_measurement_store(tmp_path):
+  store = MeasurementStore(str(tmp_path))
+  store.append([ float3(1, 2, 3), float3(4, 5, 6) ], part="bracket", feature="top", csy=Csy(1, 2, 3, 0, 0, 0), timestamp=10)
+  store.append(np.zeros((1000, 3)), part="plate", feature="scan", timestamp=20)
+  scan = ScanResult(np.arange(12.0).reshape(2, 6), "X(),Y(),Z(),IJK()")
+  store.append(scan, part="bracket", feature="side", tool="RefTool", timestamp=30)
+  with pytest.raises(ValueError):
+    store.append(np.zeros((1, 3)), timestamp=5)
+
+  # reopened from disk
+  store = MeasurementStore(str(tmp_path))
+  assert len(store) == 1004
+  bracket = store.query(part="bracket")
+  assert len(bracket) == 4
+  assert bracket.xyz.tolist() == [ [1, 2, 3], [4, 5, 6], [0, 1, 2], [6, 7, 8] ]
+  assert np.isnan(bracket.ijk[0]).all() and bracket.ijk[3].tolist() == [ 9, 10, 11 ]
+  assert [ m["feature"] for m in bracket.metadata() ] == [ "top", "side" ]
+  assert bracket.metadata()[0]["csy"] == "Csy(1, 2, 3, 0, 0, 0)"
+
+  [ (metadata, points) ] = store.query(start=15, end=30).batches()
+  assert metadata["part"] == "plate" and points.shape == (1000, 3)
+  assert len(store.query(part="bracket", feature="side")) == 2
+  assert len(store.query(part="unknown")) == 0
+
+@pytest.mark.parametrize("kind", [ "process", "thread" ])
+def test_offloader(kind):
+  async def test():
+    scan = Transaction("00001", "ScanOnLine()")
+    scan.data_list = [ "00001 # %s\r\n" % ",".join("%d,%d,%d" % (i, i, -i) for i in range(start, start + 10)) for start in range(0, 10000, 10) ]
+    with Offloader(kind, maxWorkers=1) as offloader:
+      result = await offloader.scanResult(scan)
+      assert result.array.shape == (10000, 3) and result.xyz[-1].tolist() == [ 9999, 9999, -9999 ]
+      norms = await offloader.run(np.linalg.norm, result.xyz, axis=1)
+      assert norms == approx(np.linalg.norm(result.xyz, axis=1))
+
+      # the client's scan report format is used
+      client = Client()
+      client.scanReportFormat = "X(),Y(),Z(),IJK()"
+      scan = Transaction("00002", "ScanOnLine()", client)
+      scan.data_list = [ "00002 # 1,2,3,0,0,1,4,5,6,0,1,0\r\n" ]
+      result = await offloader.scanResult(scan)
+      assert result.ijk.tolist() == [ [ 0, 0, 1 ], [ 0, 1, 0 ] ]
+      with pytest.raises(ValueError):
+        scan.data_list = [ "00002 # 1,2,x\r\n" ]
+        await offloader.scanResult(scan)
+
+  asyncio.run(test())
+
+OFFLOAD_LEAK_SCRIPT = """
+import sys, asyncio, multiprocessing
+from ipp import Transaction
+from ipp_offload import Offloader
+
+async def main():
+  scan = Transaction("00001", "ScanOnLine()")
+  scan.data_list = [ "00001 # %d,%d,%d\\r\\n" % (i, i, -i) for i in range(20000) ]
+  with Offloader(maxWorkers=2, mpContext=multiprocessing.get_context(sys.argv[1])) as offloader:
+    # start the workers with a call that doesn't touch shared memory
+    await offloader.run(len, [])
+    for i in range(3):
+      assert (await offloader.scanResult(scan)).array.shape == (20000, 3)
+
+if __name__ == "__main__":
+  asyncio.run(main())
+"""
+
+@pytest.mark.parametrize("method", [ "fork", "spawn" ])
+def test_offloader_frees_shared_memory(method):
+  # leaked blocks are reported by the resource tracker when the interpreter exits
+  proc = subprocess.run([ sys.executable, "-c", OFFLOAD_LEAK_SCRIPT, method ], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=60)
+  assert proc.returncode == 0, proc.stderr
+  assert "resource_tracker" not in proc.stderr
+
+def test_loop_lag_monitor():
+  async def test():
+    monitor = LoopLagMonitor(interval=0.001).start()
+    await asyncio.sleep(0.01)
+    # block the loop
+    time.sleep(0.05)
+    await asyncio.sleep(0.01)
+    monitor.stop()
+    assert monitor.summary()["max"] >= 0.04
+
+  asyncio.run(test())
+
+def test_feature_fits():
+  rng = np.random.default_rng(0)
+  directions = rng.normal(size=(200, 3))
+  directions /= np.linalg.norm(directions, axis=1)[:,None]
+  points = np.array([ 400, 300, 100 ]) + 12.5 * directions
+  sphere = fit_sphere(points)
+  assert tuple(sphere.center) == approx((400, 300, 100)) and sphere.radius == approx(12.5) and sphere.form < 1e-9
+
+  # point by point, as PtMeas results arrive, from float3s
+  incremental = IncrementalSphere(refine=True)
+  for p in points[:10]:
+    incremental.add(float3(*p))
+  assert incremental.result().radius == approx(12.5)
+
+  angles = np.linspace(0, 2 * math.pi, 36, endpoint=False)
+  circle = np.column_stack([ 200 + 25 * np.cos(angles), 300 + 25 * np.sin(angles), np.full(36, 30.0) ])
+  circle[::2,:2] += 0.01 * np.column_stack([ np.cos(angles[::2]), np.sin(angles[::2]) ])
+  for fit in (fit_circle(circle), IncrementalCircle(circle).result()):
+    assert tuple(fit.center) == approx((200, 300, 30), abs=1e-6) and abs(fit.normal.z) == approx(1)
+    assert fit.radius == approx(25.005, abs=1e-4) and fit.form == approx(0.01, abs=1e-4)
+
+  heights = np.repeat([ 10.0, 50.0 ], 36)
+  cylinder = fit_cylinder(np.column_stack([ 200 + 25 * np.cos(np.tile(angles, 2)), 300 + 25 * np.sin(np.tile(angles, 2)), heights ]))
+  assert cylinder.radius == approx(25) and abs(cylinder.axis.z) == approx(1) and tuple(cylinder.point) == approx((200, 300, 30))
+
+  surface = np.column_stack([ 200 + 25 * np.cos(np.tile(angles, 2)), 300 + 25 * np.sin(np.tile(angles, 2)), heights ])
+  incrementalCylinder = IncrementalCylinder(surface[:36:3]).extend(surface[36::3])
+  first = incrementalCylinder.result()
+  assert first.radius == approx(25) and abs(first.axis.z) == approx(1)
+  # refit from the previous axis as more points arrive
+  assert incrementalCylinder.extend(surface[1::3]).result().radius == approx(25) and len(incrementalCylinder) == 48
+
+  plane = fit_plane([ float3(0, 0, 0), float3(1, 0, 0.1), float3(0, 1, 0), float3(1, 1, 0.1) ], normal=(0, 0, 1))
+  assert plane.normal.z > 0 and plane.form == approx(0)
+  incrementalPlane = IncrementalPlane()
+  for p in [ (0, 0, 0), (1, 0, 0.1), (0, 1, 0), (1, 1, 0.1) ]:
+    incrementalPlane.add(p)
+  fit = incrementalPlane.result()
+  assert abs(np.dot(tuple(fit.normal), tuple(plane.normal))) == approx(1) and fit.form == approx(0, abs=1e-12)
+
+  # a line along (1, 2, 2) through (10, 0, 5), every other point 0.01 off it along (2, -1, 0)
+  t = np.linspace(-20, 20, 21)
+  offsets = np.where(np.arange(21) % 2, 0.01, 0.0)[:,None] * np.array([ 2, -1, 0 ]) / math.sqrt(5)
+  line = np.array([ 10, 0, 5 ]) + np.outer(t, np.array([ 1, 2, 2 ]) / 3) + offsets
+  for fit in (fit_line(line), IncrementalLine(line).result()):
+    assert abs(np.dot(tuple(fit.direction), (1 / 3, 2 / 3, 2 / 3))) == approx(1)
+    # the fitted line passes 10/21 of the offset from the 11 points on the nominal line
+    assert fit.form == approx(2 * 0.01 * 11 / 21) and tuple(fit.point) == approx((10, 0, 5), abs=0.01)